@@ -0,0 +1,98 @@
+"""添付ファイルのローカルキャッシュ（SHA-256 によるコンテンツアドレス）。
+
+メッセージの attachment には "sha256:<hex>" を入れ、実体は
+attachments/<hex> に置く。同じ画像は一度しか保存しない。
+サーバからのダウンロードは attachments/partial/<hex>.part に書き込み、
+ハッシュを確認してから本来の場所へ移す。
+
+チャンクフレームの形式は server/blobstore.py と同じ:
+  0x00 | SHA-256 (32 bytes) | offset (8 bytes, big endian) | data
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import struct
+from pathlib import Path
+from typing import Optional, Tuple
+
+ATTACHMENT_PREFIX = "sha256:"
+CHUNK_KIND = 0x00
+CHUNK_HEADER = struct.Struct(">B32sQ")
+CHUNK_SIZE = 64 * 1024
+
+
+def pack_chunk(sha: str, offset: int, data: bytes) -> bytes:
+    return CHUNK_HEADER.pack(CHUNK_KIND, bytes.fromhex(sha), offset) + data
+
+
+def unpack_chunk(frame: bytes) -> Tuple[str, int, bytes]:
+    _, digest, offset = CHUNK_HEADER.unpack_from(frame)
+    return digest.hex(), offset, frame[CHUNK_HEADER.size:]
+
+
+def is_chunk_frame(raw) -> bool:
+    return isinstance(raw, (bytes, bytearray)) and len(raw) >= CHUNK_HEADER.size and raw[0] == CHUNK_KIND
+
+
+def sha_of_ref(ref: Optional[str]) -> Optional[str]:
+    """"sha256:<hex>" 形式なら hex を返す（旧形式のファイルパスなら None）。"""
+    if ref and ref.startswith(ATTACHMENT_PREFIX):
+        return ref[len(ATTACHMENT_PREFIX):]
+    return None
+
+
+def file_sha256(path: Path | str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AttachmentCache:
+    def __init__(self, root: Path | str):
+        self.root = Path(root)
+        self.partial_dir = self.root / "partial"
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, sha: str) -> Path:
+        return self.root / sha
+
+    def add_file(self, src: Path | str) -> str:
+        """ファイルをキャッシュに取り込み、参照文字列 "sha256:<hex>" を返す。"""
+        sha = file_sha256(src)
+        dest = self.path(sha)
+        if not dest.exists():
+            tmp = self.partial_dir / f"{sha}.copy"
+            shutil.copy(str(src), str(tmp))
+            os.replace(tmp, dest)
+        return ATTACHMENT_PREFIX + sha
+
+    def resolve(self, ref: Optional[str]) -> Optional[Path]:
+        """表示に使うローカルファイル。まだ手元にない場合は None。"""
+        if not ref:
+            return None
+        sha = sha_of_ref(ref)
+        p = self.path(sha) if sha else Path(ref)
+        return p if p.exists() else None
+
+    def write_chunk(self, sha: str, offset: int, data: bytes) -> None:
+        """ダウンロード中のチャンクを書き込む（範囲指定で任意の位置へ）。"""
+        part = self.partial_dir / f"{sha}.part"
+        mode = "r+b" if part.exists() else "wb"
+        with open(part, mode) as f:
+            f.seek(offset)
+            f.write(data)
+
+    def finish_download(self, sha: str) -> bool:
+        """ハッシュを検証して取り込む。成功すれば True。"""
+        part = self.partial_dir / f"{sha}.part"
+        if not part.exists():
+            return self.path(sha).exists()
+        if file_sha256(part) != sha:
+            part.unlink()
+            return False
+        os.replace(part, self.path(sha))
+        return True
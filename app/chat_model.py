@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional
+
+from PySide6.QtCore import QAbstractListModel, QModelIndex, Qt
+
+from .attachments import AttachmentCache, sha_of_ref
+
+ME = "あなた"
+
+
+class MessageListModel(QAbstractListModel):
+    """チャット画面に表示しているメッセージ（storage の行 dict）のリスト。
+
+    起動時は最新の 1 ページだけを持ち、古いページは prepend_messages() で
+    先頭に足していく。描画は BubbleDelegate（ui_enhancements.py）が行う。
+
+    Roles:
+      - Qt.DisplayRole: text
+      - SenderRole: sender
+      - AlignRightRole: 自分のメッセージなら True
+      - AttachmentRole: attachment（"sha256:<hex>" または旧形式のパス）
+      - AttachmentPathRole: 表示に使うローカルファイル（まだ無ければ None）
+      - AttachmentPendingRole: 添付をダウンロード待ちなら True
+      - UnsentRole: サーバの ack をまだ受け取っていない自分のメッセージなら True
+    """
+
+    SenderRole = Qt.UserRole + 1
+    AlignRightRole = Qt.UserRole + 2
+    AttachmentRole = Qt.UserRole + 3
+    AttachmentPathRole = Qt.UserRole + 4
+    AttachmentPendingRole = Qt.UserRole + 5
+    UnsentRole = Qt.UserRole + 6
+
+    def __init__(self, attachments: Optional[AttachmentCache] = None, parent=None):
+        super().__init__(parent)
+        self.attachments = attachments
+        self._rows: List[Dict] = []
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._rows)
+
+    def _attachment_path(self, ref: Optional[str]) -> Optional[str]:
+        if not ref or self.attachments is None:
+            return None
+        path = self.attachments.resolve(ref)
+        return str(path) if path else None
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid() or not 0 <= index.row() < len(self._rows):
+            return None
+        msg = self._rows[index.row()]
+        if role == Qt.DisplayRole:
+            return msg.get("text", "")
+        if role == self.SenderRole:
+            return msg.get("sender", "?")
+        if role == self.AlignRightRole:
+            return msg.get("sender") == ME
+        if role == self.AttachmentRole:
+            return msg.get("attachment")
+        if role == self.AttachmentPathRole:
+            return self._attachment_path(msg.get("attachment"))
+        if role == self.AttachmentPendingRole:
+            ref = msg.get("attachment")
+            return sha_of_ref(ref) is not None and self._attachment_path(ref) is None
+        if role == self.UnsentRole:
+            return bool(msg.get("unsent"))
+        return None
+
+    @property
+    def oldest_id(self) -> Optional[int]:
+        return self._rows[0].get("id") if self._rows else None
+
+    def append_messages(self, rows: Iterable[Dict]) -> None:
+        rows = list(rows)
+        if not rows:
+            return
+        first = len(self._rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self._rows.extend(rows)
+        self.endInsertRows()
+
+    def prepend_messages(self, rows: Iterable[Dict]) -> None:
+        """古いページを先頭に追加する（rows は古い順）。"""
+        rows = list(rows)
+        if not rows:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+        self._rows[:0] = rows
+        self.endInsertRows()
+
+    def mark_sent(self, client_msg_id: Optional[str]) -> bool:
+        """ack の来たメッセージの「送信待ち」を消す。該当する行があれば True。"""
+        if not client_msg_id:
+            return False
+        # ack が来るのはたいてい最近送ったメッセージなので末尾から探す
+        for row in range(len(self._rows) - 1, -1, -1):
+            msg = self._rows[row]
+            if msg.get("client_msg_id") == client_msg_id:
+                if not msg.get("unsent"):
+                    return False
+                msg["unsent"] = False
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
+                return True
+        return False
+
+    def missing_attachments(self) -> List[str]:
+        """まだ手元にない "sha256:" 添付の参照。"""
+        refs = []
+        for msg in self._rows:
+            ref = msg.get("attachment")
+            if sha_of_ref(ref) and self._attachment_path(ref) is None and ref not in refs:
+                refs.append(ref)
+        return refs
+
+    def refresh_attachment_path(self, path: str) -> None:
+        """サムネイルができた画像を表示している行を再描画させる。"""
+        for row, msg in enumerate(self._rows):
+            if self._attachment_path(msg.get("attachment")) == path:
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
+
+    def refresh_attachment(self, sha: str) -> None:
+        """ダウンロードが終わった添付を表示している行を再描画させる。"""
+        for row, msg in enumerate(self._rows):
+            if sha_of_ref(msg.get("attachment")) == sha:
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
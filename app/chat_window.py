@@ -5,30 +5,68 @@ from PySide6.QtWidgets import (
     QLabel,
     QPushButton,
     QLineEdit,
-    QListWidget,
-    QListWidgetItem,
+    QListView,
+    QAbstractItemView,
     QSizePolicy,
     QFileDialog,
 )
-from PySide6.QtCore import QDateTime
+from PySide6.QtCore import QEvent, QTimer, Signal
 from pathlib import Path
-import shutil
+import logging
+import time
+import uuid
 
-from .storage import Storage
-from .ui_enhancements import MessageBubble
-from .ws_client import WSClient
+from .attachments import AttachmentCache
+from .chat_model import MessageListModel
+from .storage import PAGE_SIZE, Storage
+from .thumbnails import ThumbnailCache
+from .ui_enhancements import BubbleDelegate
+
+# 最初の描画までに読み込む件数（ウィンドウ 1 画面分あれば足りる）
+FIRST_SCREEN_ROWS = 30
+# この時間（ミリ秒）までに描画されなければ、描画を待たずに遅延初期化を行う
+STARTUP_FALLBACK_MS = 1000
+# 入力が止まってからこの時間（ミリ秒）で「入力中」を取り消す
+TYPING_IDLE_MS = 3000
+# 入力を続けている間、「入力中」を送り直す間隔（ミリ秒）
+TYPING_REFRESH_MS = 2000
+# 相手の「入力中」は更新が来なければこの時間（ミリ秒）で消す
+TYPING_EXPIRE_MS = 6000
+# 自分の在席状態を送り直す間隔と、相手の在席を消すまでの時間（ミリ秒）
+PRESENCE_REFRESH_MS = 30000
+PRESENCE_EXPIRE_MS = 75000
 
 
 class ChatWindow(QWidget):
     """シンプルなチャット画面ウィジェット。
 
-    - メッセージ表示: QListWidget
+    - メッセージ表示: QListView + MessageListModel + BubbleDelegate（行ごとのウィジェットは作らない）
     - 入力欄: QLineEdit
     - 送信ボタン: QPushButton
 
-    送信後は自分のメッセージをリストに追加し、簡単なエコー応答を表示します（デモ目的）。
+    起動時は最新の PAGE_SIZE 件だけを読み込み、上端までスクロールすると
+    storage から古いページを読み足す。
+
+    起動を速くするため、コンストラクタでは 1 画面分（FIRST_SCREEN_ROWS 件）
+    だけを読み込む。最初の描画が終わってから、ストレージのウォームアップ・
+    最新ページの残り・WebSocket 接続を始める。
+
+    入力中・在席の状態は保存されない一時的なメッセージとしてやり取りし、
+    相手の状態は一覧の下（入力中）とステータス行の右（在席）に表示する。
+    自分の在席はウィンドウがアクティブかどうかで online / away を切り替え、
+    PRESENCE_REFRESH_MS ごとに送り直す。どちらも取りこぼしてよい前提なので、
+    相手の状態は更新が来なければ期限切れで消す。相手は名前ではなく peer
+    （クライアントごとの id）で区別するので、同じ名前の相手も別々に扱い、
+    自分の送った分が戻ってきても相手としては数えない。
+
+    Signals:
+      - first_painted: メッセージ一覧を初めて描画し終えた
+      - interactive: 起動後の遅延初期化が終わった
     """
 
+    first_painted = Signal()
+    interactive = Signal()
+
     def __init__(self, parent=None, server_url=None):
         super().__init__(parent)
         self.setWindowTitle("PyChat - チャット")
@@ -36,20 +74,67 @@ class ChatWindow(QWidget):
 
         # ストレージ初期化（リポジトリのルートに DB を作成）
         db_path = Path(__file__).resolve().parents[1] / "chat_history.db"
-        self.storage = Storage(db_path)
+        self.storage = Storage(db_path, defer_warm_up=True)
+        # 添付ファイルは SHA-256 をキーにしたキャッシュに置く
+        self.attachments = AttachmentCache(Path(__file__).resolve().parents[1] / "attachments")
+        # 画像はバックグラウンドで縮小し、縮小結果をメモリとディスクにキャッシュする
+        self.thumbnails = ThumbnailCache(self.attachments.root / "thumbnails", self)
+        self.thumbnails.ready.connect(self._on_thumbnail_ready)
+        self._relayout_scheduled = False
 
         # ステータス表示（接続状態 / 接続先）
         self.status_label = QLabel()
         self.status_label.setText("Not connected")
         self.status_label.setStyleSheet("color: gray; padding:4px;")
 
+        # 在席中の相手
+        self.presence_label = QLabel()
+        self.presence_label.setStyleSheet("color: gray; padding:4px;")
+
         main_layout = QVBoxLayout(self)
-        main_layout.addWidget(self.status_label)
+        status_layout = QHBoxLayout()
+        status_layout.addWidget(self.status_label)
+        status_layout.addStretch(1)
+        status_layout.addWidget(self.presence_label)
+        main_layout.addLayout(status_layout)
 
         # メッセージ表示エリア
-        self.chat_view = QListWidget()
+        self.model = MessageListModel(self.attachments, self)
+        self.chat_view = QListView()
+        self.chat_view.setModel(self.model)
+        self.chat_view.setItemDelegate(BubbleDelegate(self.thumbnails, self.chat_view))
+        self.chat_view.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        # 幅が変わったら折り返しをやり直す
+        self.chat_view.setResizeMode(QListView.Adjust)
+        self.chat_view.setSelectionMode(QAbstractItemView.NoSelection)
         self.chat_view.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.chat_view.verticalScrollBar().valueChanged.connect(self._on_scrolled)
+        # 最初の描画を待って遅延初期化を始める
+        self.chat_view.viewport().installEventFilter(self)
         main_layout.addWidget(self.chat_view)
+        # 古いページがもう無いか
+        self._history_exhausted = False
+
+        # 相手の入力中表示
+        self.typing_label = QLabel()
+        self.typing_label.setStyleSheet("color: gray; font-size: 11px; padding:0 4px;")
+        main_layout.addWidget(self.typing_label)
+        # 相手の状態: 送信者 -> 入力中の期限 / (在席状態, 期限)（期限は time.monotonic()）
+        # peer -> (名前, 期限) / peer -> (名前, 状態, 期限)
+        self._typing_peers = {}
+        self._presence = {}
+        self._peer_expiry = QTimer(self)
+        self._peer_expiry.setInterval(1000)
+        self._peer_expiry.timeout.connect(self._expire_peers)
+        self._presence_refresh = QTimer(self)
+        self._presence_refresh.setInterval(PRESENCE_REFRESH_MS)
+        self._presence_refresh.timeout.connect(self._send_presence)
+        # 自分の入力中状態（最後に送った時刻。送っていなければ None）
+        self._typing_sent = None
+        self._typing_idle = QTimer(self)
+        self._typing_idle.setSingleShot(True)
+        self._typing_idle.setInterval(TYPING_IDLE_MS)
+        self._typing_idle.timeout.connect(self._stop_typing)
 
         # 入力エリア
         input_layout = QHBoxLayout()
@@ -66,147 +151,335 @@ class ChatWindow(QWidget):
         # シグナル
         self.send_btn.clicked.connect(self.send_message)
         self.input.returnPressed.connect(self.send_message)
+        self.input.textEdited.connect(self._on_text_edited)
         self.attach_btn.clicked.connect(self.attach_file)
 
-    # 起動時に履歴をロード
+        self.ws_client = None
+
+        self.server_url = server_url
+        self._started = False
+        QTimer.singleShot(STARTUP_FALLBACK_MS, self._start_unpainted)
+
+        # 起動時は最新の 1 画面分だけをロード（残りは最初の描画の後）
         try:
-            for msg in self.storage.get_messages():
-                who = msg.get("sender", "?")
-                text = msg.get("text", "")
-                ts = msg.get("timestamp")
-                attachment = msg.get("attachment")
-                is_sender = who == "あなた"
-                # MessageBubble を使って履歴表示
-                widget = MessageBubble(who, text=text, attachment=attachment, align_right=is_sender)
-                item = QListWidgetItem()
-                item.setSizeHint(widget.sizeHint())
-                self.chat_view.addItem(item)
-                self.chat_view.setItemWidget(item, widget)
-            self.chat_view.scrollToBottom()
+            rows = self.storage.get_page(limit=FIRST_SCREEN_ROWS)
+            self._history_exhausted = len(rows) < FIRST_SCREEN_ROWS
+            self.model.append_messages(rows)
+            # レイアウトが決まってから最下部へ
+            QTimer.singleShot(0, self.chat_view.scrollToBottom)
         except Exception:
             # 履歴ロード失敗は無視
             pass
 
-        # WebSocket クライアント
-        self.ws_client = None
-        self.server_url = server_url
-        if server_url:
+    def eventFilter(self, obj, event):
+        if not self._started and event.type() == QEvent.Paint and obj is self.chat_view.viewport():
+            self._started = True
+            # paint が終わってから（次のイベントループで）続きを行う
+            QTimer.singleShot(0, self._on_first_paint)
+        return super().eventFilter(obj, event)
+
+    def _on_first_paint(self):
+        self.first_painted.emit()
+        self._finish_startup()
+
+    def _start_unpainted(self):
+        # 最小化されたまま起動したなど、描画されないときも接続は始める
+        if not self._started:
+            self._started = True
+            self._finish_startup()
+
+    def _finish_startup(self):
+        """最初の描画の後に行う初期化。終わったら interactive を emit する。"""
+        self.chat_view.viewport().removeEventFilter(self)
+        # 検索インデックスの準備は専用スレッドに任せて待たない
+        self.storage.warm_up()
+        # 最新ページの残りを、表示位置を保ったまま先頭に足す
+        if not self._history_exhausted:
+            self._load_older_page(PAGE_SIZE - self.model.rowCount())
+
+        # WebSocket クライアント（websocket パッケージの import もここまで遅らせる）
+        if self.server_url:
             try:
-                self.ws_client = WSClient()
-                self.ws_client.message_received.connect(self._on_ws_message)
+                from .ws_client import WSClient
+
+                # 未 ack のメッセージは storage の outbox に残し、再接続時に送り直す
+                self.ws_client = WSClient(attachments=self.attachments, outbox=self.storage)
+                self.ws_client.messages_received.connect(self._on_ws_messages)
+                self.ws_client.message_acked.connect(self._on_ws_ack)
+                self.ws_client.attachment_ready.connect(self._on_attachment_ready)
+                self.ws_client.ephemeral_received.connect(self._on_ws_ephemeral)
                 # 接続状態シグナルをハンドル
                 self.ws_client.connected.connect(self._on_ws_connected)
                 self.ws_client.disconnected.connect(self._on_ws_disconnected)
-                # start in background thread
-                self.ws_client.start(server_url)
+                # start in background thread（保存済みより新しいメッセージだけを受け取る）
+                self.ws_client.start(self.server_url, since=self.storage.max_server_id())
                 # 初期ステータス表示
-                self.status_label.setText(f"Connecting to {server_url}...")
+                self.status_label.setText(f"Connecting to {self.server_url}...")
                 self.status_label.setStyleSheet("color: orange; padding:4px;")
             except Exception:
                 self.ws_client = None
-
+        self.interactive.emit()
 
     def send_message(self):
         text = self.input.text().strip()
         if not text:
             return
+        self._stop_typing()
         # 送信メッセージを永続化
+        msg_id = None
         try:
-            self.storage.add_message("あなた", text)
+            msg_id = self.storage.add_message("あなた", text)
         except Exception:
             pass
 
-        # UI にバブルとして追加
-        widget = MessageBubble("あなた", text=text, align_right=True)
-        item = QListWidgetItem()
-        item.setSizeHint(widget.sizeHint())
-        self.chat_view.addItem(item)
-        self.chat_view.setItemWidget(item, widget)
+        # UI にバブルとして追加（サーバの ack が来るまでは「送信待ち」）
+        client_msg_id = uuid.uuid4().hex
+        unsent = bool(self.server_url)
+        self._append([{"id": msg_id, "sender": "あなた", "text": text, "attachment": None, "client_msg_id": client_msg_id, "unsent": unsent}])
         self.input.clear()
 
-        # サーバへ送信（接続されていれば）
+        # サーバへ送信（切断中なら outbox に残り、再接続時に送られる）
         try:
-            if self.ws_client is not None:
-                payload = {"sender": "あなた", "text": text}
-                self.ws_client.send(payload)
+            self._post({"sender": "あなた", "text": text, "client_msg_id": client_msg_id}, msg_id)
         except Exception:
             pass
 
-    def _append_message(self, who: str, text: str):
-        ts = QDateTime.currentDateTime().toString("HH:mm:ss")
-        item_text = f"[{ts}] {who}: {text}"
-        item = QListWidgetItem(item_text)
-        self.chat_view.addItem(item)
+    def _post(self, payload: dict, msg_id):
+        if self.ws_client is not None:
+            self.ws_client.post(payload, msg_id=msg_id)
+        elif self.server_url:
+            # WSClient を作る前（起動直後）でも outbox に残せば接続時に送られる
+            self.storage.put_outbox(payload["client_msg_id"], msg_id, payload)
+
+    def _on_text_edited(self, text: str):
+        if not text:
+            self._stop_typing()
+            return
+        if self.ws_client is None:
+            return
+        now = time.monotonic()
+        # 打鍵ごとではなく TYPING_REFRESH_MS に 1 回だけ送る
+        if self._typing_sent is None or (now - self._typing_sent) * 1000 >= TYPING_REFRESH_MS:
+            self.ws_client.send_typing("あなた", True)
+            self._typing_sent = now
+        self._typing_idle.start()
+
+    def _stop_typing(self):
+        self._typing_idle.stop()
+        if self._typing_sent is None:
+            return
+        self._typing_sent = None
+        if self.ws_client is not None:
+            self.ws_client.send_typing("あなた", False)
+
+    def _on_ws_ephemeral(self, data: dict):
+        sender = data.get("sender") or "相手"
+        # peer の無い古いサーバ・クライアントからのものは名前で区別する
+        peer = data.get("peer") or sender
+        if self.ws_client is not None and peer == self.ws_client.peer:
+            return
+        if data.get("type") == "typing":
+            if data.get("typing"):
+                self._typing_peers[peer] = (sender, time.monotonic() + TYPING_EXPIRE_MS / 1000)
+            else:
+                self._typing_peers.pop(peer, None)
+        elif data.get("type") == "presence":
+            status = data.get("status")
+            if status == "offline":
+                self._presence.pop(peer, None)
+                self._typing_peers.pop(peer, None)
+            else:
+                if peer not in self._presence:
+                    # 新しく来た相手には次の送り直しを待たずにこちらの状態を知らせる
+                    self._send_presence()
+                self._presence[peer] = (sender, status, time.monotonic() + PRESENCE_EXPIRE_MS / 1000)
+            self._update_presence_label()
+        self._update_typing_label()
+
+    def _expire_peers(self):
+        now = time.monotonic()
+        for peer, (_, expires) in list(self._typing_peers.items()):
+            if expires <= now:
+                del self._typing_peers[peer]
+        for peer, (_, _, expires) in list(self._presence.items()):
+            if expires <= now:
+                del self._presence[peer]
+        self._update_presence_label()
+        self._update_typing_label()
+
+    def _update_typing_label(self):
+        if self._typing_peers:
+            self.typing_label.setText("、".join(sorted(name for name, _ in self._typing_peers.values())) + " が入力中…")
+        else:
+            self.typing_label.clear()
+        # 期限切れの確認は相手の状態があるときだけ動かす
+        if self._typing_peers or self._presence:
+            if not self._peer_expiry.isActive():
+                self._peer_expiry.start()
+        else:
+            self._peer_expiry.stop()
+
+    def _update_presence_label(self):
+        online = sorted(name for name, st, _ in self._presence.values() if st == "online")
+        away = sorted(name for name, st, _ in self._presence.values() if st == "away")
+        parts = []
+        if online:
+            parts.append("オンライン: " + "、".join(online))
+        if away:
+            parts.append("離席: " + "、".join(away))
+        self.presence_label.setText(" / ".join(parts))
+
+    def _send_presence(self):
+        if self.ws_client is not None:
+            self.ws_client.send_presence("あなた", "online" if self.isActiveWindow() else "away")
+
+    def changeEvent(self, event):
+        if event.type() == QEvent.ActivationChange:
+            self._send_presence()
+        super().changeEvent(event)
+
+    def _on_ws_ack(self, data: dict):
+        # サーバの id は WSClient が outbox と一緒に storage へ記録する
+        if self.model.mark_sent(data.get("client_msg_id")):
+            self._schedule_relayout()
+
+    def _append(self, msgs: list):
+        """メッセージを末尾にまとめて追加し、最下部へ 1 回だけスクロールする。
+
+        手元にない添付はダウンロードを要求する。
+        """
+        first = self.model.rowCount()
+        self.model.append_messages(msgs)
         self.chat_view.scrollToBottom()
+        if self.ws_client is None:
+            return
+        for row in range(first, self.model.rowCount()):
+            index = self.model.index(row)
+            if index.data(MessageListModel.AttachmentPendingRole):
+                self.ws_client.download(index.data(MessageListModel.AttachmentRole))
+
+    def _on_scrolled(self, value: int):
+        # 上端に着いたら古いページを読み足す
+        if value == self.chat_view.verticalScrollBar().minimum() and not self._history_exhausted:
+            self._load_older_page()
+
+    def _load_older_page(self, limit: int = PAGE_SIZE):
+        oldest = self.model.oldest_id
+        if oldest is None or limit <= 0:
+            return
+        try:
+            rows = self.storage.get_page(before_id=oldest, limit=limit)
+        except Exception:
+            return
+        self._history_exhausted = len(rows) < limit
+        if not rows:
+            return
+        # 表示中の位置がずれないよう、下端からの距離を保ったまま先頭に追加する
+        bar = self.chat_view.verticalScrollBar()
+        from_bottom = bar.maximum() - bar.value()
+        self.model.prepend_messages(rows)
+        self.chat_view.doItemsLayout()
+        bar.setValue(bar.maximum() - from_bottom)
+        if self.ws_client is not None:
+            for ref in self.model.missing_attachments():
+                self.ws_client.download(ref)
+
+    def _on_attachment_ready(self, sha: str):
+        # ダウンロード待ちだったバブルを画像付きで描き直す
+        self.model.refresh_attachment(sha)
+        self._schedule_relayout()
+
+    def _on_thumbnail_ready(self, path: str):
+        self.model.refresh_attachment_path(path)
+        self._schedule_relayout()
+
+    def _schedule_relayout(self):
+        # 行の高さが変わるので、続けて届いた分をまとめて一度だけレイアウトし直す
+        if self._relayout_scheduled:
+            return
+        self._relayout_scheduled = True
+        QTimer.singleShot(0, self._relayout)
+
+    def _relayout(self):
+        self._relayout_scheduled = False
+        bar = self.chat_view.verticalScrollBar()
+        at_bottom = bar.value() == bar.maximum()
+        self.chat_view.doItemsLayout()
+        if at_bottom:
+            self.chat_view.scrollToBottom()
 
     def attach_file(self):
-        # ファイルダイアログで画像を選び、attachments フォルダにコピーしてメッセージとして送信
+        # ファイルダイアログで画像を選び、キャッシュに取り込んでからサーバへアップロードする
         filename, _ = QFileDialog.getOpenFileName(self, "ファイルを選択", str(Path.home()), "Images (*.png *.jpg *.jpeg *.bmp *.gif)")
         if not filename:
             return
         try:
-            attachments_dir = Path(__file__).resolve().parents[1] / "attachments"
-            attachments_dir.mkdir(parents=True, exist_ok=True)
-            dest = attachments_dir / (f"{int(QDateTime.currentSecsSinceEpoch())}_" + Path(filename).name)
-            shutil.copy(filename, str(dest))
+            # メッセージにはパスではなく "sha256:<hex>" を載せる
+            ref = self.attachments.add_file(filename)
             # 永続化（テキストは空でも良い）
-            self.storage.add_message("あなた", "", attachment=str(dest))
+            msg_id = self.storage.add_message("あなた", "", attachment=ref)
 
             # UI に追加
-            widget = MessageBubble("あなた", text="", attachment=str(dest), align_right=True)
-            item = QListWidgetItem()
-            item.setSizeHint(widget.sizeHint())
-            self.chat_view.addItem(item)
-            self.chat_view.setItemWidget(item, widget)
-            self.chat_view.scrollToBottom()
-            # サーバへ送信（ファイルパスを送る。実運用ではファイル転送/URL化が必要）
+            client_msg_id = uuid.uuid4().hex
+            unsent = bool(self.server_url)
+            self._append([{"id": msg_id, "sender": "あなた", "text": "", "attachment": ref, "client_msg_id": client_msg_id, "unsent": unsent}])
+            # サーバへアップロードし、完了してからメッセージを送る
             try:
-                if self.ws_client is not None:
-                    payload = {"sender": "あなた", "text": "", "attachment": str(dest)}
-                    self.ws_client.send(payload)
+                self._post({"sender": "あなた", "text": "", "attachment": ref, "client_msg_id": client_msg_id}, msg_id)
             except Exception:
                 pass
         except Exception:
             pass
 
     def closeEvent(self, event):
-        # アプリ終了時に DB を閉じる
+        self.thumbnails.shutdown()
+        # 終了の順番: offline を知らせてから ws を止める。stop() は受信済みのメッセージを
+        # _on_ws_messages へ渡し切ってから戻るので、DB はその後、最後に閉じる
+        if self.ws_client is not None:
+            try:
+                self.ws_client.send_presence("あなた", "offline")
+            except Exception:
+                logging.exception("failed to send offline presence")
+            try:
+                self.ws_client.stop()
+            except Exception:
+                logging.exception("failed to stop websocket client")
         try:
             self.storage.close()
         except Exception:
-            pass
-        try:
-            if self.ws_client is not None:
-                self.ws_client.stop()
-        except Exception:
-            pass
+            logging.exception("failed to close storage")
         super().closeEvent(event)
 
-    def _on_ws_message(self, data: dict):
-        """サーバから来たメッセージを UI に表示し、ローカルに保存する。"""
-        try:
-            sender = data.get("sender", "相手")
-            text = data.get("text", "")
-            ts = data.get("timestamp")
-            attachment = data.get("attachment")
-            # 永続化
+    def _on_ws_messages(self, batch: list):
+        """サーバから来たメッセージ（フレームごとにまとめたもの）を UI に表示し、ローカルに保存する。"""
+        rows = []
+        for data in batch:
             try:
-                # storage.add_message is sync
-                self.storage.add_message(sender, text, timestamp=ts, attachment=attachment)
+                sender = data.get("sender", "相手")
+                text = data.get("text", "")
+                ts = data.get("timestamp")
+                attachment = data.get("attachment")
+                # 永続化（書き込みキューに積むだけ）
+                msg_id = None
+                try:
+                    msg_id = self.storage.add_message(sender, text, timestamp=ts, attachment=attachment, server_id=data.get("id"))
+                except Exception:
+                    pass
+                rows.append({"id": msg_id, "sender": sender, "text": text, "timestamp": ts, "attachment": attachment})
+                # 送ってきた相手はもう入力中ではない
+                self._typing_peers.pop(sender, None)
             except Exception:
                 pass
-
-            is_sender = sender == "あなた"
-            widget = MessageBubble(sender, text=text, attachment=attachment, align_right=is_sender)
-            item = QListWidgetItem()
-            item.setSizeHint(widget.sizeHint())
-            self.chat_view.addItem(item)
-            self.chat_view.setItemWidget(item, widget)
-            self.chat_view.scrollToBottom()
-        except Exception:
-            pass
+        self._append(rows)
+        self._update_typing_label()
 
     def _on_ws_connected(self):
+        # 接続前に表示した履歴のうち、手元にない添付を取りに行く
+        for ref in self.model.missing_attachments():
+            self.ws_client.download(ref)
+        # 在席状態は保存されないので、接続するたびに知らせ直す
+        self._send_presence()
+        self._presence_refresh.start()
         try:
             if self.server_url:
                 self.status_label.setText(f"Connected: {self.server_url}")
@@ -218,8 +491,15 @@ class ChatWindow(QWidget):
 
     def _on_ws_disconnected(self):
         try:
-            self.status_label.setText("Disconnected")
+            # WSClient が間隔を空けて自動で再接続する
+            self.status_label.setText("Disconnected (reconnecting...)")
             self.status_label.setStyleSheet("color: red; padding:4px;")
+            # 切断中は相手の状態が分からない
+            self._presence_refresh.stop()
+            self._presence.clear()
+            self._typing_peers.clear()
+            self._update_presence_label()
+            self._update_typing_label()
         except Exception:
             pass
 
@@ -0,0 +1,71 @@
+"""クライアント側のワイヤーフォーマット（server/codec.py と同じ仕様）。
+
+接続時に WebSocket サブプロトコルで形式をネゴシエートする。
+- pychat.msgpack.v1: 短いキー名の MessagePack（バイナリフレーム、msgpack が必要）
+- 何も合意しなかった場合は従来どおり JSON テキスト
+"""
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, List
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+# server/codec.py の FIELD_CODES と一致させること
+FIELD_CODES: Dict[str, str] = {
+    "type": "y",
+    "id": "i",
+    "sender": "s",
+    "text": "t",
+    "timestamp": "ts",
+    "attachment": "a",
+    "room": "r",
+    "messages": "m",
+    "last_id": "li",
+    "hits": "h",
+    "snippet": "sn",
+    "rank": "rk",
+    "query": "q",
+    "offset": "o",
+    "next_offset": "no",
+    "limit": "l",
+    "error": "e",
+    "request": "rq",
+    "client_msg_id": "c",
+}
+FIELD_NAMES: Dict[str, str] = {v: k for k, v in FIELD_CODES.items()}
+
+MSGPACK = "pychat.msgpack.v1"
+JSON = "pychat.json.v1"
+
+
+def _rename(obj: Any, table: Dict[str, str]) -> Any:
+    if isinstance(obj, dict):
+        return {table.get(k, k): _rename(v, table) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_rename(v, table) for v in obj]
+    return obj
+
+
+def subprotocols() -> List[str]:
+    """サーバに提示するサブプロトコル（優先順）。"""
+    return [MSGPACK, JSON] if msgpack is not None else [JSON]
+
+
+def encode(obj: Dict, subprotocol: str | None):
+    """送信用にエンコードする。MessagePack なら bytes、それ以外は str。"""
+    if subprotocol == MSGPACK and msgpack is not None:
+        return msgpack.packb(_rename(obj, FIELD_CODES), use_bin_type=True)
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def decode(raw) -> Any:
+    """受信フレームをフレーム種別（バイナリ / テキスト）に応じてデコードする。"""
+    if isinstance(raw, (bytes, bytearray)):
+        if msgpack is None:
+            raise ValueError("msgpack is not installed")
+        return _rename(msgpack.unpackb(bytes(raw), raw=False), FIELD_NAMES)
+    return json.loads(raw)
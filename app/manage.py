@@ -0,0 +1,83 @@
+"""Maintenance commands for the desktop client's local database.
+
+Usage (from the repository root):
+  python -m app.manage rebuild-fts [--db chat_history.db]
+  python -m app.manage export FILE [--db chat_history.db]
+  python -m app.manage import FILE [--db chat_history.db]
+
+FILE is JSON lines (one message per line; "-" for stdin/stdout, *.gz for
+gzip). Import accepts this command's output and the server's
+``python -m server.manage export`` output, and skips messages that are
+already stored. Close the app first.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from .storage import Storage
+
+DEFAULT_DB = Path(__file__).resolve().parents[1] / "chat_history.db"
+
+
+def rebuild_fts(db_path: str) -> None:
+    storage = Storage(db_path)
+    try:
+        if not storage.fts:
+            raise SystemExit("FTS5 is not available in this SQLite build")
+        t0 = time.perf_counter()
+        storage.rebuild_fts()
+        print(f"Rebuilt search index of {db_path} in {time.perf_counter() - t0:.2f}s")
+    finally:
+        storage.close()
+
+
+def export(db_path: str, dest: str) -> None:
+    storage = Storage(db_path, defer_warm_up=True)
+    try:
+        s = storage.export_jsonl(dest)
+        print(
+            f"Exported {s['rows']} messages ({s['bytes'] / 1e6:.1f} MB) from {db_path} "
+            f"in {s['seconds']:.2f}s ({s['rows_per_s']:.0f} rows/s)",
+            file=sys.stderr,
+        )
+    finally:
+        storage.close()
+
+
+def import_(db_path: str, source: str) -> None:
+    storage = Storage(db_path)
+    try:
+        s = storage.import_jsonl(source)
+        print(
+            f"Imported {s['inserted']} of {s['read']} messages into {db_path} "
+            f"({s['skipped']} already stored, {s['invalid']} invalid) "
+            f"in {s['seconds']:.2f}s ({s['rows_per_s']:.0f} rows/s)",
+            file=sys.stderr,
+        )
+    finally:
+        storage.close()
+
+
+def main(argv: list[str] | None = None):
+    p = argparse.ArgumentParser(description="PyChat local database maintenance")
+    sub = p.add_subparsers(dest="command", required=True)
+    sp = sub.add_parser("rebuild-fts", help="rebuild the full-text search index")
+    sp.add_argument("--db", default=str(DEFAULT_DB))
+    sp = sub.add_parser("export", help="write all messages as JSON lines")
+    sp.add_argument("file", help='output file ("-" = stdout, *.gz = gzip)')
+    sp.add_argument("--db", default=str(DEFAULT_DB))
+    sp = sub.add_parser("import", help="insert messages from JSON lines, skipping ones already stored")
+    sp.add_argument("file", help='input file ("-" = stdin, *.gz = gzip)')
+    sp.add_argument("--db", default=str(DEFAULT_DB))
+    args = p.parse_args(argv)
+    if args.command == "rebuild-fts":
+        rebuild_fts(args.db)
+    elif args.command == "export":
+        export(args.db, args.file)
+    elif args.command == "import":
+        import_(args.db, args.file)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,245 @@
 from __future__ import annotations
 
+from concurrent.futures import Future
 from pathlib import Path
+import gzip
+import itertools
+import json
+import logging
+import queue
 import sqlite3
-from typing import List, Dict, Optional
-from datetime import datetime
+import sys
+import threading
+import time
+from typing import Any, Callable, List, Dict, Optional, TextIO
+from datetime import datetime, timezone
+
+# messages.text の全文検索インデックス（トリガーで同期）。trigram トークナイザは
+# 部分一致になるので分かち書きのない日本語でも使える。3 文字未満の検索は LIKE で代用。
+FTS_SCHEMA = (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, content='messages', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+)
+FTS_MIN_QUERY = 3
+SNIPPET_TOKENS = 16
+# timestamp は UTC の Unix エポックからのミリ秒（INTEGER）
+MESSAGES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender TEXT NOT NULL,
+        text TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        attachment TEXT,
+        server_id INTEGER
+    )
+"""
+# チャット画面が一度に読み込む件数
+PAGE_SIZE = 100
+# 書き込みキューのコミット間隔（秒）と、間隔を待たずにコミットする件数
+COMMIT_INTERVAL = 0.05
+COMMIT_BATCH = 200
+# エクスポートで 1 回に読む件数と、インポートで 1 トランザクションに入れる件数
+EXPORT_BATCH = 5000
+IMPORT_BATCH = 20000
+# インポートの INSERT 1 文あたりの行数（6 列 × 100 で SQLite の変数上限 999 未満）
+ROWS_PER_INSERT = 100
+
+
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def to_epoch_ms(value) -> Optional[int]:
+    """エポックミリ秒（int / float / 数字の文字列）・ISO 8601 文字列・datetime をエポックミリ秒にする。
+
+    タイムゾーンの無いものは UTC とみなす（以前の版が保存していた形式）。
+    それ以外は ValueError。
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = value.strip()
+        if value.lstrip("-").isdigit():
+            return int(value)
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"not a timestamp: {value!r}") from None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp() * 1000)
+    raise ValueError(f"not a timestamp: {value!r}")
+
+
+def open_jsonl(path, mode: str) -> TextIO:
+    """JSONL / NDJSON ファイルを開く（"-" は標準入出力、*.gz は gzip）。"""
+    if str(path) == "-":
+        return sys.stdin if "r" in mode else sys.stdout
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode + "t", compresslevel=6, encoding="utf-8")
+    return open(path, mode, encoding="utf-8", newline="\n")
+
+
+def _insert_ignore_sql(rows: int) -> str:
+    return (
+        "INSERT OR IGNORE INTO messages (id, sender, text, timestamp, attachment, server_id) VALUES "
+        + ", ".join(["(?, ?, ?, ?, ?, ?)"] * rows)
+    )
 
 
 class Storage:
     """シンプルな SQLite ベースのメッセージストレージ。
 
     API:
-      - add_message(sender, text, timestamp=None) -> int
+      - add_message(sender, text, timestamp=None, attachment=None, server_id=None) -> int
+      - set_server_id(msg_id, server_id)
+      - max_server_id() -> Optional[int]
+      - put_outbox(client_msg_id, msg_id, payload)
+      - outbox_items() -> List[Dict]
+      - ack_outbox(client_msg_id, server_id)
       - get_messages(limit=None) -> List[Dict]
+      - get_page(before_id=None, limit=PAGE_SIZE) -> List[Dict]
+      - get_messages_between(start, end, limit=None) -> List[Dict]
+      - search(query, limit=20, offset=0) -> List[Dict]
+      - rebuild_fts()
+      - export_jsonl(dest) -> Dict
+      - import_jsonl(source) -> Dict
+      - warm_up()
+      - flush()
       - close()
+
+    SQLite には専用スレッドだけが触れる（呼び出し元の GUI スレッドは触れない）。
+    add_message は id を先に割り当てて書き込みキューに積むだけで、すぐ戻る。
+    専用スレッドはキューの INSERT をまとめて実行し、COMMIT_INTERVAL 秒ごと
+    （または COMMIT_BATCH 件ごと）に 1 回だけコミットする（WAL モード）。
+    読み出しも同じスレッド・同じ接続で順番に実行するので、まだコミットされて
+    いない書き込みも結果に含まれる。
+
+    timestamp は UTC のエポックミリ秒（INTEGER）で保存し、インデックスを張るので
+    日付の範囲で読む（get_messages_between）ときも全件は走査しない。ISO 8601 の
+    TEXT で保存していた以前の DB は、開いたときに変換する。
+
+    outbox テーブルはサーバに送ったがまだ ack の来ていないメッセージ
+    （オフライン中に送ったものを含む）を保持する。アプリを再起動しても残り、
+    WSClient が再接続のたびにまとめて送り直す。
+
+    export_jsonl / import_jsonl は 1 行 1 メッセージの JSON（JSONL）で履歴を
+    書き出し・取り込む。決まった件数ずつ専用スレッドに渡すので、履歴が大きくても
+    メモリは増えず、その間の読み書きも待たされ続けない。
+
+    defer_warm_up=True なら、コンストラクタはテーブルの用意までで戻り、
+    検索インデックスの準備（初回は全件の取り込みになる）は warm_up() を
+    呼んだときに専用スレッドで行う。チャット画面は最初の描画の後に呼ぶ。
     """
 
-    def __init__(self, db_path: Path | str):
+    def __init__(
+        self,
+        db_path: Path | str,
+        commit_interval: float = COMMIT_INTERVAL,
+        commit_batch: int = COMMIT_BATCH,
+        defer_warm_up: bool = False,
+    ):
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.conn: Optional[sqlite3.Connection] = None
+        self.fts = False
+        self._next_id = 1
+        self._id_lock = threading.Lock()
+        # (関数, 引数, Future または None)。None は終了の合図
+        self._tasks: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._uncommitted = 0
+        self._thread = threading.Thread(target=self._run, name="storage", daemon=True)
+        self._thread.start()
+        self._call(self._open)
+        if not defer_warm_up:
+            self._call(self._ensure_fts)
+
+    # --- 専用スレッド ---
+
+    def _run(self) -> None:
+        # 未コミットの書き込みをコミットする時刻。最初の書き込みから数え、
+        # タスクが途切れず届いても先へは延ばさない
+        deadline: Optional[float] = None
+        while True:
+            if not self._uncommitted:
+                deadline = None
+            elif deadline is None:
+                deadline = time.monotonic() + self.commit_interval
+            try:
+                task = self._tasks.get(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                self._commit()
+                continue
+            if task is None:
+                self._commit()
+                if self.conn is not None:
+                    self.conn.close()
+                return
+            fn, args, future = task
+            try:
+                result = fn(*args)
+            except Exception as e:
+                if future is None:
+                    logging.exception("Storage write failed")
+                else:
+                    future.set_exception(e)
+                continue
+            if future is not None:
+                future.set_result(result)
+            if self._uncommitted >= self.commit_batch or (deadline is not None and time.monotonic() >= deadline):
+                self._commit()
+
+    def _commit(self) -> None:
+        if self._uncommitted and self.conn is not None:
+            self.conn.commit()
+        self._uncommitted = 0
+
+    def _call(self, fn: Callable, *args) -> Any:
+        """fn を専用スレッドで実行し、結果を待つ。"""
+        future: Future = Future()
+        self._tasks.put((fn, args, future))
+        return future.result()
+
+    def _open(self) -> None:
         self.conn = sqlite3.connect(str(self.db_path))
         self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL ならコミットごとの fsync を省いても壊れない
+        self.conn.execute("PRAGMA synchronous=NORMAL")
         self._ensure_table()
+        self._next_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0] + 1
 
     def _ensure_table(self) -> None:
         cur = self.conn.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender TEXT NOT NULL,
-                text TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                attachment TEXT
-            )
-            """
-        )
+        cur.execute(MESSAGES_SCHEMA.format(table="messages"))
         self.conn.commit()
         # Ensure attachment column exists for older DBs
         cur.execute("PRAGMA table_info(messages)")
-        cols = [r[1] for r in cur.fetchall()]
+        cols = {r[1]: r[2] for r in cur.fetchall()}
         if "attachment" not in cols:
             try:
                 cur.execute("ALTER TABLE messages ADD COLUMN attachment TEXT")
@@ -46,18 +247,175 @@ class Storage:
             except Exception:
                 # Some SQLite versions may not allow ALTER; ignore if it fails
                 pass
+        # サーバが振った id。再接続で同じメッセージが届いても二重に保存しない
+        if "server_id" not in cols:
+            cur.execute("ALTER TABLE messages ADD COLUMN server_id INTEGER")
+        if cols["timestamp"].upper() != "INTEGER":
+            self._migrate_timestamps()
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_server_id ON messages(server_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)")
+        # ack 待ちの送信メッセージ（seq 順に送り直す）
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                client_msg_id TEXT NOT NULL UNIQUE,
+                msg_id INTEGER,
+                payload TEXT NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
 
-    def add_message(self, sender: str, text: str, timestamp: Optional[str] = None, attachment: Optional[str] = None) -> int:
-        ts = timestamp or datetime.utcnow().isoformat()
+    def _migrate_timestamps(self) -> None:
+        """ISO 8601 の TEXT で保存した timestamp をエポックミリ秒の INTEGER に変換する。
+
+        SQLite は列の型を変えられないので、新しいテーブルに行を写して置き換える。
+        id は変わらないので検索インデックスはそのまま使える（トリガーだけ作り直す）。
+        """
+
+        def convert(value):
+            try:
+                return to_epoch_ms(value)
+            except ValueError:
+                return 0
+
+        t0 = time.perf_counter()
+        self.conn.create_function("pychat_epoch_ms", 1, convert, deterministic=True)
         cur = self.conn.cursor()
+        cur.execute("DROP TABLE IF EXISTS messages_migrating")
+        cur.execute(MESSAGES_SCHEMA.format(table="messages_migrating"))
         cur.execute(
-            "INSERT INTO messages (sender, text, timestamp, attachment) VALUES (?, ?, ?, ?)",
-            (sender, text, ts, attachment),
+            "INSERT INTO messages_migrating (id, sender, text, timestamp, attachment, server_id)"
+            " SELECT id, sender, text, pychat_epoch_ms(timestamp), attachment, server_id FROM messages"
         )
+        cur.execute("DROP TABLE messages")
+        cur.execute("ALTER TABLE messages_migrating RENAME TO messages")
+        # トリガーは古いテーブルと一緒に消えた。warm_up() を待たずに作り直す
+        if cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None:
+            for stmt in FTS_SCHEMA[1:]:
+                cur.execute(stmt)
         self.conn.commit()
-        return cur.lastrowid
+        logging.info("Migrated message timestamps to epoch milliseconds in %.2fs", time.perf_counter() - t0)
 
-    def get_messages(self, limit: Optional[int] = None) -> List[Dict]:
+    def _ensure_fts(self) -> None:
+        cur = self.conn.cursor()
+        existed = cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
+        self.fts = False
+        try:
+            for stmt in FTS_SCHEMA:
+                cur.execute(stmt)
+        except sqlite3.OperationalError:
+            # FTS5 のない SQLite では検索を無効にする
+            self.conn.rollback()
+            return
+        self.fts = True
+        if not existed:
+            # インデックス作成前のメッセージを取り込む
+            self._rebuild_fts()
+        self.conn.commit()
+
+    def _rebuild_fts(self) -> None:
+        self.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        self.conn.commit()
+
+    def _export_chunk(self, after_id: int, limit: int) -> List[Dict]:
+        rows = self.conn.execute(
+            "SELECT id, sender, text, timestamp, attachment, server_id FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    def _import_rows(self, rows: List[tuple]) -> int:
+        """rows を 1 トランザクションで INSERT OR IGNORE し、新しく入った件数を返す。"""
+        # キューに積まれた書き込みを先にコミットしておく
+        self._commit()
+        rows = self._assign_ids(rows)
+        # 検索インデックスのトリガーは文ごとの固定費が大きいので、1 文に複数行まとめる
+        full = len(rows) - len(rows) % ROWS_PER_INSERT
+        inserted = 0
+        for sql, params in (
+            (
+                _insert_ignore_sql(ROWS_PER_INSERT),
+                [tuple(itertools.chain.from_iterable(rows[i:i + ROWS_PER_INSERT])) for i in range(0, full, ROWS_PER_INSERT)],
+            ),
+            (_insert_ignore_sql(len(rows) - full), [tuple(itertools.chain.from_iterable(rows[full:]))]),
+        ):
+            if params and params[0]:
+                # rowcount にはトリガーが入れた行は含まれない
+                inserted += self.conn.executemany(sql, params).rowcount
+        self.conn.commit()
+        return inserted
+
+    def _assign_ids(self, rows: List[tuple]) -> List[tuple]:
+        """id の無い行に id を振る。保存済みの server_id の行は除く。"""
+        if all(r[0] is not None for r in rows):
+            return rows
+        new = [r[5] for r in rows if r[0] is None and r[5] is not None]
+        known = set()
+        for i in range(0, len(new), 900):
+            part = new[i:i + 900]
+            known.update(
+                r[0] for r in self.conn.execute(
+                    f"SELECT server_id FROM messages WHERE server_id IN ({', '.join('?' * len(part))})", part
+                )
+            )
+        out = []
+        for r in rows:
+            if r[0] is None:
+                if r[5] is not None:
+                    if r[5] in known:
+                        continue
+                    known.add(r[5])
+                with self._id_lock:
+                    msg_id = self._next_id
+                    self._next_id += 1
+                r = (msg_id,) + r[1:]
+            out.append(r)
+        return out
+
+    def _insert(self, msg_id: int, sender: str, text: str, ts: str, attachment: Optional[str], server_id: Optional[int]) -> int:
+        cur = self.conn.execute(
+            "INSERT OR IGNORE INTO messages (id, sender, text, timestamp, attachment, server_id) VALUES (?, ?, ?, ?, ?, ?)",
+            (msg_id, sender, text, ts, attachment, server_id),
+        )
+        if cur.rowcount == 0 and server_id is not None:
+            # 同じ server_id の行が既にある。新しい id は使わずにその行の id を返す
+            row = self.conn.execute("SELECT id FROM messages WHERE server_id = ?", (server_id,)).fetchone()
+            if row is not None:
+                return row[0]
+        self._uncommitted += 1
+        return msg_id
+
+    def _set_server_id(self, msg_id: int, server_id: int) -> None:
+        self.conn.execute("UPDATE OR IGNORE messages SET server_id = ? WHERE id = ?", (server_id, msg_id))
+        self._uncommitted += 1
+
+    def _max_server_id(self) -> Optional[int]:
+        return self.conn.execute("SELECT MAX(server_id) FROM messages").fetchone()[0]
+
+    def _put_outbox(self, client_msg_id: str, msg_id: Optional[int], payload: str) -> None:
+        self.conn.execute(
+            "INSERT OR IGNORE INTO outbox (client_msg_id, msg_id, payload) VALUES (?, ?, ?)",
+            (client_msg_id, msg_id, payload),
+        )
+        self._uncommitted += 1
+
+    def _outbox_items(self) -> List[Dict]:
+        rows = self.conn.execute("SELECT client_msg_id, msg_id, payload FROM outbox ORDER BY seq").fetchall()
+        return [{"client_msg_id": r[0], "msg_id": r[1], "payload": json.loads(r[2])} for r in rows]
+
+    def _ack_outbox(self, client_msg_id: str, server_id: Optional[int]) -> None:
+        if server_id is not None:
+            self.conn.execute(
+                "UPDATE OR IGNORE messages SET server_id = ?"
+                " WHERE id = (SELECT msg_id FROM outbox WHERE client_msg_id = ?)",
+                (server_id, client_msg_id),
+            )
+        self.conn.execute("DELETE FROM outbox WHERE client_msg_id = ?", (client_msg_id,))
+        self._uncommitted += 1
+
+    def _get_messages(self, limit: Optional[int]) -> List[Dict]:
         cur = self.conn.cursor()
         q = "SELECT id, sender, text, timestamp, attachment FROM messages ORDER BY id ASC"
         if limit is not None:
@@ -68,8 +426,218 @@ class Storage:
         rows = cur.fetchall()
         return [dict(r) for r in rows]
 
-    def close(self) -> None:
+    def _get_page(self, before_id: Optional[int], limit: int) -> List[Dict]:
+        cur = self.conn.cursor()
+        q = "SELECT id, sender, text, timestamp, attachment FROM messages"
+        params: list = []
+        if before_id is not None:
+            q += " WHERE id < ?"
+            params.append(before_id)
+        q += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        cur.execute(q, params)
+        return [dict(r) for r in reversed(cur.fetchall())]
+
+    def _get_messages_between(self, start: Optional[int], end: Optional[int], limit: Optional[int]) -> List[Dict]:
+        q = "SELECT id, sender, text, timestamp, attachment FROM messages"
+        where = []
+        params: list = []
+        if start is not None:
+            where.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("timestamp < ?")
+            params.append(end)
+        if where:
+            q += " WHERE " + " AND ".join(where)
+        q += " ORDER BY timestamp, id"
+        if limit is not None:
+            q += " LIMIT ?"
+            params.append(limit)
+        return [dict(r) for r in self.conn.execute(q, params).fetchall()]
+
+    def _search(self, query: str, limit: int, offset: int) -> List[Dict]:
+        query = query.strip()
+        if not query or not self.fts:
+            return []
+        cur = self.conn.cursor()
+        if len(query) >= FTS_MIN_QUERY:
+            cur.execute(
+                "SELECT m.id, m.sender, m.text, m.timestamp, m.attachment,"
+                f" snippet(messages_fts, 0, '[', ']', '…', {SNIPPET_TOKENS}) AS snippet,"
+                " bm25(messages_fts) AS rank"
+                " FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+                " WHERE messages_fts MATCH ? ORDER BY rank, m.id DESC LIMIT ? OFFSET ?",
+                ('"' + query.replace('"', '""') + '"', limit, offset),
+            )
+        else:
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            cur.execute(
+                "SELECT id, sender, text, timestamp, attachment, text AS snippet, 0.0 AS rank"
+                " FROM messages WHERE text LIKE ? ESCAPE '\\' ORDER BY id DESC LIMIT ? OFFSET ?",
+                (pattern, limit, offset),
+            )
+        return [dict(r) for r in cur.fetchall()]
+
+    # --- 公開 API（どのスレッドから呼んでもよい） ---
+
+    def add_message(
+        self,
+        sender: str,
+        text: str,
+        timestamp: int | str | None = None,
+        attachment: Optional[str] = None,
+        server_id: Optional[int] = None,
+    ) -> int:
+        """メッセージを保存し、その行の id を返す。
+
+        timestamp はエポックミリ秒か ISO 8601 文字列（省略時は現在時刻）。
+        server_id が既に保存済みなら何も書かず、保存済みの行の id を返す。
+        """
+        ts = to_epoch_ms(timestamp) if timestamp is not None else now_ms()
+        with self._id_lock:
+            msg_id = self._next_id
+            self._next_id += 1
+        args = (msg_id, sender, text, ts, attachment, server_id)
+        if server_id is not None:
+            # 重複していれば既存の id を返すので、書き込みの結果を待つ
+            return self._call(self._insert, *args)
+        # 書き込みは待たない（コミットは専用スレッドがまとめて行う）
+        self._tasks.put((self._insert, args, None))
+        return msg_id
+
+    def set_server_id(self, msg_id: int, server_id: int) -> None:
+        """自分が送ったメッセージにサーバの ack で届いた id を記録する。"""
+        self._tasks.put((self._set_server_id, (msg_id, server_id), None))
+
+    def max_server_id(self) -> Optional[int]:
+        """保存済みのサーバ id の最大値（再接続時に ?since= で渡す）。"""
+        return self._call(self._max_server_id)
+
+    def put_outbox(self, client_msg_id: str, msg_id: Optional[int], payload: Dict) -> None:
+        """送信するメッセージを ack が来るまで outbox に残す（msg_id はローカルの id）。"""
+        self._tasks.put((self._put_outbox, (client_msg_id, msg_id, json.dumps(payload, ensure_ascii=False)), None))
+
+    def outbox_items(self) -> List[Dict]:
+        """ack 待ちのメッセージを送った順で返す（client_msg_id, msg_id, payload）。"""
+        return self._call(self._outbox_items)
+
+    def ack_outbox(self, client_msg_id: str, server_id: Optional[int]) -> None:
+        """ack の来たメッセージを outbox から消し、サーバの id を記録する。"""
+        self._tasks.put((self._ack_outbox, (client_msg_id, server_id), None))
+
+    def get_messages(self, limit: Optional[int] = None) -> List[Dict]:
+        return self._call(self._get_messages, limit)
+
+    def get_page(self, before_id: Optional[int] = None, limit: int = PAGE_SIZE) -> List[Dict]:
+        """before_id より前（省略時は最新）の limit 件を古い順で返す。"""
+        return self._call(self._get_page, before_id, limit)
+
+    def get_messages_between(self, start, end, limit: Optional[int] = None) -> List[Dict]:
+        """start <= timestamp < end のメッセージを古い順で返す。
+
+        start / end はエポックミリ秒・ISO 8601 文字列・datetime（None ならその側は無制限）。
+        """
+        return self._call(self._get_messages_between, to_epoch_ms(start), to_epoch_ms(end), limit)
+
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        """query を含むメッセージを関連度順に返す（snippet と rank 付き）。"""
+        return self._call(self._search, query, limit, offset)
+
+    def rebuild_fts(self) -> None:
+        """全メッセージの検索インデックスを作り直す。"""
+        self._call(self._rebuild_fts)
+
+    def export_jsonl(self, dest) -> Dict:
+        """全メッセージを id 順に JSONL で書き出す（dest はパス・"-"・テキストファイル）。
+
+        戻り値は {"rows", "bytes", "seconds", "rows_per_s"}。
+        """
+        self.flush()
+        t0 = time.perf_counter()
+        rows = size = last_id = 0
+        f = open_jsonl(dest, "w") if isinstance(dest, (str, Path)) else dest
+        try:
+            while True:
+                chunk = self._call(self._export_chunk, last_id, EXPORT_BATCH)
+                if not chunk:
+                    break
+                lines = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in chunk)
+                f.write(lines)
+                size += len(lines)
+                rows += len(chunk)
+                last_id = chunk[-1]["id"]
+        finally:
+            if f is not dest and f is not sys.stdout:
+                f.close()
+        seconds = time.perf_counter() - t0
+        return {"rows": rows, "bytes": size, "seconds": seconds, "rows_per_s": rows / seconds if seconds else 0.0}
+
+    def import_jsonl(self, source) -> Dict:
+        """JSONL のメッセージを取り込む（source はパス・"-"・テキストファイル）。
+
+        export_jsonl の出力は id を保ったまま入れる。server_id の無い行
+        （サーバの export の出力）は、その id を server_id として新しい id で入れる。
+        既にある id・server_id の行は飛ばすので、同じファイルを何度入れてもよい。
+        戻り値は {"read", "inserted", "skipped", "invalid", "seconds", "rows_per_s"}。
+        """
+        t0 = time.perf_counter()
+        stats = {"read": 0, "inserted": 0, "skipped": 0, "invalid": 0}
+        batch: List[tuple] = []
+        f = open_jsonl(source, "r") if isinstance(source, (str, Path)) else source
         try:
-            self.conn.close()
-        except Exception:
-            pass
+            for line in f:
+                if not line.strip():
+                    continue
+                stats["read"] += 1
+                try:
+                    batch.append(self._import_row(json.loads(line)))
+                except (ValueError, TypeError, AttributeError):
+                    stats["invalid"] += 1
+                    continue
+                if len(batch) >= IMPORT_BATCH:
+                    stats["inserted"] += self._call(self._import_rows, batch)
+                    batch = []
+            if batch:
+                stats["inserted"] += self._call(self._import_rows, batch)
+        finally:
+            if f is not source and f is not sys.stdin:
+                f.close()
+        stats["skipped"] = stats["read"] - stats["invalid"] - stats["inserted"]
+        seconds = time.perf_counter() - t0
+        stats.update(seconds=seconds, rows_per_s=stats["read"] / seconds if seconds else 0.0)
+        return stats
+
+    def _import_row(self, obj: Dict) -> tuple:
+        if "server_id" in obj:
+            msg_id, server_id = obj.get("id"), obj["server_id"]
+        else:
+            msg_id, server_id = None, obj.get("id")
+        if msg_id is not None:
+            msg_id = int(msg_id)
+            with self._id_lock:
+                # 以後の add_message が取り込んだ id を使わないようにする
+                self._next_id = max(self._next_id, msg_id + 1)
+        ts = to_epoch_ms(obj.get("timestamp"))
+        return (
+            msg_id,
+            str(obj.get("sender") or "unknown"),
+            str(obj.get("text") or ""),
+            ts if ts is not None else now_ms(),
+            obj.get("attachment"),
+            int(server_id) if server_id is not None else None,
+        )
+
+    def warm_up(self) -> None:
+        """検索インデックスを用意する（待たない）。用意ができるまで search() は空を返す。"""
+        self._tasks.put((self._ensure_fts, (), None))
+
+    def flush(self) -> None:
+        """キューに積まれた書き込みをすべてコミットするまで待つ。"""
+        self._call(self._commit)
+
+    def close(self) -> None:
+        if not self._thread.is_alive():
+            return
+        self._tasks.put(None)
+        self._thread.join()
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+from PySide6.QtCore import QObject, QRunnable, QSize, QThreadPool, Qt, Signal, Slot
+from PySide6.QtGui import QImage, QImageReader, QPixmap
+
+THUMBNAIL_WIDTH = 240
+MEMORY_LIMIT = 32 * 1024 * 1024  # 縮小済み画像のメモリ上限（バイト）
+DISK_LIMIT = 128 * 1024 * 1024  # サムネイルのディスク上限（バイト）
+# 上限の 1/DISK_SLACK を新しく書くたびにディスクを整理する（超過はその分まで）
+DISK_SLACK = 8
+DECODE_THREADS = 2
+# 読めなかったファイルを覚えておく数と、無い・読めないファイルを stat し直す間隔（秒）
+FAILED_LIMIT = 1024
+RECHECK_INTERVAL = 5.0
+
+# (パス, mtime_ns, サイズ)。ファイルが変わればキーも変わる
+_Key = Tuple[str, int, int]
+
+
+def _file_key(path: str) -> Optional[_Key]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+def _disk_name(key: _Key) -> str:
+    return hashlib.sha1(f"{key[0]}|{key[1]}|{key[2]}|{THUMBNAIL_WIDTH}".encode("utf-8")).hexdigest() + ".png"
+
+
+class _DecodeSignals(QObject):
+    # (パス, 縮小済み画像, ディスクに新しく書いたバイト数)。null 画像なら読み込み失敗
+    decoded = Signal(str, QImage, int)
+
+
+class _DecodeTask(QRunnable):
+    """ワーカースレッドで画像を読み、THUMBNAIL_WIDTH に縮小してディスクキャッシュへ書く。
+
+    QPixmap は GUI スレッド専用なので、ここでは QImage だけを扱う。
+    """
+
+    def __init__(self, path: str, disk_path: Path, signals: _DecodeSignals):
+        super().__init__()
+        self.path = path
+        self.disk_path = disk_path
+        self.signals = signals
+
+    def run(self) -> None:
+        image = QImage()
+        written = 0
+        if self.disk_path.exists():
+            image = QImage(str(self.disk_path))
+        if image.isNull():
+            reader = QImageReader(self.path)
+            reader.setAutoTransform(True)
+            size = reader.size()
+            if size.isValid() and size.width() > THUMBNAIL_WIDTH:
+                # JPEG などは縮小しながらデコードできるので全画素を展開しない
+                reader.setScaledSize(QSize(THUMBNAIL_WIDTH, max(1, size.height() * THUMBNAIL_WIDTH // size.width())))
+            image = reader.read()
+            if not image.isNull() and image.width() > THUMBNAIL_WIDTH:
+                image = image.scaledToWidth(THUMBNAIL_WIDTH, Qt.SmoothTransformation)
+            if not image.isNull():
+                tmp = self.disk_path.with_suffix(".tmp")
+                if image.save(str(tmp), "PNG"):
+                    os.replace(tmp, self.disk_path)
+                    try:
+                        written = self.disk_path.stat().st_size
+                    except OSError:
+                        pass
+        self.signals.decoded.emit(self.path, image, written)
+
+
+class ThumbnailCache(QObject):
+    """添付画像のサムネイルを非同期に作ってキャッシュする。
+
+    - get(path) はメモリにあれば QPixmap を返し、無ければバックグラウンドの
+      デコードを依頼して None を返す（呼び出し側はプレースホルダを描く）
+    - デコードが終わると ready(path) を emit する
+    - メモリは MEMORY_LIMIT バイトの LRU。ディスク（cache_dir）は起動時と、
+      DISK_LIMIT の 1/DISK_SLACK を書き足すたびに DISK_LIMIT バイトまで、
+      最近使われていないものから削除する（この整理もワーカースレッドで行い、
+      起動や描画を待たせない）
+    - キーはパス・mtime・サイズなので、同じ画像は起動をまたいで一度しかデコードしない
+    - 無いファイル・読めなかったファイルは RECHECK_INTERVAL 秒ごとに stat し直し、
+      現れたり書き換わったり（アップロードの完了など）したらデコードし直す。
+      読めなかったキーは FAILED_LIMIT 件までの LRU で覚える
+    """
+
+    ready = Signal(str)
+
+    def __init__(self, cache_dir: Path | str, parent=None, memory_limit: int = MEMORY_LIMIT, disk_limit: int = DISK_LIMIT):
+        super().__init__(parent)
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._memory: "OrderedDict[_Key, QPixmap]" = OrderedDict()
+        self._memory_bytes = 0
+        # paint のたびに stat しないよう、パスごとのキーを覚えておく
+        # (キー, stat し直す時刻)。時刻が None なら変わらない前提でずっと使う
+        self._stat: Dict[str, Tuple[Optional[_Key], Optional[float]]] = {}
+        self._keys: Dict[str, _Key] = {}
+        self._pending: Set[str] = set()
+        self._failed: "OrderedDict[_Key, None]" = OrderedDict()
+        # 前回の整理のあとにディスクへ書いたバイト数
+        self._disk_written = 0
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(DECODE_THREADS)
+        self._signals = _DecodeSignals()
+        self._signals.decoded.connect(self._on_decoded)
+        self._pool.start(self._trim_disk)
+
+    def _key(self, path: str) -> Optional[_Key]:
+        entry = self._stat.get(path)
+        if entry is None or (entry[1] is not None and time.monotonic() >= entry[1]):
+            key = _file_key(path)
+            self._stat[path] = entry = (key, self._recheck_at(key))
+        return entry[0]
+
+    def _recheck_at(self, key: Optional[_Key]) -> Optional[float]:
+        if key is None or key in self._failed:
+            return time.monotonic() + RECHECK_INTERVAL
+        return None
+
+    def get(self, path: str) -> Optional[QPixmap]:
+        key = self._key(path)
+        if key is None or key in self._failed:
+            return None
+        pix = self._memory.get(key)
+        if pix is not None:
+            self._memory.move_to_end(key)
+            return pix
+        if path not in self._pending:
+            self._pending.add(path)
+            self._keys[path] = key
+            self._pool.start(_DecodeTask(path, self.cache_dir / _disk_name(key), self._signals))
+        return None
+
+    def failed(self, path: str) -> bool:
+        """画像として読めなかったファイルなら True。"""
+        key = self._key(path)
+        return key is not None and key in self._failed
+
+    @Slot(str, QImage, int)
+    def _on_decoded(self, path: str, image: QImage, written: int) -> None:
+        self._pending.discard(path)
+        key = self._keys.pop(path, None)
+        if key is None:
+            return
+        if image.isNull():
+            self._failed[key] = None
+            if len(self._failed) > FAILED_LIMIT:
+                self._failed.popitem(last=False)
+            if self._stat.get(path, (None,))[0] == key:
+                self._stat[path] = (key, self._recheck_at(key))
+        else:
+            pix = QPixmap.fromImage(image)
+            self._memory[key] = pix
+            self._memory_bytes += pix.width() * pix.height() * 4
+            while self._memory_bytes > self.memory_limit and len(self._memory) > 1:
+                old_key, old = self._memory.popitem(last=False)
+                self._memory_bytes -= old.width() * old.height() * 4
+                # 追い出したパスは次に使うとき stat し直す（_stat も大きくならない）
+                if self._stat.get(old_key[0], (None,))[0] == old_key:
+                    del self._stat[old_key[0]]
+            # ディスク上のエントリも「最近使った」ことにする
+            try:
+                os.utime(self.cache_dir / _disk_name(key))
+            except OSError:
+                pass
+        self._disk_written += written
+        if self._disk_written > self.disk_limit // DISK_SLACK:
+            self._disk_written = 0
+            self._pool.start(self._trim_disk)
+        self.ready.emit(path)
+
+    def _trim_disk(self) -> None:
+        """ディスクキャッシュを DISK_LIMIT 以下にする（古く使われたものから削除）。"""
+        entries = []
+        for p in self.cache_dir.glob("*.png"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries):
+            if total <= self.disk_limit:
+                break
+            try:
+                p.unlink()
+                total -= size
+            except OSError:
+                pass
+
+    def shutdown(self) -> None:
+        self._pool.clear()
+        self._pool.waitForDone(1000)
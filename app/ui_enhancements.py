@@ -1,69 +1,136 @@
-from PySide6.QtWidgets import QWidget, QLabel, QHBoxLayout, QVBoxLayout, QSizePolicy, QSpacerItem
-from PySide6.QtGui import QPixmap
-from PySide6.QtCore import Qt
-from pathlib import Path
+from PySide6.QtWidgets import QStyledItemDelegate, QStyleOptionViewItem
+from PySide6.QtGui import QColor, QPainter, QPixmap
+from PySide6.QtCore import QModelIndex, QRect, QSize, Qt
 
+from .chat_model import MessageListModel
+from .thumbnails import THUMBNAIL_WIDTH, ThumbnailCache
 
-class MessageBubble(QWidget):
-    """メッセージをバブル表示するウィジェット。
+# バブルの見た目
+BUBBLE_COLOR_ME = QColor("#87CEFA")
+BUBBLE_COLOR_OTHER = QColor("#E8E8E8")
+PENDING_TEXT = "添付ファイルを取得中…"
+UNSENT_TEXT = "送信待ち"
+LOADING_TEXT = "読み込み中…"
+PLACEHOLDER_COLOR = QColor("#D0D0D0")
+PLACEHOLDER_SIZE = QSize(THUMBNAIL_WIDTH, THUMBNAIL_WIDTH * 3 // 4)
+ROW_MARGIN = 6  # 行の上下・左右の余白
+PAD_H = 10
+PAD_V = 6
+RADIUS = 10
+GAP = 4  # テキスト・画像・案内の間隔
+MAX_BUBBLE_FRACTION = 0.7  # ビュー幅に対するバブルの最大幅
 
-    - sender: 表示用に吹き出しの色を変える
-    - text: テキスト（省略可）
-    - attachment: 画像パス（省略可）
-    - align_right: 送信者側なら右寄せにする
+
+class BubbleDelegate(QStyledItemDelegate):
+    """MessageListModel の 1 行をバブルとして描画するデリゲート。
+
+    行ごとにウィジェットを作らず paint() で直接描くので、行数が増えても
+    ウィジェットの生成コストやメモリは増えない。
+
+    - 自分のメッセージは右寄せ・青、相手は左寄せ・灰色
+    - テキストはビュー幅の MAX_BUBBLE_FRACTION までで折り返す
+    - 画像添付は ThumbnailCache の縮小画像を表示し、デコードが終わるまでは
+      プレースホルダを描く（GUI スレッドでは画像をデコードしない）
+    - ダウンロード中の添付は案内文を表示
+    - サーバの ack がまだ来ていない自分のメッセージには「送信待ち」を表示
     """
 
-    def __init__(self, sender: str, text: str = "", attachment: str | None = None, align_right: bool = False, parent=None):
+    def __init__(self, thumbnails: ThumbnailCache, parent=None):
         super().__init__(parent)
-        self.sender = sender
-        self.text = text
-        self.attachment = attachment
-        self.align_right = align_right
+        self.thumbnails = thumbnails
+        # (テキスト, 画像の大きさ, 取得中, 送信待ち, 幅) -> QSize
+        self._sizes: dict = {}
 
-        self._init_ui()
+    def _view_width(self, option: QStyleOptionViewItem) -> int:
+        view = self.parent()
+        if view is not None and hasattr(view, "viewport"):
+            return view.viewport().width()
+        return option.rect.width()
 
-    def _init_ui(self):
-        main = QHBoxLayout(self)
-        if self.align_right:
-            main.addItem(QSpacerItem(20, 10, QSizePolicy.Expanding, QSizePolicy.Minimum))
+    def _image(self, index: QModelIndex) -> QPixmap | QSize | None:
+        """表示する縮小画像。デコード待ちならプレースホルダの大きさ、画像が無ければ None。"""
+        path = index.data(MessageListModel.AttachmentPathRole)
+        if not path:
+            return None
+        pix = self.thumbnails.get(path)
+        if pix is not None:
+            return pix
+        return None if self.thumbnails.failed(path) else PLACEHOLDER_SIZE
 
-        bubble = QWidget()
-        bubble_layout = QVBoxLayout(bubble)
-        bubble_layout.setContentsMargins(10, 6, 10, 6)
+    def _layout(self, option: QStyleOptionViewItem, index: QModelIndex):
+        """バブル内の各要素の大きさ (text_rect, image, pending_rect, unsent_rect, bubble_size) を求める。"""
+        text = index.data(Qt.DisplayRole) or ""
+        pending = bool(index.data(MessageListModel.AttachmentPendingRole))
+        unsent = bool(index.data(MessageListModel.UnsentRole))
+        image = self._image(index)
+        fm = option.fontMetrics
+        max_w = max(50, int(self._view_width(option) * MAX_BUBBLE_FRACTION) - 2 * PAD_H)
 
-        # テキストラベル
-        if self.text:
-            label = QLabel(self.text)
-            label.setWordWrap(True)
-            label.setTextInteractionFlags(Qt.TextSelectableByMouse)
-            bubble_layout.addWidget(label)
+        text_rect = fm.boundingRect(QRect(0, 0, max_w, 1_000_000), Qt.TextWordWrap, text) if text else QRect()
+        pending_rect = fm.boundingRect(PENDING_TEXT) if pending else QRect()
+        unsent_rect = fm.boundingRect(UNSENT_TEXT) if unsent else QRect()
+        parts = [r.size() for r in (text_rect, pending_rect) if not r.isNull()]
+        if image is not None:
+            parts.append(image.size() if isinstance(image, QPixmap) else image)
+        if not unsent_rect.isNull():
+            parts.append(unsent_rect.size())
+        width = max((s.width() for s in parts), default=0)
+        height = sum(s.height() for s in parts) + GAP * max(0, len(parts) - 1)
+        return text_rect, image, pending_rect, unsent_rect, QSize(width + 2 * PAD_H, max(height, fm.height()) + 2 * PAD_V)
 
-        # 画像添付があれば表示
-        if self.attachment:
-            p = Path(self.attachment)
-            if p.exists():
-                pix = QPixmap(str(p))
-                if not pix.isNull():
-                    img_label = QLabel()
-                    # 適度にリサイズ（最大幅 240 px）
-                    max_w = 240
-                    w = pix.width()
-                    h = pix.height()
-                    if w > max_w:
-                        pix = pix.scaledToWidth(max_w, Qt.SmoothTransformation)
-                    img_label.setPixmap(pix)
-                    img_label.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    bubble_layout.addWidget(img_label)
+    def sizeHint(self, option: QStyleOptionViewItem, index: QModelIndex) -> QSize:
+        image = self._image(index)
+        key = (
+            index.data(Qt.DisplayRole),
+            image.size() if isinstance(image, QPixmap) else image,
+            bool(index.data(MessageListModel.AttachmentPendingRole)),
+            bool(index.data(MessageListModel.UnsentRole)),
+            self._view_width(option),
+        )
+        size = self._sizes.get(key)
+        if size is None:
+            bubble = self._layout(option, index)[4]
+            size = QSize(bubble.width() + 2 * ROW_MARGIN, bubble.height() + 2 * ROW_MARGIN)
+            if len(self._sizes) > 10000:
+                self._sizes.clear()
+            self._sizes[key] = size
+        return size
 
-        # スタイル
-        bubble.setObjectName("bubble")
-        if self.align_right:
-            bubble.setStyleSheet("#bubble { background: #87CEFA; border-radius:10px; }")
-        else:
-            bubble.setStyleSheet("#bubble { background: #E8E8E8; border-radius:10px; }")
+    def paint(self, painter: QPainter, option: QStyleOptionViewItem, index: QModelIndex) -> None:
+        text_rect, image, pending_rect, unsent_rect, bubble = self._layout(option, index)
+        align_right = bool(index.data(MessageListModel.AlignRightRole))
+        row = option.rect
+        x = row.right() - ROW_MARGIN - bubble.width() if align_right else row.left() + ROW_MARGIN
+        rect = QRect(x, row.top() + ROW_MARGIN, bubble.width(), bubble.height())
 
-        main.addWidget(bubble)
-        if not self.align_right:
-            main.addItem(QSpacerItem(20, 10, QSizePolicy.Expanding, QSizePolicy.Minimum))
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(BUBBLE_COLOR_ME if align_right else BUBBLE_COLOR_OTHER)
+        painter.drawRoundedRect(rect, RADIUS, RADIUS)
 
-        self.setLayout(main)
+        y = rect.top() + PAD_V
+        left = rect.left() + PAD_H
+        painter.setPen(option.palette.color(option.palette.ColorRole.Text))
+        if not text_rect.isNull():
+            painter.drawText(QRect(left, y, text_rect.width(), text_rect.height()), Qt.TextWordWrap, index.data(Qt.DisplayRole))
+            y += text_rect.height() + GAP
+        if not pending_rect.isNull():
+            painter.setPen(QColor("gray"))
+            painter.drawText(QRect(left, y, pending_rect.width(), pending_rect.height()), 0, PENDING_TEXT)
+            y += pending_rect.height() + GAP
+        if isinstance(image, QPixmap):
+            painter.drawPixmap(left, y, image)
+        elif image is not None:
+            placeholder = QRect(left, y, image.width(), image.height())
+            painter.setPen(Qt.NoPen)
+            painter.setBrush(PLACEHOLDER_COLOR)
+            painter.drawRect(placeholder)
+            painter.setPen(QColor("gray"))
+            painter.drawText(placeholder, Qt.AlignCenter, LOADING_TEXT)
+        if image is not None:
+            y += image.height() + GAP
+        if not unsent_rect.isNull():
+            painter.setPen(QColor("gray"))
+            painter.drawText(QRect(left, y, unsent_rect.width(), unsent_rect.height()), 0, UNSENT_TEXT)
+        painter.restore()
@@ -1,64 +1,456 @@
 from __future__ import annotations
 
+import random
 import threading
-import json
-from typing import Optional
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set
+from urllib.parse import parse_qs, urlsplit
 
-from PySide6.QtCore import QObject, Signal
+from PySide6.QtCore import QObject, QTimer, Signal, Slot
 
 import websocket
 
+from . import codec
+from .attachments import CHUNK_SIZE, AttachmentCache, is_chunk_frame, pack_chunk, sha_of_ref, unpack_chunk
+
+
+# 重複判定のために覚えておくメッセージ id の数
+SEEN_IDS = 10000
+# 受信メッセージを UI へ渡す最短間隔（ミリ秒、約 60fps）
+FRAME_INTERVAL_MS = 16
+# 再接続の待ち時間（秒）。失敗するたびに上限を倍にし、0〜上限の一様乱数だけ待つ
+RECONNECT_BASE = 1.0
+RECONNECT_MAX = 60.0
+# 再接続時に outbox を送り直すときの 1 フレームあたりの件数
+OUTBOX_BATCH = 200
+# 保存されない一時的なメッセージ（入力中・在席）の type
+EPHEMERAL_TYPES = ("typing", "presence")
+# 差分同期で 1 回に要求する履歴の件数（サーバの上限 HISTORY_MAX_LIMIT と同じ）
+HISTORY_PAGE = 5000
+# URI に rooms が無いときにサーバが入れるルーム
+DEFAULT_ROOM = "general"
+# stop() がネットワークスレッドの終了を待つ最長時間（秒）
+STOP_TIMEOUT = 2.0
+
 
 class WSClient(QObject):
     """Simple WebSocket client using `websocket-client` running in background thread.
 
     Signals:
-      - message_received(dict)
+      - messages_received(list)  受信メッセージをまとめたもの（古い順）
+      - message_acked(dict)  自分が送ったメッセージの ack（id, timestamp, client_msg_id）
       - connected()
       - disconnected()
+      - attachment_ready(str)  ダウンロードが完了した添付の sha256
+      - range_received(dict)  request_range() の結果（messages, more など）
+      - ephemeral_received(dict)  他のクライアントの入力中 / 在席の状態
+
+    入力中・在席には起動ごとに作る peer（このクライアントの id）を付ける。
+    名前（sender）は同じでもクライアントごとに区別でき、自分の分も見分けられる。
+
+    受信したメッセージの id の最大値を last_id に覚えておき、start() に
+    since を渡すとサーバはそれより新しいメッセージだけを送る（差分同期）。
+    最近受け取った SEEN_IDS 件の id と同じメッセージは emit しない。
+    サーバは since の履歴を HISTORY_PAGE 件ずつ送り、続きがあれば history_end に
+    more を付けるので、続きを history リクエストで取り終えるまで追いかける。
+    追いつく前に切れたら、live で受け取った id ではなく取り終えた履歴の位置から
+    再開する（途中の履歴を取りこぼさない）。
+
+    受信メッセージはネットワークスレッドでバッファに溜め、FRAME_INTERVAL_MS に
+    高々 1 回だけ messages_received でまとめて UI スレッドへ渡す。履歴の再送の
+    ような大量受信でも UI の追加・スクロールはフレームごとに 1 回で済む。
+    まとめた件数は batches / coalesced / max_batch / last_batch に数える。
+
+    添付ファイルはチャンク単位のバイナリフレームでアップロード / ダウンロードする
+    （upload() / download()、形式は attachments.py を参照）。
+
+    接続が切れると、stop() されるまで自動で再接続する。待ち時間は
+    「full jitter」の指数バックオフ（0〜RECONNECT_BASE * 2^失敗回数 秒、
+    上限 RECONNECT_MAX）なので、サーバ停止後に全クライアントが同時に
+    再接続しに来ることはない。再接続の URI には last_id を since に渡す。
+
+    チャットメッセージは post() で送る。outbox（Storage）を渡した場合は
+    送る前に outbox に保存し、ack が来たものだけを outbox から消す。接続中で
+    なければ保存だけして戻り、(再)接続したときに未 ack のメッセージを
+    OUTBOX_BATCH 件ずつの batch フレームにまとめ、ack を待たずに続けて送る。
+    サーバは client_msg_id で重複を捨てるので、ack を受け取る前に切れた
+    メッセージを送り直しても二重にはならない。
+
+    入力中（send_typing()）と在席（send_presence()）は保存も ack もされない
+    一時的なメッセージで、outbox を通らず、切断中なら捨てる。サーバは送信者
+    ごとに短い間隔でまとめ、混雑したクライアントには送らないことがあるので、
+    受け取る側は状態を一定時間で期限切れにする。
     """
 
-    message_received = Signal(dict)
+    messages_received = Signal(list)
+    message_acked = Signal(dict)
     connected = Signal()
     disconnected = Signal()
+    attachment_ready = Signal(str)
+    range_received = Signal(dict)
+    ephemeral_received = Signal(dict)
+    # ネットワークスレッド -> UI スレッドへの「バッファに溜まった」通知
+    _inbox_ready = Signal()
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, attachments: Optional[AttachmentCache] = None, outbox=None):
         super().__init__(parent)
+        self.attachments = attachments
+        # put_outbox / outbox_items / ack_outbox を持つもの（通常は Storage）
+        self.outbox = outbox
+        # 入力中・在席でこのクライアントを表す id
+        self.peer = uuid.uuid4().hex
+        # sha -> アップロード完了後に送るメッセージ
+        self._uploads: Dict[str, List[dict]] = {}
+        self._downloads: Set[str] = set()
+        # sha -> 送信スレッドの世代（再同期で古いスレッドを止める）
+        self._upload_gen: Dict[str, int] = {}
         self.ws: Optional[websocket.WebSocketApp] = None
         self._thread: Optional[threading.Thread] = None
+        self._uri = ""
+        self._stopping = threading.Event()
+        # post() と再接続時の送り直しの順序を守る。_flushed は送り直しが済んだか
+        self._outbox_lock = threading.Lock()
+        self._flushed = False
+        self.reconnects = 0
+        # 接続時にネゴシエートされたワイヤーフォーマット
+        self.subprotocol: Optional[str] = None
+        # 受け取ったメッセージ id の最大値と、重複を弾くための最近の id
+        self.last_id: Optional[int] = None
+        self._seen_ids: Set[int] = set()
+        self._seen_order: Deque[int] = deque()
+        # ルーム -> 取り終えた履歴の最後の id（since の履歴を追いかけている間だけ）
+        self._catchup: Dict[str, int] = {}
+        # 受信バッファ（ネットワークスレッドが追加し、UI スレッドがまとめて取り出す）
+        self._inbox: List[dict] = []
+        self._inbox_lock = threading.Lock()
+        self._flush_scheduled = False
+        self._last_flush = 0.0
+        self._inbox_ready.connect(self._schedule_flush)
+        # まとめて渡した回数・件数
+        self.batches = 0
+        self.coalesced = 0
+        self.max_batch = 0
+        self.last_batch = 0
+
+    def _deliver(self, msgs: List[dict]) -> None:
+        """（ネットワークスレッド）受信メッセージをバッファに積み、UI へ渡す予約をする。"""
+        if not msgs:
+            return
+        with self._inbox_lock:
+            self._inbox.extend(msgs)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._inbox_ready.emit()
+
+    @Slot()
+    def _schedule_flush(self) -> None:
+        # 前回から FRAME_INTERVAL_MS 経っていなければその分だけ待つ
+        wait_ms = FRAME_INTERVAL_MS - (time.monotonic() - self._last_flush) * 1000.0
+        QTimer.singleShot(max(0, int(wait_ms)), self._flush_inbox)
 
-    def start(self, uri: str):
-        if self.ws is not None:
+    def _flush_inbox(self) -> None:
+        with self._inbox_lock:
+            batch, self._inbox = self._inbox, []
+            self._flush_scheduled = False
+        self._last_flush = time.monotonic()
+        if not batch:
             return
+        self.batches += 1
+        self.coalesced += len(batch)
+        self.last_batch = len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        self.messages_received.emit(batch)
 
-        def _on_message(ws, message):
+    def stats(self) -> Dict[str, int]:
+        return {"batches": self.batches, "coalesced": self.coalesced, "max_batch": self.max_batch, "last_batch": self.last_batch}
+
+    def _seen(self, msg: dict) -> bool:
+        """既に受け取った id なら True。新しければ記録して last_id を進める。
+
+        履歴の再送と新着は混ざって届くことがあるので、大小ではなく id の集合で判定する。
+        """
+        msg_id = msg.get("id")
+        if not isinstance(msg_id, int):
+            return False
+        if msg_id in self._seen_ids:
+            return True
+        self._seen_ids.add(msg_id)
+        self._seen_order.append(msg_id)
+        if len(self._seen_order) > SEEN_IDS:
+            self._seen_ids.discard(self._seen_order.popleft())
+        self.last_id = max(self.last_id or 0, msg_id)
+        return False
+
+    def start(self, uri: str, since: Optional[int] = None):
+        if self._thread is not None:
+            return
+        if since is not None:
+            self.last_id = max(self.last_id or 0, since)
+        self._uri = uri
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="ws", daemon=True)
+        self._thread.start()
+
+    def _connect_uri(self) -> str:
+        """（ネットワークスレッド）次の接続の URI。since の履歴を追いかける状態も作り直す。"""
+        uri = self._uri
+        since = min(self._catchup.values()) if self._catchup else self.last_id
+        self._catchup = {}
+        if since is not None:
+            uri += ("&" if "?" in uri else "?") + f"since={since}&limit={HISTORY_PAGE}"
+            rooms = [r for r in ",".join(parse_qs(urlsplit(self._uri).query).get("rooms", [])).split(",") if r]
+            self._catchup = {room: since for room in rooms or [DEFAULT_ROOM]}
+        return uri
+
+    @staticmethod
+    def backoff(failures: int) -> float:
+        """failures 回続けて失敗した後の待ち時間（秒）。"""
+        return random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * 2 ** min(failures, 16)))
+
+    def _run(self) -> None:
+        """（ネットワークスレッド）stop() されるまで接続し直す。"""
+        failures = 0
+        while not self._stopping.is_set():
+            opened = threading.Event()
+
+            def _on_open(ws, opened=opened):
+                opened.set()
+                self._on_open(ws)
+
+            self.ws = websocket.WebSocketApp(
+                self._connect_uri(),
+                on_message=self._on_message,
+                on_open=_on_open,
+                on_close=self._on_close,
+                subprotocols=codec.subprotocols(),
+            )
             try:
-                data = json.loads(message)
+                self.ws.run_forever()
             except Exception:
-                data = {"text": message}
-            self.message_received.emit(data)
+                pass
+            if self._stopping.is_set():
+                break
+            # つながっていたなら切れた直後なので、失敗回数は数え直す
+            failures = 0 if opened.is_set() else failures + 1
+            self.reconnects += 1
+            self._stopping.wait(self.backoff(failures))
+
+    def _on_message(self, ws, message):
+        if is_chunk_frame(message):
+            sha, offset, chunk = unpack_chunk(message)
+            if self.attachments is not None and sha in self._downloads:
+                self.attachments.write_chunk(sha, offset, chunk)
+            return
+        try:
+            data = codec.decode(message)
+        except Exception:
+            data = {"text": message}
+        kind = data.get("type") if isinstance(data, dict) else None
+        if kind in ("history", "batch"):
+            # 履歴や混雑時にまとめられたメッセージは展開してバッファへ
+            self._deliver([m for m in data.get("messages", []) if not self._seen(m)])
+            return
+        if kind == "history_end":
+            self._on_history_end(data)
+            return
+        if kind == "range_results":
+            self.range_received.emit(data)
+            return
+        if kind in EPHEMERAL_TYPES:
+            self.ephemeral_received.emit(data)
+            return
+        if kind == "ack":
+            self._seen(data)
+            if self.outbox is not None and data.get("client_msg_id"):
+                self.outbox.ack_outbox(data["client_msg_id"], data.get("id"))
+            self.message_acked.emit(data)
+            return
+        if kind in ("upload_ready", "upload_done", "download_end") or (kind == "error" and data.get("sha256")):
+            self._on_transfer_reply(kind, data)
+            return
+        if isinstance(data, dict) and self._seen(data):
+            return
+        self._deliver([data])
 
-        def _on_open(ws):
-            self.connected.emit()
+    def _on_history_end(self, data: dict) -> None:
+        """（ネットワークスレッド）履歴の続きがあれば次のページを要求する。"""
+        room = data.get("room")
+        if room not in self._catchup:
+            return
+        if data.get("more") and data.get("last_id") is not None:
+            self._catchup[room] = data["last_id"]
+            self.send({"type": "history", "room": room, "since": data["last_id"], "limit": HISTORY_PAGE})
+        else:
+            del self._catchup[room]
 
-        def _on_close(ws, close_status_code, close_msg):
-            self.disconnected.emit()
+    def _on_open(self, ws):
+        try:
+            self.subprotocol = ws.sock.getsubprotocol()
+        except Exception:
+            self.subprotocol = None
+        self._resume()
+        self.connected.emit()
 
-        self.ws = websocket.WebSocketApp(uri, on_message=_on_message, on_open=_on_open, on_close=_on_close)
-        self._thread = threading.Thread(target=self.ws.run_forever, daemon=True)
-        self._thread.start()
+    def _on_close(self, ws, close_status_code, close_msg):
+        with self._outbox_lock:
+            self._flushed = False
+        self.disconnected.emit()
+
+    def _resume(self) -> None:
+        """（ネットワークスレッド）接続直後に、途中で切れた転送と未 ack のメッセージを送り直す。"""
+        # 進行中だったダウンロードは UI が接続時にもう一度要求する
+        self._downloads.clear()
+        # 古い送信スレッドを止める（サーバが示すオフセットから送り直す）
+        self._upload_gen.clear()
+        with self._outbox_lock:
+            if self.outbox is None:
+                # 送信待ちのメッセージはアップロード完了後に送る分だけ
+                for sha in list(self._uploads):
+                    self._request_upload(sha)
+            else:
+                self._uploads = {}
+                batch = []
+                for item in self.outbox.outbox_items():
+                    payload = item["payload"]
+                    if sha_of_ref(payload.get("attachment")):
+                        self.upload(payload["attachment"], then_send=payload)
+                        continue
+                    batch.append(payload)
+                    if len(batch) >= OUTBOX_BATCH:
+                        self.send({"type": "batch", "messages": batch})
+                        batch = []
+                if batch:
+                    self.send({"type": "batch", "messages": batch})
+            self._flushed = True
+
+    def post(self, payload: dict, msg_id: Optional[int] = None) -> str:
+        """チャットメッセージを送る。outbox があれば ack が来るまで保存しておく。
+
+        payload に client_msg_id が無ければ付けて、その値を返す。
+        """
+        client_msg_id = payload.setdefault("client_msg_id", uuid.uuid4().hex)
+        with self._outbox_lock:
+            if self.outbox is not None:
+                self.outbox.put_outbox(client_msg_id, msg_id, payload)
+                # 接続直後の送り直しが済むまでは、そちらに任せて順序を保つ
+                if not self._flushed:
+                    return client_msg_id
+            if sha_of_ref(payload.get("attachment")):
+                self.upload(payload["attachment"], then_send=payload)
+            else:
+                self.send(payload)
+        return client_msg_id
+
+    def request_range(self, start, end=None, limit: int = 100, room: Optional[str] = None):
+        """start <= timestamp < end（エポックミリ秒か ISO 8601）のメッセージを要求する（日付へのジャンプ用）。
+
+        結果は range_received で届く。
+        """
+        request = {"type": "range", "start": start, "end": end, "limit": limit}
+        if room is not None:
+            request["room"] = room
+        self.send(request)
+
+    def send_typing(self, sender: str, typing: bool = True, room: Optional[str] = None):
+        """入力中かどうかを同じルームのメンバーに知らせる（保存されない）。"""
+        self._send_ephemeral({"type": "typing", "sender": sender, "typing": typing}, room)
+
+    def send_presence(self, sender: str, status: str = "online", room: Optional[str] = None):
+        """在席状態（online / away / offline）を知らせる（保存されない）。"""
+        self._send_ephemeral({"type": "presence", "sender": sender, "status": status}, room)
+
+    def _send_ephemeral(self, data: dict, room: Optional[str]):
+        data["peer"] = self.peer
+        if room is not None:
+            data["room"] = room
+        # 切断中なら送らない（再接続したときに改めて知らせる）
+        self.send(data)
+
+    def upload(self, ref: str, then_send: Optional[dict] = None):
+        """キャッシュ済みの添付をサーバへ送り、完了後に then_send を送信する。"""
+        sha = sha_of_ref(ref)
+        if sha is None or self.attachments is None:
+            return
+        self._uploads.setdefault(sha, [])
+        if then_send is not None:
+            self._uploads[sha].append(then_send)
+        self._request_upload(sha)
+
+    def _request_upload(self, sha: str):
+        self.send({"type": "upload_start", "sha256": sha, "size": self.attachments.path(sha).stat().st_size})
+
+    def download(self, ref: str):
+        sha = sha_of_ref(ref)
+        if sha is None or self.attachments is None or sha in self._downloads:
+            return
+        if not (self.ws and self.ws.sock and self.ws.sock.connected):
+            return
+        self._downloads.add(sha)
+        self.send({"type": "download", "sha256": sha})
+
+    def _on_transfer_reply(self, kind: str, data: dict):
+        sha = data.get("sha256", "")
+        if kind == "upload_ready" and sha in self._uploads:
+            # 途中から再開できるよう、サーバが示したオフセットから送る
+            gen = self._upload_gen.get(sha, 0) + 1
+            self._upload_gen[sha] = gen
+            threading.Thread(target=self._send_chunks, args=(sha, int(data.get("offset", 0)), gen), daemon=True).start()
+        elif kind == "upload_done":
+            self._upload_gen.pop(sha, None)
+            for payload in self._uploads.pop(sha, []):
+                self.send(payload)
+        elif kind == "download_end":
+            self._downloads.discard(sha)
+            if self.attachments is not None and self.attachments.finish_download(sha):
+                self.attachment_ready.emit(sha)
+        elif kind == "error":
+            self._downloads.discard(sha)
+            self._uploads.pop(sha, None)
+            self._upload_gen.pop(sha, None)
+
+    def _send_chunks(self, sha: str, offset: int, gen: int):
+        try:
+            with open(self.attachments.path(sha), "rb") as f:
+                f.seek(offset)
+                for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    if self._upload_gen.get(sha) != gen:
+                        return
+                    if not (self.ws and self.ws.sock and self.ws.sock.connected):
+                        return
+                    self.ws.send(pack_chunk(sha, offset, block), opcode=websocket.ABNF.OPCODE_BINARY)
+                    offset += len(block)
+        except Exception:
+            pass
 
     def send(self, data: dict):
         if self.ws and self.ws.sock and self.ws.sock.connected:
             try:
-                self.ws.send(json.dumps(data, ensure_ascii=False))
+                payload = codec.encode(data, self.subprotocol)
+                if isinstance(payload, bytes):
+                    self.ws.send(payload, opcode=websocket.ABNF.OPCODE_BINARY)
+                else:
+                    self.ws.send(payload)
             except Exception:
                 pass
 
     def stop(self):
+        """接続を閉じてネットワークスレッドの終了を待ち、受信バッファに残ったメッセージを渡し切る。
+
+        UI スレッドから呼ぶ。戻った後は messages_received などのシグナルはもう出ないので、
+        呼び出し側はその後で保存先を閉じてよい。
+        """
+        self._stopping.set()
+        thread, self._thread = self._thread, None
         if self.ws:
             try:
                 self.ws.close()
             except Exception:
                 pass
-            self.ws = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(STOP_TIMEOUT)
+        self.ws = None
+        # 予約済みの QTimer を待たずに、ここで残りを渡す（後から来るタイマーは空振りする）
+        self._flush_inbox()
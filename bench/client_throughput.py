@@ -0,0 +1,152 @@
+"""Throughput of the asyncio client library (server/client.py) against a local server.
+
+Usage (from the repository root):
+  python -m bench.client_throughput [--connections 4] [--sessions 16] [--messages 2000]
+                                    [--payload 100] [--window 5000] [--format json|msgpack]
+                                    [--json-out results.json]
+
+The server runs in this process (server.server.handler on an ephemeral port)
+against a temporary database, with its ingress rate limits turned off
+unless --server-limits is given. --sessions pool sessions spread over
+--connections connections each send --messages messages as fast as the
+send window allows, and one separate Client reads the room with the async
+iterator. Each message carries its send time, so the reader measures
+send-to-receive latency. --window 1 waits for every ack before the next
+send, for comparison with pipelining.
+
+Like bench.fanout, the clients share the server's event loop and process,
+so the results are for comparing builds and settings.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import websockets
+
+from bench.fanout import percentiles
+from server import codec
+from server import server as srv
+from server.client import Client, ClientPool
+from server.storage import Storage
+
+
+async def run(args) -> dict:
+    tmp = tempfile.mkdtemp(prefix="pychat-bench-")
+    srv.STORAGE = Storage(os.path.join(tmp, "bench.db"), commit_window=args.commit_window_ms / 1000.0)
+    await srv.STORAGE.init()
+    if not args.server_limits:
+        srv._set_limits(0, 0, 0, 0, srv.MAX_FRAME_BYTES)
+    wire_format = "auto" if args.format == "msgpack" else "json"
+    expected = args.sessions * args.messages
+    text = "x" * args.payload
+    try:
+        async with websockets.serve(srv.handler, "127.0.0.1", 0, **srv._serve_options(not args.no_deflate)) as server:
+            port = server.sockets[0].getsockname()[1]
+            uri = f"ws://127.0.0.1:{port}/"
+            reader = Client(uri, sender="reader", wire_format=wire_format)
+            pool = ClientPool(uri, args.connections, wire_format=wire_format, max_inflight=args.window)
+            await reader.start()
+            await pool.start()
+            await reader.wait_connected(10)
+            await pool.wait_connected(10)
+            sessions = [await pool.session(f"bench{i}") for i in range(args.sessions)]
+
+            latencies = []
+            batch_sizes = []
+
+            async def consume() -> None:
+                async for batch in reader.batches():
+                    now = time.perf_counter()
+                    batch_sizes.append(len(batch))
+                    latencies.extend(now - m["bench_ts"] for m in batch if "bench_ts" in m)
+                    if len(latencies) >= expected:
+                        return
+
+            async def produce(session) -> None:
+                for _ in range(args.messages):
+                    await session.send(text, bench_ts=time.perf_counter())
+                    if args.window == 1:
+                        await session.flush()
+
+            consumer = asyncio.create_task(consume())
+            t0 = time.perf_counter()
+            await asyncio.gather(*(produce(s) for s in sessions))
+            queued = time.perf_counter() - t0
+            await pool.flush(args.drain)
+            acked = time.perf_counter() - t0
+            try:
+                await asyncio.wait_for(consumer, args.drain)
+            except asyncio.TimeoutError:
+                pass
+            received = time.perf_counter() - t0
+            pool_stats = pool.stats()
+            await pool.close()
+            await reader.close()
+    finally:
+        await srv.STORAGE.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    conns = pool_stats["connections"]
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "json_out"},
+        "send": {
+            "messages": expected,
+            "queued_s": queued,
+            "acked_s": acked,
+            "acked_per_s": expected / acked if acked else 0.0,
+            "frames": sum(c["frames_out"] for c in conns),
+            "messages_per_frame": expected / max(1, sum(c["frames_out"] for c in conns)),
+        },
+        "receive": {
+            "received": len(latencies),
+            "elapsed_s": received,
+            "per_s": len(latencies) / received if received else 0.0,
+            "batches": len(batch_sizes),
+            "messages_per_batch": len(latencies) / max(1, len(batch_sizes)),
+        },
+        "latency": percentiles(latencies),
+    }
+
+
+def _print(results: dict) -> None:
+    send = results["send"]
+    recv = results["receive"]
+    lat = results["latency"]
+    print(f"send         {send['messages']} messages acked in {send['acked_s']:.2f}s ({send['acked_per_s']:.0f}/s), "
+          f"{send['frames']} frames ({send['messages_per_frame']:.1f} messages/frame)")
+    print(f"receive      {recv['received']} messages in {recv['elapsed_s']:.2f}s ({recv['per_s']:.0f}/s), "
+          f"{recv['batches']} batches ({recv['messages_per_batch']:.1f} messages/batch)")
+    if lat["count"]:
+        print(f"latency      p50 {lat['p50_ms']:.2f} ms, p90 {lat['p90_ms']:.2f} ms, p99 {lat['p99_ms']:.2f} ms, max {lat['max_ms']:.2f} ms")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--connections", type=int, default=4, help="pool connections")
+    p.add_argument("--sessions", type=int, default=16, help="sending sessions spread over the connections")
+    p.add_argument("--messages", type=int, default=2000, help="messages per session")
+    p.add_argument("--payload", type=int, default=100, help="message text size in bytes")
+    p.add_argument("--window", type=int, default=5000, help="max unacknowledged messages per connection (1 = wait for each ack)")
+    p.add_argument("--commit-window-ms", type=float, default=50.0)
+    p.add_argument("--format", choices=("json", "msgpack"), default="json")
+    p.add_argument("--no-deflate", action="store_true")
+    p.add_argument("--server-limits", action="store_true", help="keep the server's default ingress rate limits")
+    p.add_argument("--drain", type=float, default=60.0, help="max seconds to wait for acks and deliveries")
+    p.add_argument("--json-out", default=None, help="also write the results as JSON to this file")
+    args = p.parse_args(argv)
+    if args.format == "msgpack" and codec.msgpack is None:
+        p.error("msgpack is not installed")
+
+    results = asyncio.run(run(args))
+    _print(results)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
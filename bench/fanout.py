@@ -0,0 +1,250 @@
+"""Load generator: many WebSocket clients against an in-process server.
+
+Usage (from the repository root):
+  python -m bench.fanout [--clients 200] [--senders 20] [--rate 5] [--duration 10]
+                         [--payload 100] [--history 1000] [--format json|msgpack]
+                         [--json-out results.json]
+
+The server runs in this process (server.server.handler on an ephemeral port)
+against a temporary database, pre-filled with --history messages. Every
+client connects, waits for its history replay, then --senders of them send
+--rate messages per second each for --duration seconds. Each message carries
+its send time, so every receiving client measures end-to-end fan-out latency.
+
+Clients and server share one event loop and one process, so the numbers are
+a relative measure for comparing builds, not a capacity figure; RSS likewise
+includes the simulated clients.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import websockets
+
+from server import codec
+from server import server as srv
+from server.history import HotHistory
+from server.storage import Storage
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pct(p: float) -> float:
+        return values[min(len(values) - 1, int(p / 100.0 * len(values)))] * 1000.0
+
+    return {
+        "count": len(values),
+        "mean_ms": statistics.fmean(values) * 1000.0,
+        "p50_ms": pct(50),
+        "p90_ms": pct(90),
+        "p99_ms": pct(99),
+        "max_ms": values[-1] * 1000.0,
+    }
+
+
+def rss_kb() -> dict:
+    """Current and peak resident set size of this process in KiB (None off Linux).
+
+    Both come from /proc/self/status (VmRSS and its high-water mark VmHWM),
+    so they are measured the same way and current <= peak always holds.
+    """
+    fields = {"VmRSS:": "current_kb", "VmHWM:": "peak_kb"}
+    out = dict.fromkeys(fields.values())
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                parts = line.split()
+                if parts and parts[0] in fields:
+                    out[fields[parts[0]]] = int(parts[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return out
+
+
+class BenchClient:
+    def __init__(self, index: int, url: str, subprotocols: list):
+        self.index = index
+        self.url = url
+        self.subprotocols = subprotocols
+        self.ws = None
+        self.connect_time = 0.0
+        self.replay_time = 0.0
+        self.history_received = 0
+        self.latencies: list = []
+        self.sent = 0
+        self._replayed = asyncio.Event()
+        self._reader = None
+
+    async def connect(self) -> None:
+        t0 = time.perf_counter()
+        self.ws = await websockets.connect(self.url, subprotocols=self.subprotocols or None, max_size=None)
+        t1 = time.perf_counter()
+        self.connect_time = t1 - t0
+        self._reader = asyncio.create_task(self._read_loop())
+        await self._replayed.wait()
+        self.replay_time = time.perf_counter() - t1
+
+    async def _read_loop(self) -> None:
+        try:
+            async for raw in self.ws:
+                now = time.perf_counter()
+                data = codec.decode_frame(raw)
+                kind = data.get("type")
+                if kind == "history":
+                    self.history_received += len(data.get("messages", []))
+                elif kind == "history_end":
+                    self._replayed.set()
+                elif kind == "batch":
+                    for m in data.get("messages", []):
+                        self._record(m, now)
+                else:
+                    self._record(data, now)
+        except websockets.ConnectionClosed:
+            pass
+
+    def _record(self, msg: dict, now: float) -> None:
+        sent_at = msg.get("bench_ts")
+        if sent_at is not None:
+            self.latencies.append(now - sent_at)
+
+    async def send_for(self, rate: float, duration: float, text: str) -> None:
+        interval = 1.0 / rate
+        wire = codec.for_subprotocol(self.ws.subprotocol)
+        start = time.perf_counter()
+        next_at = start
+        while next_at - start < duration:
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            msg = {"sender": f"bench{self.index}", "text": text, "bench_ts": time.perf_counter()}
+            await self.ws.send(wire.encode(msg))
+            self.sent += 1
+            next_at += interval
+
+    async def close(self) -> None:
+        await self.ws.close()
+        if self._reader is not None:
+            await self._reader
+
+
+async def run(args) -> dict:
+    tmp = tempfile.mkdtemp(prefix="pychat-bench-")
+    srv.STORAGE = Storage(os.path.join(tmp, "bench.db"), commit_window=args.commit_window_ms / 1000.0)
+    await srv.STORAGE.init()
+    for i in range(args.history):
+        await srv.STORAGE.add_message("seed", f"history {i}")
+    await srv.STORAGE.flush()
+    srv.HOT = HotHistory(args.history_cache) if args.history_cache > 0 else None
+    if srv.HOT is not None:
+        await srv.HOT.warm(srv.STORAGE)
+    rss_before = rss_kb()
+
+    subprotocols = [codec.MsgpackCodec.name] if args.format == "msgpack" else []
+    text = "x" * args.payload
+    try:
+        async with websockets.serve(srv.handler, "127.0.0.1", 0, **srv._serve_options(not args.no_deflate)) as server:
+            port = server.sockets[0].getsockname()[1]
+            url = f"ws://127.0.0.1:{port}/?limit={args.history_limit}"
+            clients = [BenchClient(i, url, subprotocols) for i in range(args.clients)]
+            gate = asyncio.Semaphore(args.connect_concurrency)
+
+            async def connect(c: BenchClient) -> None:
+                async with gate:
+                    await c.connect()
+
+            t0 = time.perf_counter()
+            await asyncio.gather(*(connect(c) for c in clients))
+            connect_all = time.perf_counter() - t0
+
+            senders = clients[: args.senders]
+            t0 = time.perf_counter()
+            await asyncio.gather(*(c.send_for(args.rate, args.duration, text) for c in senders))
+            send_elapsed = time.perf_counter() - t0
+            # let in-flight messages arrive
+            expected = sum(c.sent for c in senders) * (args.clients - 1)
+            deadline = time.perf_counter() + args.drain
+            while sum(len(c.latencies) for c in clients) < expected and time.perf_counter() < deadline:
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - t0
+            rss_after = rss_kb()
+            stats = srv.server_stats()
+            await asyncio.gather(*(c.close() for c in clients))
+    finally:
+        await srv.STORAGE.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    sent = sum(c.sent for c in clients)
+    delivered = sum(len(c.latencies) for c in clients)
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "json_out"},
+        "connect": {
+            "all_clients_s": connect_all,
+            "per_client": percentiles([c.connect_time for c in clients]),
+            "history_replay": percentiles([c.replay_time for c in clients]),
+            "history_messages_per_client": statistics.fmean(c.history_received for c in clients) if clients else 0,
+        },
+        "messages": {
+            "sent": sent,
+            "expected_deliveries": expected,
+            "delivered": delivered,
+            "sent_per_s": sent / send_elapsed if send_elapsed else 0.0,
+            "delivered_per_s": delivered / elapsed if elapsed else 0.0,
+            "dropped": sum(st["dropped"] for st in stats["clients"]),
+        },
+        "fanout_latency": percentiles([lat for c in clients for lat in c.latencies]),
+        "rss": {"before_kb": rss_before, "after_kb": rss_after},
+    }
+
+
+def _print(results: dict) -> None:
+    conn = results["connect"]
+    msgs = results["messages"]
+    lat = results["fanout_latency"]
+    print(f"connect      {conn['all_clients_s']:.2f}s for all clients, p50 {conn['per_client'].get('p50_ms', 0):.1f} ms, "
+          f"p99 {conn['per_client'].get('p99_ms', 0):.1f} ms")
+    print(f"history      p50 {conn['history_replay'].get('p50_ms', 0):.1f} ms, p99 {conn['history_replay'].get('p99_ms', 0):.1f} ms "
+          f"({conn['history_messages_per_client']:.0f} messages/client)")
+    print(f"throughput   sent {msgs['sent_per_s']:.0f}/s, delivered {msgs['delivered_per_s']:.0f}/s "
+          f"({msgs['delivered']}/{msgs['expected_deliveries']}, dropped {msgs['dropped']})")
+    if lat["count"]:
+        print(f"fan-out      p50 {lat['p50_ms']:.2f} ms, p90 {lat['p90_ms']:.2f} ms, p99 {lat['p99_ms']:.2f} ms, max {lat['max_ms']:.2f} ms")
+    rss = results["rss"]["after_kb"]
+    print(f"rss          {rss['current_kb']} KiB (peak {rss['peak_kb']} KiB)")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--clients", type=int, default=200, help="connected clients (all receive)")
+    p.add_argument("--senders", type=int, default=20, help="clients that also send")
+    p.add_argument("--rate", type=float, default=5.0, help="messages per second per sender")
+    p.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    p.add_argument("--payload", type=int, default=100, help="message text size in bytes")
+    p.add_argument("--history", type=int, default=1000, help="messages stored before clients connect")
+    p.add_argument("--history-limit", type=int, default=200, help="history replayed per client on connect")
+    p.add_argument("--history-cache", type=int, default=srv.HISTORY_CACHE_SIZE, help="server ring buffer size (0 = off)")
+    p.add_argument("--commit-window-ms", type=float, default=50.0)
+    p.add_argument("--format", choices=("json", "msgpack"), default="json")
+    p.add_argument("--no-deflate", action="store_true")
+    p.add_argument("--connect-concurrency", type=int, default=50, help="clients connecting at the same time")
+    p.add_argument("--drain", type=float, default=5.0, help="max seconds to wait for in-flight messages")
+    p.add_argument("--json-out", default=None, help="also write the results as JSON to this file")
+    args = p.parse_args(argv)
+    if args.format == "msgpack" and codec.msgpack is None:
+        p.error("msgpack is not installed")
+    args.senders = min(args.senders, args.clients)
+
+    results = asyncio.run(run(args))
+    _print(results)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
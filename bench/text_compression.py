@@ -0,0 +1,227 @@
+"""Space saved by compressed message text (server/compression.py) against its CPU cost.
+
+Usage (from the repository root):
+  python -m bench.text_compression [--messages 100000] [--source export.jsonl]
+                                   [--train 20000] [--reads 2000] [--json-out results.json]
+
+The same messages go into two temporary databases: one plain, and one
+compressed with a dictionary trained on the first --train messages. For
+each, the bench reports:
+- stored text bytes, the size of the messages table and the file size;
+- process CPU per message written after training, through the
+  write-behind path (``add_message`` + commit);
+- CPU per message read, for --reads latest-100 history pages, a full
+  ``iter_messages`` scan and a set of searches.
+
+Messages come from --source, JSON lines as written by
+``python -m server.manage export``, or are generated. Generated chat is
+more regular than real chat, so base decisions on a real export.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from server import compression
+from server.storage import Storage, open_jsonl
+
+ROOMS = ["general", "dev", "random"]
+WORDS = (
+    "the a to is it you i we that for on in this be have do not with are was lol ok yes no "
+    "deploy build server test merge review branch fix bug release today tomorrow meeting please "
+    "thanks sure later lunch coffee check logs error timeout latency database query index cache restart"
+).split()
+PHRASES = [
+    "了解です",
+    "ありがとうございます",
+    "お疲れ様です",
+    "確認します",
+    "よろしくお願いします",
+    "今日の会議は 10 時からです",
+    "サーバーが落ちたみたい",
+    "デプロイしました",
+    "ちょっと待ってください",
+    "あとで見ます",
+]
+
+
+def generate(n: int, seed: int = 1) -> list:
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        if rnd.random() < 0.3:
+            text = rnd.choice(PHRASES) + rnd.choice(["", "！", "。", "、" + rnd.choice(PHRASES)])
+        else:
+            text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 20))).capitalize()
+            text += rnd.choice(["", ".", "?", "!", " :)", f" #{rnd.randint(1, 5000)}"])
+        out.append({"sender": f"user{rnd.randint(1, 40)}", "text": text, "room": rnd.choice(ROOMS)})
+    return out
+
+
+def load(path: str, n: int) -> list:
+    out = []
+    with open_jsonl(path, "r") as f:
+        for line in f:
+            if line.strip():
+                m = json.loads(line)
+                out.append({"sender": m.get("sender") or "unknown", "text": m.get("text") or "", "room": m.get("room") or "general"})
+                if len(out) >= n:
+                    break
+    return out
+
+
+def _table_bytes(db_path: str, name: str):
+    try:
+        with sqlite3.connect(db_path) as conn:
+            return conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = ?", (name,)).fetchone()[0]
+    except sqlite3.OperationalError:
+        # SQLite built without the dbstat table
+        return None
+
+
+async def measure(tmp: str, msgs: list, args, compressed: bool) -> dict:
+    path = os.path.join(tmp, "compressed.db" if compressed else "plain.db")
+    storage = Storage(path, commit_window=0.05)
+    await storage.init()
+    try:
+        for m in msgs[: args.train]:
+            await storage.add_message(m["sender"], m["text"], room=m["room"])
+        await storage.flush()
+        if compressed:
+            await storage.compress_text(samples=args.train)
+
+        rest = msgs[args.train:]
+        c0 = time.process_time()
+        for m in rest:
+            await storage.add_message(m["sender"], m["text"], room=m["room"])
+        await storage.flush()
+        write_cpu = time.process_time() - c0
+
+        rnd = random.Random(2)
+        c0 = time.process_time()
+        read = 0
+        for _ in range(args.reads):
+            read += len(await storage.get_messages(limit=100, room=rnd.choice(ROOMS)))
+        history_cpu = time.process_time() - c0
+
+        c0 = time.process_time()
+        scanned = 0
+        async for _ in storage.iter_messages():
+            scanned += 1
+        scan_cpu = time.process_time() - c0
+
+        queries = [rnd.choice(msgs)["text"][:8] for _ in range(args.searches)]
+        c0 = time.process_time()
+        hits = 0
+        for q in queries:
+            hits += len(await storage.search(q, limit=20))
+        search_cpu = time.process_time() - c0
+
+        sizes = await storage.text_size()
+        await storage.vacuum()
+    finally:
+        await storage.close()
+    return {
+        "mode": "compressed" if compressed else "plain",
+        "messages": sizes["messages"],
+        "compressed_rows": sizes["compressed"],
+        "text_bytes": sizes["text_bytes"],
+        "table_bytes": _table_bytes(path, "messages"),
+        "file_bytes": os.path.getsize(path),
+        "write_us_per_msg": write_cpu / max(1, len(rest)) * 1e6,
+        "history_us_per_msg": history_cpu / max(1, read) * 1e6,
+        "scan_us_per_msg": scan_cpu / max(1, scanned) * 1e6,
+        "search_ms_per_query": search_cpu / max(1, len(queries)) * 1e3,
+        "search_hits": hits,
+    }
+
+
+def codec_cost(msgs: list, train: int) -> dict:
+    """Compress/decompress time per message for the codec alone."""
+    codec = compression.TextCodec({1: compression.train([m["text"] for m in msgs[:train]])})
+    texts = [m["text"] for m in msgs[train:]]
+    t0 = time.perf_counter()
+    stored = [codec.compress(t) for t in texts]
+    t_comp = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for s in stored:
+        codec.decompress(s)
+    t_dec = time.perf_counter() - t0
+    raw = sum(len(t.encode("utf-8")) for t in texts)
+    kept = sum(len(s) if isinstance(s, bytes) else len(s.encode("utf-8")) for s in stored)
+    n = max(1, len(texts))
+    return {
+        "raw_bytes_per_msg": raw / n,
+        "stored_bytes_per_msg": kept / n,
+        "ratio": raw / kept if kept else 0.0,
+        "compress_us_per_msg": t_comp / n * 1e6,
+        "decompress_us_per_msg": t_dec / n * 1e6,
+    }
+
+
+async def run(args) -> dict:
+    msgs = load(args.source, args.messages) if args.source else generate(args.messages)
+    if len(msgs) <= args.train:
+        raise SystemExit(f"need more than --train {args.train} messages, got {len(msgs)}")
+    tmp = tempfile.mkdtemp(prefix="pychat-bench-")
+    try:
+        plain = await measure(tmp, msgs, args, compressed=False)
+        packed = await measure(tmp, msgs, args, compressed=True)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "json_out"},
+        "codec": codec_cost(msgs, args.train),
+        "plain": plain,
+        "compressed": packed,
+    }
+
+
+def _saved(a, b) -> str:
+    if not a or b is None:
+        return "n/a"
+    return f"{(1 - b / a) * 100:.0f}%"
+
+
+def _print(results: dict) -> None:
+    c = results["codec"]
+    print(f"codec        {c['raw_bytes_per_msg']:.1f} -> {c['stored_bytes_per_msg']:.1f} bytes/message ({c['ratio']:.2f}x), "
+          f"compress {c['compress_us_per_msg']:.2f} us, decompress {c['decompress_us_per_msg']:.2f} us per message")
+    plain, packed = results["plain"], results["compressed"]
+    for r in (plain, packed):
+        table = f"{r['table_bytes'] / 1e6:.1f} MB" if r["table_bytes"] is not None else "n/a"
+        print(f"{r['mode']:<12} text {r['text_bytes'] / 1e6:.1f} MB, messages table {table}, file {r['file_bytes'] / 1e6:.1f} MB; "
+              f"CPU write {r['write_us_per_msg']:.1f} us/msg, history {r['history_us_per_msg']:.2f} us/msg, "
+              f"scan {r['scan_us_per_msg']:.2f} us/msg, search {r['search_ms_per_query']:.2f} ms/query")
+    print(f"saved        text {_saved(plain['text_bytes'], packed['text_bytes'])}, "
+          f"messages table {_saved(plain['table_bytes'], packed['table_bytes'])}, "
+          f"file {_saved(plain['file_bytes'], packed['file_bytes'])} "
+          f"({packed['compressed_rows']} of {packed['messages']} rows compressed)")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--messages", type=int, default=100000)
+    p.add_argument("--source", default=None, help="JSON lines to take the messages from (default: generated)")
+    p.add_argument("--train", type=int, default=20000, help="messages written before training the dictionary")
+    p.add_argument("--reads", type=int, default=2000, help="latest-100 history reads per mode")
+    p.add_argument("--searches", type=int, default=200, help="search queries per mode")
+    p.add_argument("--json-out", default=None, help="also write the results as JSON to this file")
+    args = p.parse_args(argv)
+    if compression.zstandard is None:
+        p.error("zstandard is not installed")
+
+    results = asyncio.run(run(args))
+    _print(results)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Compare the negotiated wire formats: bytes per message and encode/decode CPU.
+
+Usage (from the repository root):
+  python -m bench.wire_formats [--messages 20000] [--json-out results.json]
+
+Each format is measured raw and with per-message deflate as negotiated by
+permessage-deflate (one compressor per connection with context takeover,
+flushed after every message).
+"""
+import argparse
+import json
+import random
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from server import codec
+
+SENDERS = ["あなた", "alice", "bob", "サーバ管理者", "cli"]
+ROOMS = ["general", "dev", "random"]
+TEXTS = [
+    "おはようございます",
+    "今日の会議は 10 時からです",
+    "了解しました！",
+    "PR をレビューしました。いくつかコメントを残しています",
+    "hello",
+    "lunch?",
+    "The deploy finished without errors",
+    "画像を送ります",
+]
+
+
+def sample_messages(n: int, seed: int = 1) -> list:
+    rnd = random.Random(seed)
+    t0 = datetime(2026, 1, 1)
+    out = []
+    for i in range(n):
+        text = rnd.choice(TEXTS)
+        if rnd.random() < 0.3:
+            text += " " + rnd.choice(TEXTS)
+        out.append(
+            {
+                "id": 100000 + i,
+                "sender": rnd.choice(SENDERS),
+                "text": text,
+                "timestamp": int((t0 + timedelta(seconds=i * 7)).timestamp() * 1000),
+                "attachment": None,
+                "room": rnd.choice(ROOMS),
+            }
+        )
+    return out
+
+
+def _deflate_sizes(payloads: list) -> int:
+    comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+    total = 0
+    for p in payloads:
+        data = p.encode("utf-8") if isinstance(p, str) else p
+        # permessage-deflate strips the trailing 00 00 ff ff of each flush
+        total += len(comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return total
+
+
+def measure(wire, msgs: list) -> dict:
+    t0 = time.perf_counter()
+    payloads = [wire.encode(m) for m in msgs]
+    t_enc = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for p in payloads:
+        codec.decode_frame(p)
+    t_dec = time.perf_counter() - t0
+    raw = sum(len(p.encode("utf-8")) if isinstance(p, str) else len(p) for p in payloads)
+    n = len(msgs)
+    return {
+        "format": wire.name,
+        "bytes_per_msg": raw / n,
+        "deflate_bytes_per_msg": _deflate_sizes(payloads) / n,
+        "encode_us_per_msg": t_enc / n * 1e6,
+        "decode_us_per_msg": t_dec / n * 1e6,
+    }
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--messages", type=int, default=20000)
+    p.add_argument("--json-out", default=None, help="also write the results as JSON to this file")
+    args = p.parse_args(argv)
+
+    msgs = sample_messages(args.messages)
+    results = [measure(codec.CODECS[name], msgs) for name in reversed(codec.SUBPROTOCOLS)]
+    if codec.msgpack is None:
+        print("msgpack is not installed; only JSON was measured")
+    print(f"{'format':<20}{'bytes/msg':>11}{'+deflate':>11}{'enc us':>9}{'dec us':>9}")
+    for r in results:
+        print(
+            f"{r['format']:<20}{r['bytes_per_msg']:>11.1f}{r['deflate_bytes_per_msg']:>11.1f}"
+            f"{r['encode_us_per_msg']:>9.2f}{r['decode_us_per_msg']:>9.2f}"
+        )
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({"messages": args.messages, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Read-only archive of messages removed from the database by retention.
+
+Expired rows are written to compressed JSONL segment files, one or more per
+calendar month (UTC) of their timestamp::
+
+  <root>/messages-2026-01-0001.jsonl.zst
+  <root>/index.json
+
+Segments are never modified once written; every retention run that touches
+a month adds a new part. ``index.json`` lists each segment with its row
+count, id and timestamp range and rooms, so a query only opens the
+segments that can contain matches. Segments are compressed with zstd when
+the optional ``zstandard`` package is installed and with gzip otherwise;
+the file extension records which.
+
+Rows are written (and fsynced) before they are deleted from the database,
+so a crash in between can leave a row both archived and stored; the next
+run archives it again and queries drop the duplicate by id.
+"""
+from __future__ import annotations
+
+import asyncio
+import gzip
+import heapq
+import io
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+from .storage import Storage, now_ms, to_epoch_ms
+
+ZSTD_LEVEL = 10
+# rows moved per transaction (and at most per segment part)
+ARCHIVE_BATCH = 5000
+# free pages returned to the file system after each run (0 = all)
+VACUUM_PAGES = 0
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def _month(ts: int) -> str:
+    return datetime.fromtimestamp(ts / 1000, tz=timezone.utc).strftime("%Y-%m")
+
+
+class Archive:
+    def __init__(self, root: Path | str):
+        self.root = Path(root)
+        self.index_path = self.root / "index.json"
+
+    @property
+    def suffix(self) -> str:
+        return ".jsonl.zst" if zstandard is not None else ".jsonl.gz"
+
+    def segments(self) -> List[Dict]:
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                return json.load(f)["segments"]
+        except FileNotFoundError:
+            return []
+
+    def _save_index(self, segments: List[Dict]) -> None:
+        tmp = self.index_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"segments": segments}, f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.index_path)
+
+    def _compress(self, data: bytes) -> bytes:
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+        return gzip.compress(data, compresslevel=9)
+
+    def write(self, rows: List[Dict]) -> List[Dict]:
+        """Append `rows` as new segment parts (one per month). Returns the new index entries."""
+        if not rows:
+            return []
+        self.root.mkdir(parents=True, exist_ok=True)
+        segments = self.segments()
+        by_month: Dict[str, List[Dict]] = {}
+        for row in rows:
+            by_month.setdefault(_month(row["timestamp"]), []).append(row)
+        added = []
+        for month, month_rows in sorted(by_month.items()):
+            part = 1 + sum(1 for s in segments if s["month"] == month)
+            name = f"messages-{month}-{part:04d}{self.suffix}"
+            data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in month_rows).encode("utf-8")
+            tmp = self.root / (name + ".tmp")
+            with open(tmp, "wb") as f:
+                f.write(self._compress(data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.root / name)
+            entry = {
+                "file": name,
+                "month": month,
+                "count": len(month_rows),
+                "min_id": min(r["id"] for r in month_rows),
+                "max_id": max(r["id"] for r in month_rows),
+                "min_ts": min(r["timestamp"] for r in month_rows),
+                "max_ts": max(r["timestamp"] for r in month_rows),
+                "rooms": sorted({r["room"] for r in month_rows}),
+                "bytes": (self.root / name).stat().st_size,
+            }
+            segments.append(entry)
+            added.append(entry)
+        self._save_index(segments)
+        return added
+
+    def _read(self, name: str) -> Iterator[Dict]:
+        path = self.root / name
+        if name.endswith(".zst"):
+            if zstandard is None:
+                logging.warning("Skipping archive segment %s: zstandard is not installed", name)
+                return
+            with open(path, "rb") as raw, zstandard.ZstdDecompressor().stream_reader(raw) as stream:
+                for line in io.TextIOWrapper(stream, encoding="utf-8"):
+                    yield json.loads(line)
+        else:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def query(
+        self,
+        start=None,
+        end=None,
+        room: Optional[str] = None,
+        limit: int = 100,
+    ) -> List[Dict]:
+        """Archived messages with start <= timestamp < end, oldest first (slow path).
+
+        Decompresses every segment whose index entry overlaps the range and
+        room; memory stays bounded by `limit`.
+        """
+        start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+        names = [
+            s["file"]
+            for s in self.segments()
+            if (start_ms is None or s["max_ts"] >= start_ms)
+            and (end_ms is None or s["min_ts"] < end_ms)
+            and (room is None or room in s["rooms"])
+        ]
+
+        def matches() -> Iterable[Dict]:
+            for name in names:
+                for row in self._read(name):
+                    if (
+                        (room is None or row["room"] == room)
+                        and (start_ms is None or row["timestamp"] >= start_ms)
+                        and (end_ms is None or row["timestamp"] < end_ms)
+                    ):
+                        yield row
+
+        rows = heapq.nsmallest(limit, matches(), key=lambda r: (r["timestamp"], r["id"]))
+        # a row archived twice (see the module docstring) sorts next to its copy
+        return [r for i, r in enumerate(rows) if i == 0 or r["id"] != rows[i - 1]["id"]]
+
+    def stats(self) -> Dict:
+        segments = self.segments()
+        return {
+            "segments": len(segments),
+            "messages": sum(s["count"] for s in segments),
+            "bytes": sum(s.get("bytes", 0) for s in segments),
+        }
+
+
+async def archive_expired(
+    storage: Storage,
+    archive: Archive,
+    max_age_days: Optional[float] = None,
+    max_rows: Optional[int] = None,
+    on_archived: Optional[Callable[[List[int]], None]] = None,
+) -> int:
+    """Move rows older than `max_age_days` or beyond the newest `max_rows` into `archive`.
+
+    Works in batches of ARCHIVE_BATCH rows (write segment, then delete and
+    commit), then returns free pages with an incremental VACUUM. Returns
+    the number of rows moved.
+    """
+    if max_age_days is None and max_rows is None:
+        return 0
+    t0 = time.perf_counter()
+    before_ts = now_ms() - int(max_age_days * DAY_MS) if max_age_days is not None else None
+    before_id = await storage.retention_cutoff_id(max_rows) if max_rows is not None else None
+    loop = asyncio.get_running_loop()
+    moved = 0
+    while True:
+        rows = await storage.expired_rows(before_ts, before_id, ARCHIVE_BATCH)
+        if not rows:
+            break
+        # compression and fsync happen off the event loop
+        await loop.run_in_executor(None, archive.write, rows)
+        ids = [r["id"] for r in rows]
+        await storage.delete_messages(ids)
+        if on_archived is not None:
+            on_archived(ids)
+        moved += len(rows)
+    if moved:
+        await storage.incremental_vacuum(VACUUM_PAGES)
+        logging.info("Archived %d messages to %s in %.2fs", moved, archive.root, time.perf_counter() - t0)
+    return moved
+
+
+async def run_retention(
+    storage: Storage,
+    archive: Archive,
+    max_age_days: Optional[float],
+    max_rows: Optional[int],
+    interval: float,
+    on_archived: Optional[Callable[[List[int]], None]] = None,
+) -> None:
+    """Background task: apply the retention policy every `interval` seconds.
+
+    Call ``storage.enable_incremental_vacuum()`` once before starting it.
+    """
+    while True:
+        try:
+            await archive_expired(storage, archive, max_age_days, max_rows, on_archived)
+        except Exception:
+            logging.exception("Retention run failed")
+        await asyncio.sleep(interval)
@@ -0,0 +1,191 @@
+"""Content-addressed attachment store.
+
+Files are stored once under their SHA-256 (``<root>/ab/cd/abcd...``), so
+repeated uploads of the same image cost nothing. Uploads arrive as chunks
+appended to ``<root>/partial/<sha>.part``; an interrupted upload resumes
+from the size of that file. The declared size is kept next to it in
+``<sha>.size``, so a resumed upload may continue in another process (with
+--workers N it can reconnect to a different worker). The digest is verified
+in a worker thread (``finish``) before the blob is moved into place, so
+hashing a large file does not stall the event loop. Reads are done in
+ranges so a blob is never held in memory as a whole.
+
+Chunk frames on the wire (both directions) are binary WebSocket frames:
+
+  0x00 | 32-byte SHA-256 digest | 8-byte big-endian offset | data
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import re
+import struct
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+CHUNK_KIND = 0x00
+CHUNK_HEADER = struct.Struct(">B32sQ")
+CHUNK_SIZE = 64 * 1024
+ATTACHMENT_PREFIX = "sha256:"
+
+_HEX = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_digest(value: str) -> bool:
+    return bool(_HEX.match(value or ""))
+
+
+def pack_chunk(sha: str, offset: int, data: bytes) -> bytes:
+    return CHUNK_HEADER.pack(CHUNK_KIND, bytes.fromhex(sha), offset) + data
+
+
+def unpack_chunk(frame: bytes) -> Tuple[str, int, bytes]:
+    kind, digest, offset = CHUNK_HEADER.unpack_from(frame)
+    if kind != CHUNK_KIND:
+        raise ValueError("not a chunk frame")
+    return digest.hex(), offset, frame[CHUNK_HEADER.size:]
+
+
+def is_chunk_frame(raw) -> bool:
+    return isinstance(raw, (bytes, bytearray)) and len(raw) >= CHUNK_HEADER.size and raw[0] == CHUNK_KIND
+
+
+class UploadError(Exception):
+    pass
+
+
+class BlobStore:
+    def __init__(self, root: Path | str, max_size: int = 20 * 1024 * 1024):
+        self.root = Path(root)
+        self.max_size = max_size
+        self.partial_dir = self.root / "partial"
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+        # sha -> declared size of uploads in progress (also in <sha>.size)
+        self._expected: Dict[str, int] = {}
+        # sha -> verification running in a thread (see finish)
+        self._finishing: Dict[str, asyncio.Future] = {}
+
+    def path(self, sha: str) -> Path:
+        return self.root / sha[:2] / sha[2:4] / sha
+
+    def _partial(self, sha: str) -> Path:
+        return self.partial_dir / f"{sha}.part"
+
+    def _size_file(self, sha: str) -> Path:
+        return self.partial_dir / f"{sha}.size"
+
+    def _expected_size(self, sha: str) -> Optional[int]:
+        """Declared size of an upload in progress, also one started by another process."""
+        size = self._expected.get(sha)
+        if size is None:
+            try:
+                size = self._expected[sha] = int(self._size_file(sha).read_text())
+            except (OSError, ValueError):
+                return None
+        return size
+
+    def size(self, sha: str) -> Optional[int]:
+        """Size of a stored blob, None if it does not exist."""
+        try:
+            return self.path(sha).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def begin_upload(self, sha: str, size: int) -> int:
+        """Register an upload; returns the offset to continue from.
+
+        The offset equals `size` when the blob is already stored, or when
+        the partial file holds every byte but still has to be verified
+        (call ``finish``).
+        """
+        if not is_digest(sha):
+            raise UploadError("invalid sha256")
+        if size <= 0:
+            raise UploadError("invalid size")
+        if size > self.max_size:
+            raise UploadError("attachment too large")
+        if self.size(sha) is not None:
+            return size
+        if self._expected_size(sha) != size:
+            self._size_file(sha).write_text(str(size))
+        self._expected[sha] = size
+        part = self._partial(sha)
+        have = part.stat().st_size if part.exists() else 0
+        if have > size:
+            part.unlink()
+            have = 0
+        return have
+
+    def write_chunk(self, sha: str, offset: int, data: bytes) -> Tuple[int, bool]:
+        """Append a chunk at `offset`. Returns (received bytes, complete).
+
+        A chunk that does not continue the partial file is ignored; the
+        caller answers with the current offset so the sender can resync.
+        When complete, the caller awaits ``finish`` before reporting it.
+        """
+        expected = self._expected_size(sha)
+        if expected is None:
+            raise UploadError("upload not started")
+        part = self._partial(sha)
+        have = part.stat().st_size if part.exists() else 0
+        if offset != have or have + len(data) > expected:
+            return have, False
+        with open(part, "ab") as f:
+            f.write(data)
+        have += len(data)
+        return have, have >= expected
+
+    async def finish(self, sha: str) -> None:
+        """Verify a completely received upload and move it into place.
+
+        Runs in a thread; concurrent calls for the same blob share one run.
+        Raises UploadError if the data does not match the digest (the
+        partial file is deleted, so the upload starts over).
+        """
+        task = self._finishing.get(sha)
+        if task is None:
+            task = self._finishing[sha] = asyncio.ensure_future(asyncio.to_thread(self._finish, sha))
+            task.add_done_callback(lambda _: self._finishing.pop(sha, None))
+        await asyncio.shield(task)
+
+    def _finish(self, sha: str) -> None:
+        part = self._partial(sha)
+        digest = hashlib.sha256()
+        try:
+            with open(part, "rb") as f:
+                for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    digest.update(block)
+        except FileNotFoundError:
+            # another process finished it first
+            if self.size(sha) is not None:
+                return
+            raise UploadError("upload not started") from None
+        self._expected.pop(sha, None)
+        self._size_file(sha).unlink(missing_ok=True)
+        if digest.hexdigest() != sha:
+            part.unlink(missing_ok=True)
+            raise UploadError("sha256 mismatch")
+        dest = self.path(sha)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(part, dest)
+        except FileNotFoundError:
+            if self.size(sha) is None:
+                raise UploadError("upload not started") from None
+
+    def read_range(self, sha: str, offset: int = 0, length: Optional[int] = None, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[int, bytes]]:
+        """Yield (offset, data) chunks of a stored blob."""
+        size = self.size(sha)
+        if size is None:
+            raise FileNotFoundError(sha)
+        end = size if length is None else min(size, offset + length)
+        with open(self.path(sha), "rb") as f:
+            f.seek(offset)
+            pos = offset
+            while pos < end:
+                data = f.read(min(chunk_size, end - pos))
+                if not data:
+                    break
+                yield pos, data
+                pos += len(data)
@@ -0,0 +1,221 @@
+"""Local pub/sub bus for the multi-process server mode.
+
+The supervisor process runs a BusHub on a Unix-domain socket; every worker
+process connects a BusClient to it. Frames are length-prefixed JSON
+(4-byte big-endian length + UTF-8 body):
+
+  worker -> hub   {"op":"hello","worker":<n>}
+  worker -> hub   {"op":"publish","worker":<n>,"conn":<id>,"msg":{...}}
+  hub -> workers  {"op":"deliver","worker":<n>,"conn":<id>,"msg":{...}}
+  worker -> hub   {"op":"ephemeral","worker":<n>,"conn":<id>,"msg":{...}}
+  hub -> workers  (the same frame)
+
+The hub hands each published message to its `on_publish` callback (the
+single persistence writer) and then delivers the result to every worker,
+including the one it came from, so all processes see the same stream.
+Ephemeral frames (typing, presence) skip the callback and are relayed
+as they are.
+
+After each fan-out the hub waits for the worker links to drain, so a slow
+worker slows the publishers down instead of growing the hub's buffers. A
+worker that stops reading altogether is cut off like a client under the
+"disconnect" overflow policy: once its link holds more than
+BUS_BUFFER_LIMIT bytes, or has not drained for BUS_DRAIN_TIMEOUT seconds,
+the hub aborts the link. The worker then exits and the supervisor starts
+a new one, whose clients reconnect and catch up with ?since=.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import struct
+from typing import Awaitable, Callable, Dict, Optional
+
+from .metrics import BUS_LINKS_DROPPED
+
+_HEADER = struct.Struct(">I")
+MAX_FRAME = 16 * 1024 * 1024
+# bytes queued for one worker before the hub gives up on it
+BUS_BUFFER_LIMIT = 64 * 1024 * 1024
+# seconds a worker link may stay above its high-water mark
+BUS_DRAIN_TIMEOUT = 10.0
+
+
+def encode_frame(obj: Dict) -> bytes:
+    body = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return _HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Dict:
+    header = await reader.readexactly(_HEADER.size)
+    (size,) = _HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise ValueError(f"bus frame too large: {size}")
+    return json.loads(await reader.readexactly(size))
+
+
+class BusHub:
+    """Fan-out hub living in the supervisor process."""
+
+    def __init__(
+        self,
+        path: str,
+        on_publish: Callable[[Dict], Awaitable[Optional[Dict]]],
+        buffer_limit: int = BUS_BUFFER_LIMIT,
+        drain_timeout: float = BUS_DRAIN_TIMEOUT,
+    ):
+        self.path = path
+        self.on_publish = on_publish
+        self.buffer_limit = buffer_limit
+        self.drain_timeout = drain_timeout
+        self.dropped = 0
+        self.workers: Dict[int, asyncio.StreamWriter] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve_worker, path=self.path)
+
+    async def _serve_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        worker_id = None
+        try:
+            hello = await read_frame(reader)
+            worker_id = int(hello.get("worker", -1))
+            self.workers[worker_id] = writer
+            logging.info("Bus: worker %s attached", worker_id)
+            while True:
+                frame = await read_frame(reader)
+                if frame.get("op") == "ephemeral":
+                    # not persisted: straight back out to every worker
+                    self.deliver(frame)
+                    await self.drain()
+                    continue
+                if frame.get("op") != "publish":
+                    continue
+                try:
+                    msg = await self.on_publish(frame["msg"])
+                except Exception:
+                    logging.exception("Bus: failed to handle published message")
+                    continue
+                if msg is None:
+                    continue
+                self.deliver({"op": "deliver", "worker": worker_id, "conn": frame.get("conn"), "msg": msg})
+                await self.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logging.exception("Bus: worker %s connection failed", worker_id)
+        finally:
+            if worker_id is not None and self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+            writer.close()
+            logging.info("Bus: worker %s detached", worker_id)
+
+    def deliver(self, frame: Dict) -> None:
+        """Queue `frame` for every worker (without waiting; see drain)."""
+        data = encode_frame(frame)
+        for worker_id, writer in list(self.workers.items()):
+            if writer.is_closing():
+                continue
+            if writer.transport.get_write_buffer_size() + len(data) > self.buffer_limit:
+                self._drop(worker_id, writer, "send buffer full")
+                continue
+            writer.write(data)
+
+    async def drain(self) -> None:
+        """Wait until no worker link is above its high-water mark.
+
+        Links that don't get there within drain_timeout are dropped.
+        """
+        links = [
+            (worker_id, writer)
+            for worker_id, writer in self.workers.items()
+            if not writer.is_closing()
+            and writer.transport.get_write_buffer_size() > writer.transport.get_write_buffer_limits()[1]
+        ]
+        if not links:
+            return
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(writer.drain() for _, writer in links), return_exceptions=True), self.drain_timeout
+            )
+        except asyncio.TimeoutError:
+            for worker_id, writer in links:
+                if not writer.is_closing() and writer.transport.get_write_buffer_size() > writer.transport.get_write_buffer_limits()[1]:
+                    self._drop(worker_id, writer, f"not drained in {self.drain_timeout:g}s")
+
+    def _drop(self, worker_id: int, writer: asyncio.StreamWriter, reason: str) -> None:
+        logging.warning("Bus: dropping worker %s (%s, %d bytes queued)", worker_id, reason, writer.transport.get_write_buffer_size())
+        self.dropped += 1
+        BUS_LINKS_DROPPED.inc()
+        if self.workers.get(worker_id) is writer:
+            del self.workers[worker_id]
+        # abort, not close: close() would keep the queued bytes until they are sent
+        writer.transport.abort()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in list(self.workers.values()):
+            writer.close()
+        self.workers.clear()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class BusClient:
+    """Worker-side connection to the BusHub."""
+
+    def __init__(self, path: str, worker_id: int):
+        self.path = path
+        self.worker_id = worker_id
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self, retries: int = 50, delay: float = 0.1) -> None:
+        for attempt in range(retries):
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if attempt == retries - 1:
+                    raise
+                await asyncio.sleep(delay)
+        assert self._writer is not None
+        self._writer.write(encode_frame({"op": "hello", "worker": self.worker_id}))
+
+    def publish(self, msg: Dict, conn_id: Optional[int] = None) -> None:
+        """Send `msg` to the hub without waiting for it to be persisted."""
+        assert self._writer is not None
+        self._writer.write(encode_frame({"op": "publish", "worker": self.worker_id, "conn": conn_id, "msg": msg}))
+
+    def publish_ephemeral(self, msg: Dict, conn_id: Optional[int] = None) -> None:
+        """Send a typing/presence frame to every worker (not persisted)."""
+        assert self._writer is not None
+        self._writer.write(encode_frame({"op": "ephemeral", "worker": self.worker_id, "conn": conn_id, "msg": msg}))
+
+    async def run(
+        self, on_deliver: Callable[[Dict], None], on_ephemeral: Optional[Callable[[Dict], None]] = None
+    ) -> None:
+        """Read delivered frames until the hub goes away."""
+        assert self._reader is not None
+        while True:
+            frame = await read_frame(self._reader)
+            op = frame.get("op")
+            if op == "deliver":
+                on_deliver(frame)
+            elif op == "ephemeral" and on_ephemeral is not None:
+                on_ephemeral(frame)
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+            self._writer = None
@@ -0,0 +1,547 @@
+"""Asyncio client library for bots and integrations (no Qt, no threads).
+
+  async with Client("ws://localhost:8765", rooms=["general"], sender="bot") as c:
+      await c.send("hello")          # queued; returns as soon as there is window space
+      async for msg in c:            # messages of the joined rooms, oldest first
+          ...
+
+Sends are pipelined: send() only queues the message, and a writer task
+packs everything queued into as few {"type":"batch"} frames as possible
+without waiting for acks. At most `max_inflight` messages may be queued or
+unacknowledged; send() waits for window space beyond that. Every message
+carries a client_msg_id and stays queued until the server acks it. The
+client reconnects on its own (jittered exponential backoff, like the
+desktop client) with ?since=<last id>, then sends the unacked messages
+again; the server drops the ones it already stored. flush() waits until
+everything is acked.
+
+Incoming messages are handed over in batches: whatever is read within
+`batch_interval` of the first message goes to one on_messages(list) call,
+or one step of batches(). Iterating the client itself yields single
+messages. A consumer that falls behind stops the reader. The excess then
+waits in the server's outbound queue for this connection (subject to its
+overflow policy), not in client memory. Frames other than chat messages
+and acks (errors, search results, typing/presence) go to on_event.
+
+ClientPool multiplexes many logical Sessions (a sender name and its rooms)
+over a fixed number of connections. Each new session goes to the
+connection with the fewest sessions, and a connection joins the union of
+its sessions' rooms. The server does not echo a message to the connection
+that sent it, so the pool hands acknowledged messages to the other
+sessions of the same connection itself.
+
+Server ingress limits apply per connection (see ratelimit.py); spread
+high-volume senders over more pool connections.
+"""
+from __future__ import annotations
+
+import asyncio
+import inspect
+import itertools
+import logging
+import random
+import uuid
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set
+from urllib.parse import urlencode, urlsplit, urlunsplit
+
+import websockets
+
+from . import codec
+
+DEFAULT_ROOM = "general"
+# messages per outgoing batch frame
+SEND_BATCH = 200
+# queued + unacknowledged messages before send() waits
+MAX_INFLIGHT = 5000
+# seconds to gather incoming messages into one batch
+BATCH_INTERVAL = 0.005
+# read but undelivered messages before the reader stops reading
+MAX_INBOX = 10000
+# undelivered batches for batches() / iteration
+MAX_BATCHES = 64
+RECONNECT_BASE = 1.0
+RECONNECT_MAX = 60.0
+# history requested after a reconnect (the server caps it at HISTORY_MAX_LIMIT)
+RESYNC_LIMIT = 5000
+# recently received message ids remembered to drop replayed duplicates
+SEEN_IDS = 10000
+
+BatchCallback = Callable[[List[Dict]], Optional[Awaitable[None]]]
+EventCallback = Callable[[Dict], Optional[Awaitable[None]]]
+
+
+def backoff(failures: int) -> float:
+    """Seconds to wait after `failures` failed attempts in a row (full jitter)."""
+    return random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * 2 ** min(failures, 16)))
+
+
+async def _call(callback, arg) -> None:
+    try:
+        result = callback(arg)
+        if inspect.isawaitable(result):
+            await result
+    except Exception:
+        logging.exception("Client callback failed")
+
+
+async def _iter_batches(queue: asyncio.Queue) -> AsyncIterator[List[Dict]]:
+    while True:
+        batch = await queue.get()
+        if batch is None:  # closed
+            return
+        yield batch
+
+
+def _close_queue(queue: asyncio.Queue) -> None:
+    # make room for the end marker; batches nobody consumed are discarded
+    while True:
+        try:
+            queue.put_nowait(None)
+            return
+        except asyncio.QueueFull:
+            queue.get_nowait()
+
+
+class Client:
+    def __init__(
+        self,
+        uri: str,
+        rooms: Iterable[str] = (DEFAULT_ROOM,),
+        sender: str = "bot",
+        *,
+        history: int = 0,
+        since: Optional[int] = None,
+        wire_format: str = "auto",
+        on_messages: Optional[BatchCallback] = None,
+        on_event: Optional[EventCallback] = None,
+        echo: bool = False,
+        max_inflight: int = MAX_INFLIGHT,
+        send_batch: int = SEND_BATCH,
+        batch_interval: float = BATCH_INTERVAL,
+    ):
+        """`history`: messages per room replayed on the first connect; `since`: resume after this id.
+
+        With `echo`, acknowledged messages of this client are delivered
+        with the incoming ones, marked with "echo": True.
+        """
+        self.uri = uri
+        # the server puts a client that names no rooms into "general"
+        self.rooms: List[str] = list(rooms) or [DEFAULT_ROOM]
+        self.sender = sender
+        self.history = history
+        self.last_id = since
+        self.offered = codec.SUBPROTOCOLS if wire_format == "auto" else [codec.JsonCodec.name]
+        self.on_messages = on_messages
+        self.on_event = on_event
+        self.echo = echo
+        self.max_inflight = max_inflight
+        self.send_batch = send_batch
+        self.batch_interval = batch_interval
+        self.wire = codec.JSON
+        self.ws: Optional[websockets.WebSocketClientProtocol] = None
+        self.connected = asyncio.Event()
+        self._closing = False
+        self._tasks: List[asyncio.Task] = []
+        # client_msg_id -> message, in send order, until acked
+        self._unacked: "OrderedDict[str, Dict]" = OrderedDict()
+        # ids still to be written on the current connection
+        self._queue: Deque[str] = deque()
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._all_acked = asyncio.Event()
+        self._all_acked.set()
+        # read, not yet delivered
+        self._inbox: List[Dict] = []
+        self._inbox_ready = asyncio.Event()
+        self._inbox_space = asyncio.Event()
+        self._inbox_space.set()
+        self._batches: asyncio.Queue = asyncio.Queue(MAX_BATCHES)
+        # rooms joined after connecting whose history replay is not wanted
+        self._skip_history: Set[str] = set()
+        self._seen_ids: Set[int] = set()
+        self._seen_order: Deque[int] = deque()
+        # counters
+        self.sent = 0
+        self.acked = 0
+        self.frames_out = 0
+        self.received = 0
+        self.batches_in = 0
+        self.reconnects = 0
+
+    async def __aenter__(self) -> "Client":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def start(self) -> None:
+        """Start connecting in the background; sends are queued until connected."""
+        if self._tasks:
+            return
+        self._closing = False
+        self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._dispatch_loop())]
+
+    async def wait_connected(self, timeout: Optional[float] = None) -> None:
+        await asyncio.wait_for(self.connected.wait(), timeout)
+
+    async def close(self) -> None:
+        self._closing = True
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        _close_queue(self._batches)
+
+    # -- sending --
+
+    async def send(self, text: str = "", room: Optional[str] = None, **fields) -> str:
+        """Queue a chat message and return its client_msg_id (waits only for window space)."""
+        while len(self._unacked) >= self.max_inflight:
+            self._space.clear()
+            await self._space.wait()
+        return self.send_nowait(text, room, **fields)
+
+    def send_nowait(self, text: str = "", room: Optional[str] = None, **fields) -> str:
+        """Like send(), but ignores the window."""
+        room = room or self.rooms[0]
+        if room not in self.rooms:
+            # the server would answer with an error instead of an ack
+            raise ValueError(f"not joined: {room}")
+        msg = {"sender": self.sender, "text": text, "room": room}
+        msg.update(fields)
+        client_msg_id = msg.setdefault("client_msg_id", uuid.uuid4().hex)
+        self._unacked[client_msg_id] = msg
+        self._queue.append(client_msg_id)
+        self._all_acked.clear()
+        self._wakeup.set()
+        return client_msg_id
+
+    async def flush(self, timeout: Optional[float] = None) -> None:
+        """Wait until every message sent so far has been acked."""
+        await asyncio.wait_for(self._all_acked.wait(), timeout)
+
+    @property
+    def pending(self) -> int:
+        return len(self._unacked)
+
+    async def request(self, obj: Dict) -> bool:
+        """Send a request frame ({"type": ...}) now; False when not connected."""
+        ws = self.ws
+        if ws is None:
+            return False
+        try:
+            await ws.send(self.wire.encode(obj))
+        except websockets.ConnectionClosed:
+            return False
+        return True
+
+    async def join(self, room: str) -> None:
+        if room in self.rooms:
+            return
+        self.rooms.append(room)
+        if not self.history:
+            self._skip_history.add(room)
+        # when not connected, the next connect joins it through the URI
+        await self.request({"type": "join", "room": room})
+
+    async def leave(self, room: str) -> None:
+        if room in self.rooms:
+            self.rooms.remove(room)
+            await self.request({"type": "leave", "room": room})
+
+    # -- receiving --
+
+    def batches(self) -> AsyncIterator[List[Dict]]:
+        """Incoming messages, one list per delivery (unused when on_messages is set)."""
+        return _iter_batches(self._batches)
+
+    async def _iter_messages(self) -> AsyncIterator[Dict]:
+        async for batch in self.batches():
+            for msg in batch:
+                yield msg
+
+    def __aiter__(self) -> AsyncIterator[Dict]:
+        return self._iter_messages()
+
+    # -- connection --
+
+    def _connect_uri(self) -> str:
+        parts = urlsplit(self.uri)
+        query = {"rooms": ",".join(self.rooms)}
+        if self.last_id is not None:
+            query.update(since=self.last_id, limit=RESYNC_LIMIT)
+        else:
+            query["limit"] = self.history
+        return urlunsplit(parts._replace(path=parts.path or "/", query=urlencode(query)))
+
+    async def _run(self) -> None:
+        failures = 0
+        while not self._closing:
+            opened = False
+            try:
+                async with websockets.connect(self._connect_uri(), subprotocols=self.offered, max_size=None) as ws:
+                    opened = True
+                    self.ws = ws
+                    self.wire = codec.for_subprotocol(ws.subprotocol)
+                    # history after a reconnect is what we missed: always deliver it
+                    self._skip_history.clear()
+                    # everything unacked goes out again; the server drops what it already stored
+                    self._queue = deque(self._unacked)
+                    self._wakeup.set()
+                    self.connected.set()
+                    writer = asyncio.create_task(self._write_loop(ws))
+                    try:
+                        await self._read_loop(ws)
+                    finally:
+                        self.connected.clear()
+                        self.ws = None
+                        writer.cancel()
+                        try:
+                            await writer
+                        except (asyncio.CancelledError, websockets.ConnectionClosed):
+                            pass
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                logging.debug("Client connection to %s failed: %s", self.uri, e)
+            if self._closing:
+                break
+            failures = 0 if opened else failures + 1
+            self.reconnects += 1
+            await asyncio.sleep(backoff(failures))
+
+    async def _write_loop(self, ws) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._queue:
+                ids = [self._queue.popleft() for _ in range(min(len(self._queue), self.send_batch))]
+                # acked in the meantime (e.g. before a reconnect) -> skip
+                payloads = [self.wire.encode(self._unacked[i]) for i in ids if i in self._unacked]
+                if not payloads:
+                    continue
+                await ws.send(payloads[0] if len(payloads) == 1 else self.wire.batch(payloads))
+                self.frames_out += 1
+                self.sent += len(payloads)
+
+    async def _read_loop(self, ws) -> None:
+        async for raw in ws:
+            try:
+                data = codec.decode_frame(raw)
+            except Exception:
+                continue
+            if not isinstance(data, dict):
+                continue
+            kind = data.get("type", "message")
+            if kind in ("history", "batch"):
+                if kind == "history" and data.get("room") in self._skip_history:
+                    continue
+                msgs = [m for m in data.get("messages", []) if isinstance(m, dict) and not self._seen(m)]
+            elif kind == "message":
+                msgs = [] if self._seen(data) else [data]
+            elif kind == "ack":
+                await self._on_ack(data)
+                continue
+            elif kind == "history_end":
+                self._skip_history.discard(data.get("room"))
+                if data.get("more") and data.get("last_id") is not None:
+                    # the resync page was full: fetch the rest of the backlog
+                    await self.request(
+                        {"type": "history", "room": data.get("room"), "since": data["last_id"], "limit": RESYNC_LIMIT}
+                    )
+                continue
+            else:
+                if self.on_event is not None:
+                    await _call(self.on_event, data)
+                continue
+            if msgs:
+                await self._deliver(msgs)
+
+    async def _on_ack(self, data: Dict) -> None:
+        self._seen(data)
+        msg = self._unacked.pop(data.get("client_msg_id"), None)
+        if msg is None:
+            return
+        self.acked += 1
+        if len(self._unacked) < self.max_inflight:
+            self._space.set()
+        if not self._unacked:
+            self._all_acked.set()
+        if self.echo:
+            await self._deliver([dict(msg, id=data.get("id"), timestamp=data.get("timestamp"), echo=True)])
+
+    def _seen(self, msg: Dict) -> bool:
+        msg_id = msg.get("id")
+        if not isinstance(msg_id, int):
+            return False
+        if msg_id in self._seen_ids:
+            return True
+        self._seen_ids.add(msg_id)
+        self._seen_order.append(msg_id)
+        if len(self._seen_order) > SEEN_IDS:
+            self._seen_ids.discard(self._seen_order.popleft())
+        self.last_id = max(self.last_id or 0, msg_id)
+        return False
+
+    async def _deliver(self, msgs: List[Dict]) -> None:
+        # a slow consumer stops the reader here (and so the socket)
+        while len(self._inbox) >= MAX_INBOX:
+            self._inbox_space.clear()
+            await self._inbox_space.wait()
+        self._inbox.extend(msgs)
+        self._inbox_ready.set()
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            await self._inbox_ready.wait()
+            if self.batch_interval > 0:
+                await asyncio.sleep(self.batch_interval)
+            self._inbox_ready.clear()
+            batch, self._inbox = self._inbox, []
+            self._inbox_space.set()
+            if not batch:
+                continue
+            self.batches_in += 1
+            self.received += len(batch)
+            if self.on_messages is not None:
+                await _call(self.on_messages, batch)
+            else:
+                await self._batches.put(batch)
+
+    def stats(self) -> Dict:
+        return {
+            "uri": self.uri,
+            "connected": self.connected.is_set(),
+            "rooms": list(self.rooms),
+            "sent": self.sent,
+            "acked": self.acked,
+            "pending": len(self._unacked),
+            "frames_out": self.frames_out,
+            "received": self.received,
+            "batches_in": self.batches_in,
+            "reconnects": self.reconnects,
+            "last_id": self.last_id,
+        }
+
+
+class Session:
+    """A logical client of a ClientPool: a sender name and the rooms it reads."""
+
+    def __init__(self, pool: "ClientPool", client: Client, name: str, rooms: List[str]):
+        self.pool = pool
+        self.client = client
+        self.name = name
+        self.rooms = rooms
+        self._batches: asyncio.Queue = asyncio.Queue(MAX_BATCHES)
+        self.received = 0
+
+    async def send(self, text: str = "", room: Optional[str] = None, **fields) -> str:
+        room = room or self.rooms[0]
+        if room not in self.rooms:
+            raise ValueError(f"not joined: {room}")
+        return await self.client.send(text, room, sender=self.name, **fields)
+
+    async def flush(self, timeout: Optional[float] = None) -> None:
+        """Wait until everything sent over this session's connection has been acked."""
+        await self.client.flush(timeout)
+
+    def batches(self) -> AsyncIterator[List[Dict]]:
+        return _iter_batches(self._batches)
+
+    async def _iter_messages(self) -> AsyncIterator[Dict]:
+        async for batch in self.batches():
+            for msg in batch:
+                yield msg
+
+    def __aiter__(self) -> AsyncIterator[Dict]:
+        return self._iter_messages()
+
+    async def close(self) -> None:
+        await self.pool.remove(self)
+
+
+class ClientPool:
+    """Many Sessions over `connections` managed, auto-reconnecting Clients."""
+
+    def __init__(self, uri: str, connections: int = 4, **client_kwargs):
+        self.uri = uri
+        self.size = connections
+        self.client_kwargs = client_kwargs
+        self.clients: List[Client] = []
+        self.sessions: Dict[Client, List[Session]] = {}
+        self._names = itertools.count(1)
+
+    async def __aenter__(self) -> "ClientPool":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def start(self) -> None:
+        for _ in range(self.size - len(self.clients)):
+            client = Client(self.uri, rooms=(), echo=True, **self.client_kwargs)
+            client.on_messages = lambda batch, client=client: self._route(client, batch)
+            self.clients.append(client)
+            self.sessions[client] = []
+            await client.start()
+
+    async def wait_connected(self, timeout: Optional[float] = None) -> None:
+        await asyncio.gather(*(c.wait_connected(timeout) for c in self.clients))
+
+    async def session(self, name: Optional[str] = None, rooms: Iterable[str] = (DEFAULT_ROOM,)) -> Session:
+        if not self.clients:
+            await self.start()
+        client = min(self.clients, key=lambda c: len(self.sessions[c]))
+        session = Session(self, client, name or f"bot-{next(self._names)}", list(rooms))
+        self.sessions[client].append(session)
+        for room in session.rooms:
+            await client.join(room)
+        return session
+
+    async def remove(self, session: Session) -> None:
+        sessions = self.sessions.get(session.client, [])
+        if session in sessions:
+            sessions.remove(session)
+        _close_queue(session._batches)
+        wanted = {room for s in sessions for room in s.rooms}
+        # keep at least one room: the connection stays usable for new sessions
+        for room in [r for r in session.client.rooms if r not in wanted][: len(session.client.rooms) - 1]:
+            await session.client.leave(room)
+
+    async def _route(self, client: Client, batch: List[Dict]) -> None:
+        for session in list(self.sessions.get(client, [])):
+            # a session does not get its own messages back
+            msgs = [
+                m
+                for m in batch
+                if (m.get("room") or DEFAULT_ROOM) in session.rooms
+                and not (m.get("echo") and m.get("sender") == session.name)
+            ]
+            if msgs:
+                session.received += len(msgs)
+                await session._batches.put(msgs)
+
+    async def flush(self, timeout: Optional[float] = None) -> None:
+        await asyncio.gather(*(c.flush(timeout) for c in self.clients))
+
+    async def close(self) -> None:
+        for sessions in self.sessions.values():
+            for session in sessions:
+                _close_queue(session._batches)
+        await asyncio.gather(*(c.close() for c in self.clients))
+        self.clients = []
+        self.sessions = {}
+
+    def stats(self) -> Dict:
+        return {
+            "connections": [dict(c.stats(), sessions=len(self.sessions[c])) for c in self.clients],
+            "sessions": sum(len(s) for s in self.sessions.values()),
+        }
@@ -3,28 +3,55 @@
 Usage:
   python client_example.py --send "hello"
   python client_example.py
+  python client_example.py --since 120      # only history newer than id 120
+  python client_example.py --limit 20       # only the latest 20 messages
+  python client_example.py --room dev --send "hi"   # join and talk in room "dev"
+  python client_example.py --format json    # do not negotiate MessagePack
 
 This script connects, optionally sends a JSON message, and prints incoming messages.
 """
 import asyncio
-import json
 import argparse
+from urllib.parse import urlencode
 
 import websockets
 
+try:
+    from . import codec
+except ImportError:  # run as a script: python client_example.py
+    import codec
 
-async def run(uri: str, send_text: str | None):
-    async with websockets.connect(uri) as ws:
+
+async def run(
+    uri: str,
+    send_text: str | None,
+    since: int | None = None,
+    limit: int | None = None,
+    room: str | None = None,
+    wire_format: str = "auto",
+):
+    query = {k: v for k, v in (("rooms", room), ("since", since), ("limit", limit)) if v is not None}
+    if query:
+        uri = uri.rstrip("/") + "/?" + urlencode(query)
+    offered = codec.SUBPROTOCOLS if wire_format == "auto" else [codec.JsonCodec.name]
+    async with websockets.connect(uri, subprotocols=offered) as ws:
+        wire = codec.for_subprotocol(ws.subprotocol)
         if send_text:
             obj = {"sender": "cli", "text": send_text}
-            await ws.send(json.dumps(obj, ensure_ascii=False))
-        print('Connected to', uri)
+            if room:
+                obj["room"] = room
+            await ws.send(wire.encode(obj))
+        print('Connected to', uri, 'using', wire.name)
         try:
             async for msg in ws:
                 try:
-                    data = json.loads(msg)
+                    data = codec.decode_frame(msg)
                 except Exception:
                     data = {"text": msg}
+                if data.get("type") in ("history", "batch"):
+                    for m in data.get("messages", []):
+                        print('HIST>', m)
+                    continue
                 print('RECV>', data)
         except Exception:
             pass
@@ -34,8 +61,12 @@ def main():
     p = argparse.ArgumentParser()
     p.add_argument("--uri", default="ws://localhost:8765")
     p.add_argument("--send", default=None)
+    p.add_argument("--since", type=int, default=None, help="only replay history newer than this message id")
+    p.add_argument("--limit", type=int, default=None, help="replay at most this many history messages")
+    p.add_argument("--room", default=None, help="room to join and send to (default: general)")
+    p.add_argument("--format", choices=("auto", "json"), default="auto", help="wire format to negotiate")
     args = p.parse_args()
-    asyncio.run(run(args.uri, args.send))
+    asyncio.run(run(args.uri, args.send, since=args.since, limit=args.limit, room=args.room, wire_format=args.format))
 
 
 if __name__ == "__main__":
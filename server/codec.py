@@ -0,0 +1,125 @@
+"""Wire formats negotiated with the WebSocket subprotocol header.
+
+- ``pychat.msgpack.v1``: MessagePack with short field codes (FIELD_CODES),
+  sent as binary frames. Needs the optional ``msgpack`` package.
+- ``pychat.json.v1`` or no subprotocol: plain JSON text frames, so clients
+  that do not negotiate anything keep working.
+
+Incoming frames are decoded by frame type (binary = MessagePack, text =
+JSON) whatever was negotiated. permessage-deflate is negotiated separately
+by the websockets library.
+"""
+from __future__ import annotations
+
+import json
+import struct
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+Payload = Union[str, bytes]
+
+# long key -> short key; applied to every dict in a frame, nested ones included
+FIELD_CODES: Dict[str, str] = {
+    "type": "y",
+    "id": "i",
+    "sender": "s",
+    "text": "t",
+    "timestamp": "ts",
+    "attachment": "a",
+    "room": "r",
+    "messages": "m",
+    "last_id": "li",
+    "hits": "h",
+    "snippet": "sn",
+    "rank": "rk",
+    "query": "q",
+    "offset": "o",
+    "next_offset": "no",
+    "limit": "l",
+    "error": "e",
+    "request": "rq",
+    "client_msg_id": "c",
+}
+FIELD_NAMES: Dict[str, str] = {v: k for k, v in FIELD_CODES.items()}
+
+
+def _rename(obj: Any, table: Dict[str, str]) -> Any:
+    if isinstance(obj, dict):
+        return {table.get(k, k): _rename(v, table) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_rename(v, table) for v in obj]
+    return obj
+
+
+def compact(obj: Any) -> Any:
+    return _rename(obj, FIELD_CODES)
+
+
+def expand(obj: Any) -> Any:
+    return _rename(obj, FIELD_NAMES)
+
+
+class JsonCodec:
+    name = "pychat.json.v1"
+    binary = False
+
+    def encode(self, obj: Dict) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
+    def decode(self, raw: Payload) -> Any:
+        return json.loads(raw)
+
+    def batch(self, payloads: List[Payload]) -> str:
+        """One {"type":"batch","messages":[...]} frame made of encoded messages."""
+        return '{"type":"batch","messages":[' + ",".join(payloads) + "]}"
+
+
+class MsgpackCodec:
+    name = "pychat.msgpack.v1"
+    binary = True
+
+    def encode(self, obj: Dict) -> bytes:
+        return msgpack.packb(compact(obj), use_bin_type=True)
+
+    def decode(self, raw: Payload) -> Any:
+        return expand(msgpack.unpackb(raw, raw=False))
+
+    def batch(self, payloads: List[Payload]) -> bytes:
+        # MessagePack values concatenate, so the array body is the payloads as-is
+        head = msgpack.packb({FIELD_CODES["type"]: "batch"})
+        head = bytes([head[0] + 1]) + head[1:]  # fixmap with one more entry
+        n = len(payloads)
+        if n < 16:
+            arr = bytes([0x90 | n])
+        elif n < 0x10000:
+            arr = b"\xdc" + struct.pack(">H", n)
+        else:
+            arr = b"\xdd" + struct.pack(">I", n)
+        return head + msgpack.packb(FIELD_CODES["messages"]) + arr + b"".join(payloads)
+
+
+JSON = JsonCodec()
+CODECS: Dict[str, Any] = {JSON.name: JSON}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+# server preference order
+SUBPROTOCOLS: List[str] = [name for name in (MsgpackCodec.name, JsonCodec.name) if name in CODECS]
+
+
+def for_subprotocol(subprotocol: Optional[str]):
+    """Codec for the negotiated subprotocol (JSON when none was negotiated)."""
+    return CODECS.get(subprotocol or "", JSON)
+
+
+def decode_frame(raw: Payload) -> Any:
+    """Decode an incoming frame according to its frame type."""
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        if msgpack is None:
+            raise ValueError("binary frame received but msgpack is not installed")
+        return CODECS[MsgpackCodec.name].decode(bytes(raw))
+    return json.loads(raw)
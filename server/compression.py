@@ -0,0 +1,99 @@
+"""Dictionary compression of message bodies (optional, needs ``zstandard``).
+
+Chat messages are short (tens of bytes) and repetitive. zstd on a single
+message saves next to nothing, because a short input has no history to
+refer back to. Against a dictionary trained from the database's own
+messages they shrink to about half.
+
+A compressed body is stored as a BLOB in ``messages.text``: one byte naming
+the dictionary (``text_dicts.id``) followed by a magicless zstd frame
+without dictionary id or checksum, which saves 8 bytes of framing per row.
+Texts that would not get smaller stay TEXT, so plain and compressed rows
+mix freely. Training again adds a dictionary that is used for new rows;
+rows compressed with an older one keep using it. See Storage.compress_text.
+"""
+from __future__ import annotations
+
+from typing import Dict, Iterable, Union
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+DICT_SIZE = 64 * 1024
+# how many of the newest messages are used as training samples
+TRAIN_SAMPLES = 50_000
+MIN_TRAIN_SAMPLES = 1000
+TEXT_ZSTD_LEVEL = 3
+# dictionary numbers are stored in one byte
+MAX_DICTS = 255
+
+DICTS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS text_dicts (
+        id INTEGER PRIMARY KEY,
+        data BLOB NOT NULL,
+        created INTEGER NOT NULL,
+        samples INTEGER NOT NULL
+    )
+"""
+
+
+def _require() -> None:
+    if zstandard is None:
+        raise RuntimeError("compressed message text needs the zstandard package")
+
+
+def train(samples: Iterable[str], size: int = DICT_SIZE) -> bytes:
+    """Train a zstd dictionary from message texts."""
+    _require()
+    data = [s.encode("utf-8") for s in samples if s]
+    if len(data) < MIN_TRAIN_SAMPLES:
+        raise ValueError(f"need at least {MIN_TRAIN_SAMPLES} messages to train a dictionary, got {len(data)}")
+    try:
+        return zstandard.train_dictionary(size, data, level=TEXT_ZSTD_LEVEL).as_bytes()
+    except zstandard.ZstdError as e:
+        raise ValueError(f"dictionary training failed: {e}") from None
+
+
+class TextCodec:
+    """Compresses with the newest dictionary and decompresses with any of them.
+
+    zstd contexts are not thread-safe. Storage only calls ``compress`` on
+    the event loop, and it only calls ``decompress`` inside SQLite (the
+    ``pychat_text()`` SQL function), which runs on aiosqlite's thread.
+    """
+
+    def __init__(self, dicts: Dict[int, bytes]):
+        _require()
+        self.dict_no = max(dicts)
+        self.dicts = len(dicts)
+        self._prefix = bytes([self.dict_no])
+        params = zstandard.ZstdCompressionParameters.from_level(
+            TEXT_ZSTD_LEVEL,
+            format=zstandard.FORMAT_ZSTD1_MAGICLESS,
+            write_content_size=True,
+            write_checksum=False,
+            write_dict_id=False,
+        )
+        self._compressor = zstandard.ZstdCompressor(
+            dict_data=zstandard.ZstdCompressionDict(dicts[self.dict_no]), compression_params=params
+        )
+        self._decompressors = {
+            no: zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(data), format=zstandard.FORMAT_ZSTD1_MAGICLESS
+            )
+            for no, data in dicts.items()
+        }
+
+    def compress(self, text: str) -> Union[str, bytes]:
+        """The stored form of `text`: a BLOB, or `text` itself if that is not smaller."""
+        raw = text.encode("utf-8")
+        blob = self._prefix + self._compressor.compress(raw)
+        return blob if len(blob) < len(raw) else text
+
+    def decompress(self, value):
+        """The text of a stored value (TEXT values are returned as they are)."""
+        if not isinstance(value, bytes):
+            return value
+        return self._decompressors[value[0]].decompress(memoryview(value)[1:]).decode("utf-8")
@@ -0,0 +1,183 @@
+"""Per-connection state for the PyChat server.
+
+Every WebSocket connection gets a bounded outbound queue drained by its own
+writer task, so a slow or stalled client only ever delays itself. When the
+queue is full one of the overflow policies applies:
+
+- ``drop_oldest``: discard the oldest queued frame
+- ``coalesce``: merge the queued chat messages into one
+  {"type":"batch","messages":[...]} frame (in the client's wire format)
+- ``disconnect``: close the connection (code 1008)
+
+Ephemeral frames (typing, presence) go first: they are not queued at all
+once the queue is half full, and queued ones are discarded before any
+policy applies.
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+import websockets
+
+from . import codec as wire
+from .metrics import MESSAGES_OUT
+from .ratelimit import RateLimit, Throttle
+
+POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Frame kinds in the outbound queue; only chat messages can be coalesced.
+KIND_MESSAGE = "message"
+KIND_CONTROL = "control"
+# typing/presence: dropped first under congestion
+KIND_EPHEMERAL = "ephemeral"
+
+_ids = itertools.count(1)
+
+
+class Connection:
+    def __init__(
+        self,
+        ws: websockets.WebSocketServerProtocol,
+        maxsize: int = 256,
+        policy: str = "drop_oldest",
+        codec=wire.JSON,
+        throttle: Optional[Throttle] = None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown overflow policy: {policy}")
+        self.id = next(_ids)
+        self.ws = ws
+        self.codec = codec
+        # ingress limits (see ratelimit.py); unlimited unless the server passes one
+        self.throttle = throttle if throttle is not None else Throttle(RateLimit())
+        self.maxsize = maxsize
+        self.policy = policy
+        self._queue: Deque[Tuple[wire.Payload, str]] = deque()
+        self._wakeup = asyncio.Event()
+        # set whenever the queue is empty (see drain())
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._writer: Optional[asyncio.Task] = None
+        self.closed = False
+        # rooms this connection is subscribed to (see server.ROOMS)
+        self.rooms: Set[str] = set()
+        # sender name and peer id of the last presence frame this client sent (see server._on_ephemeral)
+        self.presence_sender: Optional[str] = None
+        self.presence_peer: Optional[str] = None
+        # counters
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.ephemeral_dropped = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def start(self) -> None:
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def enqueue(self, payload: wire.Payload, kind: str = KIND_MESSAGE) -> bool:
+        """Queue `payload` without waiting. Returns False if it was not queued."""
+        if self.closed:
+            return False
+        if kind == KIND_EPHEMERAL and len(self._queue) >= self.maxsize // 2:
+            self.ephemeral_dropped += 1
+            return False
+        if len(self._queue) >= self.maxsize and not self._make_room():
+            return False
+        self._queue.append((payload, kind))
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._drained.clear()
+        self._wakeup.set()
+        return True
+
+    def _make_room(self) -> bool:
+        ephemeral = sum(1 for _, k in self._queue if k == KIND_EPHEMERAL)
+        if ephemeral:
+            self._queue = deque(e for e in self._queue if e[1] != KIND_EPHEMERAL)
+            self.ephemeral_dropped += ephemeral
+            return True
+        if self.policy == "disconnect":
+            logging.warning("Disconnecting slow client %s (queue depth %d)", self.ws.remote_address, len(self._queue))
+            self.closed = True
+            asyncio.ensure_future(self.ws.close(code=1008, reason="outbound queue overflow"))
+            return False
+        if self.policy == "coalesce":
+            msgs = [p for p, k in self._queue if k == KIND_MESSAGE]
+            if len(msgs) > 1:
+                # the batch takes the place of the first queued message
+                batch: Optional[wire.Payload] = self.codec.batch(msgs)
+                merged: Deque[Tuple[wire.Payload, str]] = deque()
+                for p, k in self._queue:
+                    if k != KIND_MESSAGE:
+                        merged.append((p, k))
+                    elif batch is not None:
+                        merged.append((batch, KIND_CONTROL))
+                        batch = None
+                self._queue = merged
+                self.coalesced += len(msgs)
+                return True
+        # drop_oldest, or nothing left to coalesce
+        self._queue.popleft()
+        self.dropped += 1
+        return True
+
+    async def _write_loop(self) -> None:
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._queue:
+                    payload, _ = self._queue.popleft()
+                    await self.ws.send(payload)
+                    self.sent += 1
+                    MESSAGES_OUT.inc()
+                self._drained.set()
+        except websockets.ConnectionClosed:
+            pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Outbound writer failed for %s", self.ws.remote_address)
+        finally:
+            self.closed = True
+            self._drained.set()
+
+    async def drain(self) -> None:
+        """Wait until the writer has sent everything queued so far (or the connection closed)."""
+        await self._drained.wait()
+
+    async def send(self, obj: Dict) -> None:
+        """Send a reply directly (not through the queue) in the client's format."""
+        await self.ws.send(self.codec.encode(obj))
+
+    async def close(self) -> None:
+        self.closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+
+    def stats(self) -> Dict:
+        return {
+            "id": self.id,
+            "remote": str(self.ws.remote_address),
+            "codec": self.codec.name,
+            "rooms": sorted(self.rooms),
+            "depth": len(self._queue),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "ephemeral_dropped": self.ephemeral_dropped,
+            **self.throttle.stats(),
+        }
@@ -0,0 +1,95 @@
+"""Ephemeral frames: typing indicators and presence.
+
+These are relayed to the other members of a room but never stored,
+replayed in history or acknowledged. They are coalesced: within one
+EPHEMERAL_WINDOW only the latest frame of each (room, type, connection)
+is forwarded. A client that sends a typing update per keystroke therefore
+costs its room at most one frame per window. When a client's outbound
+queue is congested these frames are the first to be dropped (see
+connection.KIND_EPHEMERAL). A lost update is harmless, because clients
+refresh their state periodically and expire it.
+
+  {"type":"typing","room":"dev","sender":"alice","peer":"<id>","typing":true}
+  {"type":"presence","room":"dev","sender":"alice","peer":"<id>","status":"online"}
+
+"sender" is only a display name and several clients may share it, so
+clients key typing and presence state by "peer": an opaque id a client
+picks once per run (at most PEER_MAX characters). The server fills it in
+for clients that don't send one (see server._on_ephemeral).
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+from .metrics import EPHEMERAL_COALESCED, EPHEMERAL_IN
+
+EPHEMERAL_TYPES = ("typing", "presence")
+PRESENCE_STATES = ("online", "away", "offline")
+# seconds during which updates of one sender replace each other
+EPHEMERAL_WINDOW = 0.25
+PEER_MAX = 64
+
+
+def normalize(data: Dict) -> Optional[Dict]:
+    """The relayed form of an ephemeral frame (known fields only), or None if invalid."""
+    kind = data.get("type")
+    frame = {"type": kind, "room": data.get("room"), "sender": str(data.get("sender") or "unknown")}
+    peer = data.get("peer")
+    if isinstance(peer, str) and 0 < len(peer) <= PEER_MAX:
+        frame["peer"] = peer
+    if kind == "typing":
+        frame["typing"] = bool(data.get("typing", True))
+    elif kind == "presence":
+        status = data.get("status", "online")
+        if status not in PRESENCE_STATES:
+            return None
+        frame["status"] = status
+    else:
+        return None
+    return frame
+
+
+class Coalescer:
+    """Holds the latest frame per key and hands them to `flush` once per window."""
+
+    def __init__(self, flush: Callable[[Dict, Optional[int]], None], window: float = EPHEMERAL_WINDOW):
+        self.flush = flush
+        self.window = window
+        self._pending: Dict[Hashable, Tuple[Dict, Optional[int]]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # counters
+        self.received = 0
+        self.coalesced = 0
+        self.forwarded = 0
+
+    def offer(self, key: Hashable, frame: Dict, sender_id: Optional[int] = None) -> None:
+        self.received += 1
+        EPHEMERAL_IN.inc()
+        if key in self._pending:
+            self.coalesced += 1
+            EPHEMERAL_COALESCED.inc()
+        self._pending[key] = (frame, sender_id)
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+    def _flush(self) -> None:
+        self._timer = None
+        pending, self._pending = self._pending, {}
+        for frame, sender_id in pending.values():
+            self.forwarded += 1
+            self.flush(frame, sender_id)
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "forwarded": self.forwarded,
+            "pending": len(self._pending),
+        }
@@ -0,0 +1,111 @@
+"""In-memory ring buffer of the most recent messages.
+
+History replay on connect almost always asks for recent traffic, so the
+server keeps the newest messages (across all rooms) in memory together with
+their pre-serialized JSON. The ring is warmed from SQLite at startup and fed
+with every stored message; only requests reaching further back than the
+ring fall through to the database.
+"""
+from __future__ import annotations
+
+import json
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from .storage import Storage
+
+# (id, room, row, json)
+_Entry = Tuple[int, str, Dict, str]
+
+
+class HotHistory:
+    def __init__(self, capacity: int = 5000):
+        self.capacity = capacity
+        self._ring: Deque[_Entry] = deque()
+        # every message with id > floor_id is in the ring
+        self.floor_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._ring)
+
+    async def warm(self, storage: Storage) -> None:
+        rows = await storage.get_messages(limit=self.capacity)
+        self._ring.clear()
+        for row in rows:
+            self._ring.append(self._entry(row))
+        # a full ring may not reach back to the first message
+        self.floor_id = rows[0]["id"] - 1 if len(rows) >= self.capacity else 0
+
+    @staticmethod
+    def _entry(row: Dict) -> _Entry:
+        return (row["id"], row["room"], row, json.dumps(row, ensure_ascii=False))
+
+    def append(self, row: Dict) -> None:
+        """Add a stored message (a storage row including its id)."""
+        if self.capacity <= 0:
+            return
+        entry = self._entry(row)
+        if not self._ring or entry[0] > self._ring[-1][0]:
+            self._ring.append(entry)
+        else:
+            # rows normally arrive in id order; tolerate small reorderings
+            pos = len(self._ring)
+            while pos > 0 and self._ring[pos - 1][0] > entry[0]:
+                pos -= 1
+            if pos > 0 and self._ring[pos - 1][0] == entry[0]:
+                return
+            if pos == 0 and entry[0] <= self.floor_id:
+                return
+            self._ring.insert(pos, entry)
+        while len(self._ring) > self.capacity:
+            self.floor_id = max(self.floor_id, self._ring.popleft()[0])
+
+    def discard(self, ids) -> None:
+        """Drop messages that were removed from the database (archived by retention)."""
+        ids = set(ids)
+        if ids and self._ring and min(ids) <= self._ring[-1][0]:
+            self._ring = deque(e for e in self._ring if e[0] not in ids)
+
+    def query(self, room: str, since_id: Optional[int], limit: Optional[int]) -> Optional[List[Tuple[Dict, str]]]:
+        """(row, json) of the messages of `room` for a history request, or None on a miss.
+
+        Same semantics as Storage.iter_messages: with since_id the oldest
+        messages after it, otherwise the latest `limit`.
+        """
+        if since_id is not None:
+            if since_id < self.floor_id:
+                self.misses += 1
+                return None
+            out = []
+            for msg_id, msg_room, row, payload in self._ring:
+                if msg_id > since_id and msg_room == room:
+                    out.append((row, payload))
+                    if limit is not None and len(out) >= limit:
+                        break
+            self.hits += 1
+            return out
+        out = []
+        if limit is None or limit > 0:
+            for _, msg_room, row, payload in reversed(self._ring):
+                if msg_room == room:
+                    out.append((row, payload))
+                    if limit is not None and len(out) >= limit:
+                        break
+        if (limit is None or len(out) < limit) and self.floor_id > 0:
+            # older messages of this room may exist below the ring
+            self.misses += 1
+            return None
+        self.hits += 1
+        out.reverse()
+        return out
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._ring),
+            "capacity": self.capacity,
+            "floor_id": self.floor_id,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,171 @@
+"""Maintenance commands for the server database.
+
+Usage (from the repository root):
+  python -m server.manage rebuild-fts [--db server_chat_history.db]
+  python -m server.manage archive [--retention-days N] [--retention-rows N] [--archive-dir server_archive]
+  python -m server.manage archive-query [--start 2026-01-01] [--end 2026-02-01] [--room general] [--limit 100]
+  python -m server.manage export FILE [--room general] [--since-id N]
+  python -m server.manage import FILE
+  python -m server.manage compress-text [--retrain] [--samples 50000]
+  python -m server.manage decompress-text
+
+FILE is JSON lines (one message per line; "-" for stdin/stdout, *.gz for
+gzip). Import keeps message ids and skips ids that are already stored, so
+run it while the server is stopped.
+
+compress-text trains a zstd dictionary from the newest messages and stores
+message text compressed against it from then on (needs ``zstandard``);
+decompress-text turns that off again. Both rewrite the table, so run them
+while the server is stopped.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from .archive import Archive, archive_expired
+from .compression import TRAIN_SAMPLES
+from .storage import Storage
+
+
+async def rebuild_fts(db_path: str) -> None:
+    storage = Storage(db_path)
+    await storage.init()
+    try:
+        if not storage.fts:
+            raise SystemExit("FTS5 is not available in this SQLite build")
+        t0 = time.perf_counter()
+        await storage.rebuild_fts()
+        print(f"Rebuilt search index of {db_path} in {time.perf_counter() - t0:.2f}s")
+    finally:
+        await storage.close()
+
+
+async def archive(db_path: str, archive_dir: str, max_age_days, max_rows) -> None:
+    storage = Storage(db_path)
+    await storage.init()
+    try:
+        await storage.enable_incremental_vacuum()
+        t0 = time.perf_counter()
+        moved = await archive_expired(storage, Archive(archive_dir), max_age_days, max_rows)
+        print(f"Archived {moved} messages from {db_path} to {archive_dir} in {time.perf_counter() - t0:.2f}s")
+    finally:
+        await storage.close()
+
+
+async def export(db_path: str, dest: str, room, since_id) -> None:
+    storage = Storage(db_path)
+    await storage.init()
+    try:
+        s = await storage.export_jsonl(dest, room=room, since_id=since_id)
+        print(
+            f"Exported {s['rows']} messages ({s['bytes'] / 1e6:.1f} MB) from {db_path} "
+            f"in {s['seconds']:.2f}s ({s['rows_per_s']:.0f} rows/s)",
+            file=sys.stderr,
+        )
+    finally:
+        await storage.close()
+
+
+async def import_(db_path: str, source: str) -> None:
+    storage = Storage(db_path)
+    await storage.init()
+    try:
+        s = await storage.import_jsonl(source)
+        print(
+            f"Imported {s['inserted']} of {s['read']} messages into {db_path} "
+            f"({s['skipped']} already stored, {s['invalid']} invalid) "
+            f"in {s['seconds']:.2f}s ({s['rows_per_s']:.0f} rows/s)",
+            file=sys.stderr,
+        )
+    finally:
+        await storage.close()
+
+
+async def compress_text(db_path: str, retrain: bool, samples: int) -> None:
+    storage = Storage(db_path)
+    await storage.init()
+    try:
+        size = os.path.getsize(db_path)
+        s = await storage.compress_text(retrain=retrain, samples=samples)
+        print(
+            f"Compressed {s['compressed']} messages with dictionary {s['dictionary']} in {s['seconds']:.2f}s: "
+            f"message text {s['text_bytes_before'] / 1e6:.1f} MB -> {s['text_bytes_after'] / 1e6:.1f} MB"
+        )
+        t0 = time.perf_counter()
+        await storage.vacuum()
+        print(f"Vacuumed {db_path} in {time.perf_counter() - t0:.2f}s: {size / 1e6:.1f} MB -> {os.path.getsize(db_path) / 1e6:.1f} MB")
+    finally:
+        await storage.close()
+
+
+async def decompress_text(db_path: str) -> None:
+    storage = Storage(db_path)
+    await storage.init()
+    try:
+        s = await storage.decompress_text()
+        await storage.vacuum()
+        print(f"Decompressed {s['decompressed']} messages of {db_path} in {s['seconds']:.2f}s")
+    finally:
+        await storage.close()
+
+
+def archive_query(archive_dir: str, start, end, room, limit: int) -> None:
+    """Print archived messages as JSON lines."""
+    for row in Archive(archive_dir).query(start, end, room=room, limit=limit):
+        print(json.dumps(row, ensure_ascii=False))
+
+
+def main(argv: list[str] | None = None):
+    p = argparse.ArgumentParser(description="PyChat server database maintenance")
+    sub = p.add_subparsers(dest="command", required=True)
+    sp = sub.add_parser("rebuild-fts", help="rebuild the full-text search index")
+    sp.add_argument("--db", default="server_chat_history.db")
+    sp = sub.add_parser("archive", help="move expired messages to the archive once")
+    sp.add_argument("--db", default="server_chat_history.db")
+    sp.add_argument("--archive-dir", default="server_archive")
+    sp.add_argument("--retention-days", type=float, default=None, help="archive messages older than this many days")
+    sp.add_argument("--retention-rows", type=int, default=None, help="keep at most this many messages in the database")
+    sp = sub.add_parser("archive-query", help="print archived messages in a time range (JSON lines)")
+    sp.add_argument("--archive-dir", default="server_archive")
+    sp.add_argument("--start", default=None, help="epoch ms or ISO 8601 (inclusive)")
+    sp.add_argument("--end", default=None, help="epoch ms or ISO 8601 (exclusive)")
+    sp.add_argument("--room", default=None)
+    sp.add_argument("--limit", type=int, default=100)
+    sp = sub.add_parser("export", help="write messages as JSON lines")
+    sp.add_argument("file", help='output file ("-" = stdout, *.gz = gzip)')
+    sp.add_argument("--db", default="server_chat_history.db")
+    sp.add_argument("--room", default=None)
+    sp.add_argument("--since-id", type=int, default=None, help="only messages with a larger id")
+    sp = sub.add_parser("import", help="insert messages from JSON lines, skipping ids already stored")
+    sp.add_argument("file", help='input file ("-" = stdin, *.gz = gzip)')
+    sp.add_argument("--db", default="server_chat_history.db")
+    sp = sub.add_parser("compress-text", help="store message text compressed with a trained zstd dictionary")
+    sp.add_argument("--db", default="server_chat_history.db")
+    sp.add_argument("--retrain", action="store_true", help="train a new dictionary for messages written from now on")
+    sp.add_argument("--samples", type=int, default=TRAIN_SAMPLES, help="newest messages to train the dictionary on")
+    sp = sub.add_parser("decompress-text", help="store message text uncompressed again")
+    sp.add_argument("--db", default="server_chat_history.db")
+    args = p.parse_args(argv)
+    if args.command == "rebuild-fts":
+        asyncio.run(rebuild_fts(args.db))
+    elif args.command == "archive":
+        if args.retention_days is None and args.retention_rows is None:
+            p.error("archive needs --retention-days and/or --retention-rows")
+        asyncio.run(archive(args.db, args.archive_dir, args.retention_days, args.retention_rows))
+    elif args.command == "archive-query":
+        archive_query(args.archive_dir, args.start, args.end, args.room, args.limit)
+    elif args.command == "export":
+        asyncio.run(export(args.db, args.file, args.room, args.since_id))
+    elif args.command == "import":
+        asyncio.run(import_(args.db, args.file))
+    elif args.command == "compress-text":
+        asyncio.run(compress_text(args.db, args.retrain, args.samples))
+    elif args.command == "decompress-text":
+        asyncio.run(decompress_text(args.db))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""In-process metrics exposed in the Prometheus text format.
+
+The metrics are plain module-level objects updated from the event loop
+(no locks, no label sets), so recording costs a perf_counter() call and a
+few additions. A small asyncio HTTP server answers ``GET /metrics``:
+
+  python -m server.server --metrics-port 9108
+  curl http://127.0.0.1:9108/metrics
+
+Histograms use fixed buckets in seconds. Counters are cumulative; Prometheus
+derives rates with rate(), and the ``*_per_second`` gauges give the average
+rate since the previous scrape for quick looks without a Prometheus server.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, List, Optional, Sequence
+
+# 50us .. 5s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# history replay sends whole backlogs, so it gets a longer range
+REPLAY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._last = (time.monotonic(), 0)
+
+    def inc(self, n: int = 1) -> None:
+        self.value += n
+
+    def rate(self) -> float:
+        """Average increase per second since the previous call."""
+        now = time.monotonic()
+        then, before = self._last
+        self._last = (now, self.value)
+        return (self.value - before) / (now - then) if now > then else 0.0
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {self.value}"]
+
+
+class Gauge:
+    """A value read from `fn` at scrape time (kind="counter" for totals kept elsewhere)."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float], kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            logging.exception("Metric %s failed", self.name)
+            return []
+        return [f"{self.name} {_fmt(value)}"]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # one slot per bucket plus +Inf; made cumulative when rendered
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> List[str]:
+        out = []
+        total = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            total += n
+            out.append(f'{self.name}_bucket{{le="{_fmt(bound)}"}} {total}')
+        out.append(f"{self.name}_sum {_fmt(self.sum)}")
+        out.append(f"{self.name}_count {self.count}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help: str, fn: Callable[[], float], kind: str = "gauge") -> Gauge:
+        return self.register(Gauge(name, help, fn, kind))
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(m.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+PARSE_SECONDS = REGISTRY.register(Histogram("pychat_parse_seconds", "Time to decode an incoming frame"))
+PERSIST_SECONDS = REGISTRY.register(Histogram("pychat_persist_seconds", "Time spent in Storage.add_message per message"))
+COMMIT_SECONDS = REGISTRY.register(Histogram("pychat_commit_seconds", "Time to insert and commit one write-behind batch"))
+COMMIT_RETRIES = REGISTRY.register(Counter("pychat_commit_retries_total", "Write-behind commits that failed and were retried"))
+MESSAGES_REJECTED = REGISTRY.register(
+    Counter("pychat_messages_rejected_total", "Queued messages the database refused (dropped instead of retried)")
+)
+BROADCAST_SECONDS = REGISTRY.register(Histogram("pychat_broadcast_seconds", "Time to fan a message out to the room's queues"))
+HISTORY_REPLAY_SECONDS = REGISTRY.register(
+    Histogram("pychat_history_replay_seconds", "Time to send one room's history backlog", REPLAY_BUCKETS)
+)
+MESSAGES_IN = REGISTRY.register(Counter("pychat_messages_received_total", "Chat messages received from clients"))
+MESSAGES_OUT = REGISTRY.register(Counter("pychat_messages_sent_total", "Queued frames written to client sockets"))
+EPHEMERAL_IN = REGISTRY.register(Counter("pychat_ephemeral_received_total", "Typing/presence frames received from clients"))
+EPHEMERAL_COALESCED = REGISTRY.register(
+    Counter("pychat_ephemeral_coalesced_total", "Typing/presence frames replaced by a newer one before being relayed")
+)
+FRAMES_DELAYED = REGISTRY.register(Counter("pychat_frames_delayed_total", "Incoming frames held back by a rate limit"))
+FRAMES_REJECTED = REGISTRY.register(Counter("pychat_frames_rejected_total", "Incoming frames refused (larger than the max frame size)"))
+BUS_LINKS_DROPPED = REGISTRY.register(
+    Counter("pychat_bus_links_dropped_total", "Worker bus links the hub closed because the worker stopped reading")
+)
+THROTTLE_SECONDS = REGISTRY.register(
+    Histogram("pychat_throttle_delay_seconds", "How long a rate-limited client's reads were paused", REPLAY_BUCKETS)
+)
+REGISTRY.gauge("pychat_messages_received_per_second", "Received messages per second since the previous scrape", MESSAGES_IN.rate)
+REGISTRY.gauge("pychat_messages_sent_per_second", "Sent frames per second since the previous scrape", MESSAGES_OUT.rate)
+
+
+async def _serve_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, registry: Registry) -> None:
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5.0)
+        parts = request.split(b" ", 2)
+        path = parts[1].split(b"?", 1)[0] if len(parts) > 1 else b""
+        if parts[0] == b"GET" and path == b"/metrics":
+            status, body = "200 OK", registry.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        head = f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+        writer.write(head.encode("ascii") + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host: str, port: int, registry: Registry = REGISTRY) -> Optional[asyncio.AbstractServer]:
+    """Start the /metrics HTTP endpoint; returns None if the port is unavailable."""
+    try:
+        server = await asyncio.start_server(lambda r, w: _serve_request(r, w, registry), host, port)
+    except OSError as e:
+        logging.warning("Metrics endpoint disabled: cannot listen on %s:%s (%s)", host, port, e)
+        return None
+    logging.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
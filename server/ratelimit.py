@@ -0,0 +1,108 @@
+"""Token-bucket rate limits for frames coming in from clients.
+
+Every connection has its own limit (messages per second and bytes per
+second) and all connections of a process share a global one. A frame that
+goes over a limit is not refused: the connection's read loop sleeps until
+the buckets have refilled. While it sleeps the websockets library stops
+reading the socket once its small receive queue (``max_queue``) is full, so
+the excess stays in the client's TCP send buffer instead of in server
+memory, and the client's own writes block.
+
+The buckets "reserve": a frame always takes its tokens, possibly driving
+the bucket negative, and the caller waits for the debt to be repaid. Frames
+larger than a bucket's capacity (a big batch) are therefore delayed, never
+stuck.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Dict, Optional
+
+from .metrics import FRAMES_DELAYED, THROTTLE_SECONDS
+
+# bucket capacity, in seconds' worth of the rate
+BURST_SECONDS = 4.0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate * BURST_SECONDS
+        self.tokens = self.capacity
+        self._stamp = time.monotonic()
+
+    def reserve(self, n: float, now: float) -> float:
+        """Take `n` tokens and return how many seconds until the bucket is out of debt."""
+        self.tokens = min(self.capacity, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class RateLimit:
+    """A messages/s and a bytes/s bucket; a rate of 0 means unlimited."""
+
+    def __init__(self, msg_rate: float = 0, byte_rate: float = 0):
+        self.msg_rate = msg_rate
+        self.byte_rate = byte_rate
+        self.messages = TokenBucket(msg_rate) if msg_rate > 0 else None
+        self.bytes = TokenBucket(byte_rate) if byte_rate > 0 else None
+
+    @property
+    def enabled(self) -> bool:
+        return self.messages is not None or self.bytes is not None
+
+    def reserve(self, messages: int, nbytes: int, now: float) -> float:
+        delay = 0.0
+        if self.messages is not None and messages:
+            delay = self.messages.reserve(messages, now)
+        if self.bytes is not None:
+            delay = max(delay, self.bytes.reserve(nbytes, now))
+        return delay
+
+
+class Throttle:
+    """Ingress limits of one connection: its own RateLimit plus the shared one."""
+
+    def __init__(self, limit: RateLimit, shared: Optional[RateLimit] = None):
+        self.limit = limit
+        self.shared = shared if shared is not None and shared.enabled else None
+        # counters
+        self.frames = 0
+        self.bytes = 0
+        self.delayed = 0
+        self.delayed_seconds = 0.0
+        self.rejected = 0
+        # set while the read loop is sleeping
+        self.throttled = False
+
+    async def admit(self, messages: int, nbytes: int) -> None:
+        """Account for one incoming frame; sleeps if it puts the client over a limit."""
+        self.frames += 1
+        self.bytes += nbytes
+        now = time.monotonic()
+        delay = self.limit.reserve(messages, nbytes, now)
+        if self.shared is not None:
+            delay = max(delay, self.shared.reserve(messages, nbytes, now))
+        if delay <= 0:
+            return
+        self.delayed += 1
+        self.delayed_seconds += delay
+        FRAMES_DELAYED.inc()
+        THROTTLE_SECONDS.observe(delay)
+        self.throttled = True
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.throttled = False
+
+    def stats(self) -> Dict:
+        return {
+            "throttled": self.throttled,
+            "frames_in": self.frames,
+            "bytes_in": self.bytes,
+            "delayed": self.delayed,
+            "delayed_seconds": round(self.delayed_seconds, 3),
+            "rejected": self.rejected,
+        }
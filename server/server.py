@@ -3,96 +3,1144 @@
 This server persists messages in SQLite (via aiosqlite) and, when a client
 connects, sends recent history before processing incoming messages.
 
-Protocol: clients send JSON like {"sender":"name","text":"hi"}.
-Server stores the message, then broadcasts to other clients.
+Protocol: clients send JSON like {"sender":"name","text":"hi","room":"general"}.
+Server stores the message, then broadcasts to the other members of the room
+("room" defaults to "general"). Frames with a "type" other than "message"
+are requests handled by REQUEST_HANDLERS:
+  {"type":"join","room":"dev"}    subscribe to a room and replay its history
+  {"type":"leave","room":"dev"}   unsubscribe
+  {"type":"history","room":"dev","since":<id>,"limit":5000}
+                                  the next page of a joined room's backlog after
+                                  <id>, sent like the replay on connect
+  {"type":"search","query":"...","limit":20,"offset":0}
+                                  full-text search in the joined rooms; answered
+                                  with {"type":"search_results","hits":[...],"next_offset":...}
+  {"type":"range","room":"dev","start":<ms>,"end":<ms>,"limit":100}
+                                  messages with start <= timestamp < end (epoch ms or
+                                  ISO 8601, either side optional), oldest first, to jump
+                                  to a date; answered with
+                                  {"type":"range_results","messages":[...],"more":bool}
+  {"type":"archive","room":"dev","start":...,"end":...,"limit":100}
+                                  the same over messages moved to the archive by
+                                  retention (slow: decompresses segments); answered with
+                                  {"type":"archive_results",...}
+  {"type":"typing","room":"dev","sender":"alice","peer":"<id>","typing":true}
+  {"type":"presence","room":"dev","sender":"alice","peer":"<id>","status":"online"|"away"|"offline"}
+                                  ephemeral: relayed to the room, never stored or
+                                  acked, coalesced per sender (see ephemeral.py); a
+                                  client that announced presence is reported
+                                  "offline" when it disconnects. "peer" identifies
+                                  the client (names may repeat); the server fills
+                                  it in when it is missing
+  {"type":"upload_start","sha256":...,"size":n}
+                                  start/resume an attachment upload; answered with
+                                  {"type":"upload_ready","offset":k} (send chunks from k)
+                                  or {"type":"upload_done"} when the blob is already stored
+  {"type":"download","sha256":...,"offset":0,"length":n}
+                                  stream a stored attachment as chunk frames,
+                                  followed by {"type":"download_end"}
+Attachment bytes travel as binary chunk frames (see blobstore.py); chat
+messages refer to them as "attachment": "sha256:<hex>".
+
+History replay is controlled by the query string of the connect URI:
+  ws://host:8765/?rooms=a,b    rooms to join on connect (default "general")
+  ws://host:8765/?since=<id>   messages newer than <id>, oldest first (up to `limit`,
+                               default SINCE_LIMIT)
+  ws://host:8765/?limit=<n>    the latest <n> messages per room (default HISTORY_LIMIT)
+Each room's backlog is sent as a few {"type":"history","room":...,"messages":[...]}
+frames and terminated by {"type":"history_end","room":...,"last_id":<id>,"more":bool}.
+"more" is true when the page was full; a client catching up with since=
+requests the rest with {"type":"history","since":<last_id>} until it is false.
+Recent history is served from an in-memory ring buffer (see history.py);
+only older requests read the database.
+
+Stored messages are broadcast with their storage "id" and "timestamp"
+(integer milliseconds since the Unix epoch, UTC). The
+sender gets {"type":"ack","id":...,"timestamp":...,"client_msg_id":...}
+echoing the "client_msg_id" it put in the message, so it learns the id
+too. Ids only grow, so a reconnecting client passes the highest id it has
+seen as ?since=<id> and receives only what it missed. A message re-sent
+with a client_msg_id the server already stored (a client flushing its
+offline outbox after a lost ack) is acked again but not stored or
+broadcast twice. Clients may send several chat messages in one
+{"type":"batch","messages":[...]} frame. A message whose "sender", "text",
+"room", "attachment" or "client_msg_id" is not a string (or null) is
+answered with {"type":"error","request":"message","error":...} and neither
+stored nor broadcast.
+
+Wire format is negotiated with the WebSocket subprotocol (see codec.py):
+"pychat.msgpack.v1" (binary MessagePack with short keys) or plain JSON for
+clients that offer nothing. permessage-deflate is enabled unless
+--no-deflate is given.
+
+Each client has its own bounded outbound queue (see connection.py); a client
+that falls behind may receive queued messages merged into one
+{"type":"batch","messages":[...]} frame.
+
+Incoming frames pass per-client and per-process token buckets (messages/s
+and bytes/s, see ratelimit.py). A client over its limit is not disconnected;
+its frames are read more slowly, so the excess waits in its own socket
+buffer. Frames larger than --max-frame-kb close the connection (code 1009).
+
+Persistence is write-behind by default: messages are queued and committed in
+groups (see --commit-window-ms), so broadcasting never waits for the disk.
+The queue is flushed on shutdown (SIGTERM / Ctrl+C).
+
+With --workers N (Linux) the server runs N worker processes that share the
+listening port via SO_REUSEPORT. Workers publish incoming messages to a
+Unix-domain socket hub in the supervisor process (see bus.py), which is the
+single persistence writer and delivers every message back to all workers.
+
+With --retention-days and/or --retention-rows, a background job in the
+process that writes the database moves expired messages into compressed
+monthly segments under --archive-dir (see archive.py) every
+--retention-interval seconds and returns the freed pages with an
+incremental VACUUM.
+
+Latency histograms, throughput counters and queue depths are served in the
+Prometheus text format on http://127.0.0.1:9108/metrics (see metrics.py and
+--metrics-port). In multi-process mode the supervisor uses that port and
+worker N uses port + 1 + N.
 """
+import argparse
 import asyncio
 import json
 import logging
-from typing import Set
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+from urllib.parse import parse_qs, urlsplit
 
 import websockets
-from websockets.exceptions import ConnectionClosedOK
+from websockets.exceptions import ConnectionClosed, ConnectionClosedError, ConnectionClosedOK
 
-from .storage import Storage
+from . import codec, metrics
+from .archive import Archive, run_retention
+from .blobstore import BlobStore, UploadError, is_chunk_frame, is_digest, pack_chunk, unpack_chunk
+from .bus import BusClient, BusHub
+from .connection import KIND_CONTROL, KIND_EPHEMERAL, KIND_MESSAGE, Connection, POLICIES
+from .ephemeral import EPHEMERAL_TYPES, Coalescer, normalize
+from .history import HotHistory
+from .ratelimit import RateLimit, Throttle
+from .storage import DEFAULT_ROOM, Storage, now_ms, to_epoch_ms
 
 
-CONNECTED: Set[websockets.WebSocketServerProtocol] = set()
+CONNECTED: Dict[websockets.WebSocketServerProtocol, Connection] = {}
+# Connection.id -> connection, to route acks for messages that came back over the bus
+CONNECTIONS_BY_ID: Dict[int, Connection] = {}
+# room name -> connections subscribed to it
+ROOMS: Dict[str, Set[Connection]] = {}
 STORAGE: Storage | None = None
+# Set in worker processes of the multi-process mode
+BUS: BusClient | None = None
+HOT: HotHistory | None = None
+BLOBS: BlobStore | None = None
+ARCHIVE: Archive | None = None
+# shared by every connection of this process (see ratelimit.py)
+GLOBAL_LIMIT: RateLimit | None = None
+
+# Per-connection outbound queue (see connection.py)
+OUTBOUND_QUEUE_SIZE = 256
+OUTBOUND_POLICY = "drop_oldest"
+LAGGARD_CHECK_INTERVAL = 10.0
+
+# Ingress limits (0 = unlimited). A batch frame counts as one message per entry.
+CLIENT_MSG_RATE = 50.0
+CLIENT_BYTE_RATE = 2 * 1024 * 1024
+GLOBAL_MSG_RATE = 5000.0
+GLOBAL_BYTE_RATE = 64 * 1024 * 1024
+MAX_FRAME_BYTES = 1024 * 1024
+# frames websockets buffers per connection before it stops reading the socket
+INGRESS_QUEUE = 4
+# chat message fields stored as TEXT: anything but a string (or null) is refused
+STRING_FIELDS = ("sender", "text", "room", "attachment", "client_msg_id")
+
+# History replay defaults (see module docstring)
+HISTORY_LIMIT = 200
+HISTORY_MAX_LIMIT = 5000
+# default page size of since= requests (they must not be cut to the "latest N")
+SINCE_LIMIT = HISTORY_MAX_LIMIT
+HISTORY_BATCH = 100
+HISTORY_CACHE_SIZE = 5000
+MAX_ROOMS_PER_CLIENT = 50
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+ATTACHMENTS_DIR = "server_attachments"
+MAX_ATTACHMENT_MB = 20
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+ARCHIVE_DIR = "server_archive"
+RETENTION_INTERVAL = 3600.0
+ARCHIVE_MAX_LIMIT = 1000
+
+
+def _parse_history_request(path: str) -> tuple[List[str], Optional[int], int]:
+    """Return (rooms, since_id, limit) from the connect URI query string."""
+    qs = parse_qs(urlsplit(path or "").query)
+
+    def _int(name: str) -> Optional[int]:
+        try:
+            return int(qs[name][0])
+        except (KeyError, IndexError, ValueError):
+            return None
+
+    since_id = _int("since")
+    limit = _int("limit")
+    if limit is None:
+        limit = SINCE_LIMIT if since_id is not None else HISTORY_LIMIT
+    limit = max(0, min(limit, HISTORY_MAX_LIMIT))
+    rooms = [r for r in ",".join(qs.get("rooms", [])).split(",") if r] or [DEFAULT_ROOM]
+    return rooms[:MAX_ROOMS_PER_CLIENT], since_id, limit
+
+
+def join_room(conn: Connection, room: str) -> bool:
+    if room in conn.rooms or len(conn.rooms) >= MAX_ROOMS_PER_CLIENT:
+        return False
+    conn.rooms.add(room)
+    ROOMS.setdefault(room, set()).add(conn)
+    return True
+
+
+def leave_room(conn: Connection, room: str) -> None:
+    conn.rooms.discard(room)
+    members = ROOMS.get(room)
+    if members is not None:
+        members.discard(conn)
+        if not members:
+            del ROOMS[room]
+
+
+async def _history_rows(room: str, since_id: Optional[int], limit: int):
+    """Yield (row, json) of the requested backlog, from the ring buffer if possible.
+
+    json is the pre-serialized row when it comes from the ring, else None.
+    """
+    cached = HOT.query(room, since_id, limit) if HOT is not None else None
+    if cached is not None:
+        for entry in cached:
+            yield entry
+        return
+    if STORAGE is not None:
+        async for m in STORAGE.iter_messages(since_id=since_id, limit=limit, room=room):
+            yield m, None
+
+
+async def send_history(conn: Connection, room: str, since_id: Optional[int], limit: int) -> None:
+    """Stream the requested backlog of `room` to `conn` in batched frames."""
+    as_json = conn.codec is codec.JSON
+    head = '{"type":"history","room":' + json.dumps(room, ensure_ascii=False) + ',"messages":['
+    batch: list = []
+    last_id = since_id
+    count = 0
+
+    async def flush() -> None:
+        if as_json:
+            # splice the cached JSON instead of re-encoding every row
+            await conn.ws.send(head + ",".join(batch) + "]}")
+        else:
+            await conn.send({"type": "history", "room": room, "messages": batch})
+
+    t0 = time.perf_counter()
+    if limit:
+        async for row, payload in _history_rows(room, since_id, limit):
+            if as_json:
+                batch.append(payload if payload is not None else json.dumps(row, ensure_ascii=False))
+            else:
+                batch.append(row)
+            last_id = row["id"]
+            count += 1
+            if len(batch) >= HISTORY_BATCH:
+                await flush()
+                batch = []
+    if batch:
+        await flush()
+    # a full page of a since= request may not be the whole backlog
+    more = since_id is not None and limit > 0 and count >= limit
+    await conn.send({"type": "history_end", "room": room, "last_id": last_id, "more": more})
+    metrics.HISTORY_REPLAY_SECONDS.observe(time.perf_counter() - t0)
+
+
+async def _on_join(conn: Connection, data: dict) -> None:
+    room = str(data.get("room") or "")
+    if not room or not join_room(conn, room):
+        await conn.send({"type": "error", "request": "join", "room": room})
+        return
+    await conn.send({"type": "joined", "room": room})
+    await send_history(conn, room, None, HISTORY_LIMIT)
+
+
+async def _on_history(conn: Connection, data: dict) -> None:
+    room = data.get("room") or DEFAULT_ROOM
+    if room not in conn.rooms:
+        await conn.send({"type": "error", "request": "history", "room": room, "error": "not joined"})
+        return
+    try:
+        since_id = int(data["since"])
+        limit = max(1, min(int(data.get("limit", SINCE_LIMIT)), HISTORY_MAX_LIMIT))
+    except (KeyError, TypeError, ValueError, OverflowError):
+        await conn.send({"type": "error", "request": "history", "room": room, "error": "since required"})
+        return
+    await send_history(conn, room, since_id, limit)
+
+
+async def _on_leave(conn: Connection, data: dict) -> None:
+    room = str(data.get("room") or "")
+    leave_room(conn, room)
+    await conn.send({"type": "left", "room": room})
+
+
+async def _on_search(conn: Connection, data: dict) -> None:
+    query = str(data.get("query") or "")
+    try:
+        limit = max(1, min(int(data.get("limit", SEARCH_LIMIT)), SEARCH_MAX_LIMIT))
+        offset = max(0, int(data.get("offset", 0)))
+    except (TypeError, ValueError, OverflowError):
+        limit, offset = SEARCH_LIMIT, 0
+    room = data.get("room")
+    rooms = [room] if room in conn.rooms else sorted(conn.rooms)
+    hits = await STORAGE.search(query, limit=limit, offset=offset, rooms=rooms) if STORAGE is not None else []
+    reply = {
+        "type": "search_results",
+        "query": query,
+        "offset": offset,
+        "hits": hits,
+        "next_offset": offset + len(hits) if len(hits) == limit else None,
+    }
+    await conn.send(reply)
+
+
+async def _on_range(conn: Connection, data: dict) -> None:
+    room = data.get("room") or DEFAULT_ROOM
+    if room not in conn.rooms:
+        await conn.send({"type": "error", "request": "range", "room": room, "error": "not joined"})
+        return
+    try:
+        limit = max(1, min(int(data.get("limit", HISTORY_BATCH)), HISTORY_MAX_LIMIT))
+        start, end = to_epoch_ms(data.get("start")), to_epoch_ms(data.get("end"))
+    except (TypeError, ValueError, OverflowError) as e:
+        await conn.send({"type": "error", "request": "range", "room": room, "error": str(e)})
+        return
+    # one extra row tells whether the range holds more than `limit`
+    rows = await STORAGE.get_messages_between(start, end, limit=limit + 1, room=room) if STORAGE is not None else []
+    reply = {
+        "type": "range_results",
+        "room": room,
+        "start": start,
+        "end": end,
+        "messages": rows[:limit],
+        "more": len(rows) > limit,
+    }
+    await conn.send(reply)
+
+
+async def _on_archive(conn: Connection, data: dict) -> None:
+    """Like "range", but over the messages retention moved out of the database (slow)."""
+    room = data.get("room") or DEFAULT_ROOM
+    if room not in conn.rooms:
+        await conn.send({"type": "error", "request": "archive", "room": room, "error": "not joined"})
+        return
+    try:
+        limit = max(1, min(int(data.get("limit", HISTORY_BATCH)), ARCHIVE_MAX_LIMIT))
+        start, end = to_epoch_ms(data.get("start")), to_epoch_ms(data.get("end"))
+    except (TypeError, ValueError, OverflowError) as e:
+        await conn.send({"type": "error", "request": "archive", "room": room, "error": str(e)})
+        return
+    rows = []
+    if ARCHIVE is not None:
+        # decompressing segments blocks; keep it off the event loop
+        rows = await asyncio.get_running_loop().run_in_executor(None, ARCHIVE.query, start, end, room, limit + 1)
+    reply = {
+        "type": "archive_results",
+        "room": room,
+        "start": start,
+        "end": end,
+        "messages": rows[:limit],
+        "more": len(rows) > limit,
+    }
+    await conn.send(reply)
+
+
+async def _on_upload_start(conn: Connection, data: dict) -> None:
+    sha = str(data.get("sha256") or "")
+    try:
+        if BLOBS is None:
+            raise UploadError("attachments are disabled")
+        size = int(data.get("size", -1))
+        offset = BLOBS.begin_upload(sha, size)
+        if offset >= size and BLOBS.size(sha) is None:
+            # every byte arrived before; only the check is missing
+            await BLOBS.finish(sha)
+    except (UploadError, TypeError, ValueError, OverflowError) as e:
+        await conn.send({"type": "error", "request": "upload_start", "sha256": sha, "error": str(e)})
+        return
+    stored = BLOBS.size(sha)
+    if stored is not None:
+        await conn.send({"type": "upload_done", "sha256": sha, "size": stored})
+    else:
+        await conn.send({"type": "upload_ready", "sha256": sha, "offset": offset})
+
+
+async def _on_chunk(conn: Connection, frame: bytes) -> None:
+    sha, offset, chunk = unpack_chunk(frame)
+    try:
+        if BLOBS is None:
+            raise UploadError("attachments are disabled")
+        have, complete = BLOBS.write_chunk(sha, offset, chunk)
+        if complete:
+            await BLOBS.finish(sha)
+    except UploadError as e:
+        await conn.send({"type": "error", "request": "upload", "sha256": sha, "error": str(e)})
+        return
+    if complete:
+        await conn.send({"type": "upload_done", "sha256": sha, "size": have})
+    elif have != offset + len(chunk):
+        # out of sequence: tell the sender where to continue
+        await conn.send({"type": "upload_ready", "sha256": sha, "offset": have})
+
+
+async def _on_download(conn: Connection, data: dict) -> None:
+    sha = str(data.get("sha256") or "")
+    size = BLOBS.size(sha) if BLOBS is not None and is_digest(sha) else None
+    if size is None:
+        await conn.send({"type": "error", "request": "download", "sha256": sha, "error": "not found"})
+        return
+    try:
+        offset = max(0, int(data.get("offset", 0)))
+        length = int(data["length"]) if data.get("length") is not None else None
+    except (TypeError, ValueError, OverflowError):
+        offset, length = 0, None
+    # one chunk in memory at a time; ws.send waits for the socket to drain
+    for pos, chunk in BLOBS.read_range(sha, offset, length):
+        await conn.ws.send(pack_chunk(sha, pos, chunk))
+    await conn.send({"type": "download_end", "sha256": sha, "size": size})
+
+
+async def _on_message(conn: Connection, data: dict) -> None:
+    error = _message_error(data)
+    if error is not None:
+        client_msg_id = data.get("client_msg_id")
+        reply = {"type": "error", "request": "message", "error": error}
+        if isinstance(client_msg_id, str):
+            reply["client_msg_id"] = client_msg_id
+        await conn.send(reply)
+        return
+    room = data.get("room") or DEFAULT_ROOM
+    if room not in conn.rooms:
+        await conn.send({"type": "error", "request": "message", "room": room, "error": "not joined"})
+        return
+    data["room"] = room
+    metrics.MESSAGES_IN.inc()
+    await publish(conn, data)
+
+
+async def _on_ephemeral(conn: Connection, data: dict) -> None:
+    """Typing/presence: relayed (coalesced) to the room, never stored, no reply."""
+    room = data.get("room") or DEFAULT_ROOM
+    if room not in conn.rooms:
+        return
+    frame = normalize(dict(data, room=room))
+    if frame is None:
+        return
+    if "peer" not in frame:
+        # unique per process, and the worker number keeps it unique across workers
+        frame["peer"] = f"conn-{BUS.worker_id}-{conn.id}" if BUS is not None else f"conn-{conn.id}"
+    if frame["type"] == "presence":
+        online = frame["status"] != "offline"
+        conn.presence_sender = frame["sender"] if online else None
+        conn.presence_peer = frame["peer"] if online else None
+    EPHEMERAL.offer((room, frame["type"], conn.id), frame, conn.id)
+
+
+def _relay_ephemeral(frame: dict, sender_id: Optional[int]) -> None:
+    if BUS is not None:
+        BUS.publish_ephemeral(frame, conn_id=sender_id)
+    else:
+        broadcast(frame, sender_id=sender_id, kind=KIND_EPHEMERAL)
+
+
+# the latest typing/presence state per (room, type, connection), flushed every window
+EPHEMERAL = Coalescer(_relay_ephemeral)
+
+
+def _announce_offline(conn: Connection) -> None:
+    if conn.presence_sender is None:
+        return
+    for room in conn.rooms:
+        frame = {"type": "presence", "room": room, "sender": conn.presence_sender, "peer": conn.presence_peer, "status": "offline"}
+        EPHEMERAL.offer((room, "presence", conn.id), frame, conn.id)
+
+
+async def _on_batch(conn: Connection, data: dict) -> None:
+    """Several chat messages in one frame (a client flushing its outbox); each is acked."""
+    messages = data.get("messages")
+    if not isinstance(messages, list):
+        await conn.send({"type": "error", "request": "batch", "error": "messages must be a list"})
+        return
+    for msg in messages:
+        if isinstance(msg, dict) and msg.get("type", "message") == "message":
+            await _on_message(conn, msg)
+            # the acks go through the sender's own queue: let it drain rather than overflow
+            if conn.depth >= conn.maxsize // 2:
+                await conn.drain()
+
+
+# Request frames ({"type": ...}) other than chat messages
+REQUEST_HANDLERS: Dict[str, Callable[[Connection, dict], Awaitable[None]]] = {
+    "batch": _on_batch,
+    "join": _on_join,
+    "leave": _on_leave,
+    "history": _on_history,
+    "search": _on_search,
+    "range": _on_range,
+    "archive": _on_archive,
+    "upload_start": _on_upload_start,
+    "download": _on_download,
+    **{kind: _on_ephemeral for kind in EPHEMERAL_TYPES},
+}
 
 
 async def handler(ws: websockets.WebSocketServerProtocol, path: str):
     logging.info("Client connected: %s", ws.remote_address)
-    CONNECTED.add(ws)
+    throttle = Throttle(RateLimit(CLIENT_MSG_RATE, CLIENT_BYTE_RATE), GLOBAL_LIMIT)
+    conn = Connection(
+        ws,
+        maxsize=OUTBOUND_QUEUE_SIZE,
+        policy=OUTBOUND_POLICY,
+        codec=codec.for_subprotocol(ws.subprotocol),
+        throttle=throttle,
+    )
+    conn.start()
+    CONNECTED[ws] = conn
+    CONNECTIONS_BY_ID[conn.id] = conn
 
-    # On new connection, send recent history
+    # On new connection, join the requested rooms and send their recent history
     try:
-        if STORAGE is not None:
-            try:
-                msgs = await STORAGE.get_messages()
-                for m in msgs:
-                    try:
-                        await ws.send(json.dumps(m, ensure_ascii=False))
-                    except Exception:
-                        # ignore send errors to the new client
-                        pass
-            except Exception:
-                logging.exception("Failed to load/send history")
+        rooms, since_id, limit = _parse_history_request(path)
+        for room in rooms:
+            join_room(conn, room)
+        try:
+            for room in rooms:
+                await send_history(conn, room, since_id, limit)
+        except ConnectionClosed:
+            raise
+        except Exception:
+            logging.exception("Failed to load/send history")
 
         async for raw in ws:
-            # Accept either raw text or JSON
+            if is_chunk_frame(raw):
+                await throttle.admit(0, len(raw))
+                await _on_chunk(conn, raw)
+                continue
+            # Accept raw text, JSON or MessagePack
+            t0 = time.perf_counter()
             try:
-                data = json.loads(raw)
+                data = codec.decode_frame(raw)
             except Exception:
+                if not isinstance(raw, str):
+                    continue
                 data = {"sender": "unknown", "text": raw}
+            metrics.PARSE_SECONDS.observe(time.perf_counter() - t0)
+            if not isinstance(data, dict):
+                data = {"sender": "unknown", "text": str(data)}
 
-            # Persist message
-            try:
-                if STORAGE is not None:
-                    # store with provided timestamp if present
-                    ts = data.get("timestamp")
-                    attachment = data.get("attachment")
-                    await STORAGE.add_message(data.get("sender", "unknown"), data.get("text", ""), timestamp=ts, attachment=attachment)
-            except Exception:
-                logging.exception("Failed to persist message")
-
-            # Broadcast to other clients
-            await broadcast(data, sender_ws=ws)
+            kind = data.get("type", "message")
+            messages = data.get("messages")
+            # wait here (not reading the socket) while the client is over its limits
+            await throttle.admit(len(messages) if kind == "batch" and isinstance(messages, list) else 1, len(raw))
+            if kind != "message":
+                request_handler = REQUEST_HANDLERS.get(kind)
+                if request_handler is None:
+                    await conn.send({"type": "error", "request": kind, "error": "unknown request"})
+                else:
+                    await request_handler(conn, data)
+                continue
+            await _on_message(conn, data)
     except ConnectionClosedOK:
         pass
+    except ConnectionClosedError as e:
+        if e.sent is not None and e.sent.code == 1009:
+            throttle.rejected += 1
+            metrics.FRAMES_REJECTED.inc()
+            logging.warning("Closing client %s: frame larger than %d bytes", ws.remote_address, MAX_FRAME_BYTES)
+        else:
+            logging.info("Connection closed with error: %s", e)
     except Exception as e:
         logging.exception("Error in connection: %s", e)
     finally:
-        CONNECTED.discard(ws)
+        CONNECTED.pop(ws, None)
+        CONNECTIONS_BY_ID.pop(conn.id, None)
+        _announce_offline(conn)
+        for room in list(conn.rooms):
+            leave_room(conn, room)
+        await conn.close()
         logging.info("Client disconnected: %s", ws.remote_address)
 
 
-async def broadcast(data: dict, sender_ws: websockets.WebSocketServerProtocol | None = None) -> None:
-    payload = json.dumps(data, ensure_ascii=False)
-    if not CONNECTED:
+def _timestamp(value) -> int:
+    """Epoch ms of a client-supplied timestamp (ms or ISO 8601), else the current time.
+
+    Timestamps that are not valid or out of range (see to_epoch_ms) get the
+    current time too, so nothing unstorable reaches the write-behind queue.
+    """
+    try:
+        ts = to_epoch_ms(value)
+    except (ValueError, OverflowError):
+        ts = None
+    return ts if ts is not None else now_ms()
+
+
+def _message_error(data: dict) -> Optional[str]:
+    """Why a chat frame can't be stored as it is (None if it can)."""
+    for field in STRING_FIELDS:
+        value = data.get(field)
+        if value is not None and not isinstance(value, str):
+            return f"{field} must be a string"
+    return None
+
+
+def _history_row(data: dict) -> dict:
+    """The stored form of a chat message (the columns of the messages table)."""
+    return {
+        "id": data.get("id"),
+        "sender": data.get("sender", "unknown"),
+        "text": data.get("text", ""),
+        # store with provided timestamp if present
+        "timestamp": _timestamp(data.get("timestamp")),
+        "attachment": data.get("attachment"),
+        "room": data.get("room") or DEFAULT_ROOM,
+    }
+
+
+async def persist_message(data: dict) -> Optional[dict]:
+    """Store a chat message and stamp it with its id and timestamp.
+
+    Returns the stored row (None if it could not be stored). A message whose
+    client_msg_id was already stored is stamped with the stored id, marked
+    "duplicate" and not stored again.
+    """
+    if STORAGE is None:
+        return None
+    prior = STORAGE.find_client_msg(data.get("client_msg_id"))
+    if prior is not None:
+        # re-sent after a reconnect: acknowledge the stored copy instead of storing it twice
+        data.update(prior, duplicate=True)
+        return None
+    row = _history_row(data)
+    t0 = time.perf_counter()
+    try:
+        row["id"] = await STORAGE.add_message(
+            row["sender"],
+            row["text"],
+            timestamp=row["timestamp"],
+            attachment=row["attachment"],
+            room=row["room"],
+            client_msg_id=data.get("client_msg_id"),
+        )
+    except Exception:
+        logging.exception("Failed to persist message")
+        return None
+    metrics.PERSIST_SECONDS.observe(time.perf_counter() - t0)
+    data["id"] = row["id"]
+    data["timestamp"] = row["timestamp"]
+    return row
+
+
+async def publish(conn: Connection, data: dict) -> None:
+    """Persist a chat message from `conn` and fan it out to its room."""
+    if BUS is not None:
+        # the supervisor persists it and delivers it back to every worker
+        BUS.publish(data, conn_id=conn.id)
+        return
+    row = await persist_message(data)
+    if data.get("duplicate"):
+        ack(conn, data)
+        return
+    if row is not None and HOT is not None:
+        HOT.append(row)
+    # Broadcast to the other room members (only enqueues; never waits for them)
+    broadcast(data, sender_id=conn.id)
+    ack(conn, data)
+
+
+def ack(conn: Connection, data: dict) -> None:
+    """Tell the sender the id and timestamp its message was stored with."""
+    if data.get("id") is None:
         return
-    coros = [c.send(payload) for c in CONNECTED if c != sender_ws]
-    if not coros:
+    reply = {
+        "type": "ack",
+        "id": data["id"],
+        "timestamp": data.get("timestamp"),
+        "room": data.get("room") or DEFAULT_ROOM,
+        "client_msg_id": data.get("client_msg_id"),
+    }
+    # queued behind earlier broadcasts so the client sees them in id order
+    conn.enqueue(conn.codec.encode(reply), KIND_CONTROL)
+
+
+def broadcast(data: dict, sender_id: Optional[int] = None, kind: str = KIND_MESSAGE) -> None:
+    """Enqueue `data` for every member of its room except the sender."""
+    members = ROOMS.get(data.get("room") or DEFAULT_ROOM)
+    if not members:
         return
-    results = await asyncio.gather(*coros, return_exceptions=True)
-    # Log exceptions
-    for r in results:
-        if isinstance(r, Exception):
-            logging.debug("Broadcast send error: %s", r)
+    t0 = time.perf_counter()
+    # encode once per wire format, not once per client
+    payloads: Dict[str, codec.Payload] = {}
+    for conn in members:
+        if conn.id != sender_id:
+            payload = payloads.get(conn.codec.name)
+            if payload is None:
+                payload = payloads[conn.codec.name] = conn.codec.encode(data)
+            conn.enqueue(payload, kind)
+    metrics.BROADCAST_SECONDS.observe(time.perf_counter() - t0)
+
+
+def _on_bus_deliver(frame: dict) -> None:
+    msg = frame["msg"]
+    sender_id = frame.get("conn") if BUS is not None and frame.get("worker") == BUS.worker_id else None
+    sender = CONNECTIONS_BY_ID.get(sender_id) if sender_id is not None else None
+    if msg.get("duplicate"):
+        # already delivered once; only the sender is waiting for its ack
+        if sender is not None:
+            ack(sender, msg)
+        return
+    if HOT is not None and msg.get("id") is not None:
+        HOT.append(_history_row(msg))
+    # only the worker that received the message knows (and skips) its sender
+    broadcast(msg, sender_id=sender_id)
+    if sender is not None:
+        ack(sender, msg)
+
+
+def _on_bus_ephemeral(frame: dict) -> None:
+    sender_id = frame.get("conn") if BUS is not None and frame.get("worker") == BUS.worker_id else None
+    broadcast(frame["msg"], sender_id=sender_id, kind=KIND_EPHEMERAL)
+
+
+def client_stats() -> List[Dict]:
+    """Outbound queue depth and counters for every connected client."""
+    return [conn.stats() for conn in CONNECTED.values()]
+
+
+metrics.REGISTRY.gauge("pychat_connections", "Open WebSocket connections", lambda: len(CONNECTED))
+metrics.REGISTRY.gauge("pychat_rooms", "Rooms with at least one member", lambda: len(ROOMS))
+metrics.REGISTRY.gauge(
+    "pychat_outbound_queue_depth", "Frames waiting in client send queues", lambda: sum(c.depth for c in CONNECTED.values())
+)
+metrics.REGISTRY.gauge(
+    "pychat_outbound_dropped", "Frames dropped by open connections' overflow policy", lambda: sum(c.dropped for c in CONNECTED.values())
+)
+metrics.REGISTRY.gauge(
+    "pychat_ephemeral_dropped",
+    "Typing/presence frames open connections dropped under congestion",
+    lambda: sum(c.ephemeral_dropped for c in CONNECTED.values()),
+)
+metrics.REGISTRY.gauge(
+    "pychat_throttled_connections", "Connections whose reads are paused by a rate limit", lambda: sum(c.throttle.throttled for c in CONNECTED.values())
+)
+metrics.REGISTRY.gauge("pychat_write_backlog", "Messages queued for the database but not committed", lambda: STORAGE.backlog if STORAGE else 0)
+metrics.REGISTRY.gauge(
+    "pychat_history_cache_hits_total", "History requests answered from memory", lambda: HOT.hits if HOT else 0, kind="counter"
+)
+metrics.REGISTRY.gauge(
+    "pychat_history_cache_misses_total", "History requests that read the database", lambda: HOT.misses if HOT else 0, kind="counter"
+)
+
+
+def server_stats() -> Dict:
+    return {
+        "clients": client_stats(),
+        "history_cache": HOT.stats() if HOT is not None else None,
+        "global_limit": _limit_stats(GLOBAL_LIMIT),
+        "ephemeral": EPHEMERAL.stats(),
+    }
 
 
-async def main_async(host: str = "0.0.0.0", port: int = 8765):
-    global STORAGE
+def _limit_stats(limit: Optional[RateLimit]) -> Optional[Dict]:
+    if limit is None or not limit.enabled:
+        return None
+    return {
+        "msg_rate": limit.msg_rate,
+        "byte_rate": limit.byte_rate,
+        "msg_tokens": round(limit.messages.tokens, 1) if limit.messages is not None else None,
+        "byte_tokens": round(limit.bytes.tokens) if limit.bytes is not None else None,
+    }
+
+
+async def report_laggards(interval: float = LAGGARD_CHECK_INTERVAL) -> None:
+    """Periodically log clients whose outbound queue is more than half full."""
+    last_cache = None
+    while True:
+        await asyncio.sleep(interval)
+        for st in client_stats():
+            if st["depth"] > OUTBOUND_QUEUE_SIZE // 2 or st["dropped"]:
+                logging.warning("Slow client: %s", st)
+            elif st["throttled"]:
+                logging.warning("Throttled client: %s", st)
+        if HOT is not None:
+            cache = (HOT.hits, HOT.misses)
+            if cache != last_cache:
+                logging.info("History cache: %s", HOT.stats())
+                last_cache = cache
+
+
+async def _start_retention(
+    retention_days: Optional[float], retention_rows: Optional[int], interval: float
+) -> Optional[asyncio.Task]:
+    if retention_days is None and retention_rows is None:
+        return None
+    assert STORAGE is not None and ARCHIVE is not None
+    logging.info("Retention: max age %s days, max rows %s, archive %s", retention_days, retention_rows, ARCHIVE.root)
+    await STORAGE.enable_incremental_vacuum()
+    on_archived = HOT.discard if HOT is not None else None
+    return asyncio.create_task(run_retention(STORAGE, ARCHIVE, retention_days, retention_rows, interval, on_archived))
+
+
+async def main_async(
+    host: str = "0.0.0.0",
+    port: int = 8765,
+    db_path: str = "server_chat_history.db",
+    commit_window: float = 0.05,
+    commit_batch: int = 500,
+    send_queue: int = OUTBOUND_QUEUE_SIZE,
+    overflow_policy: str = OUTBOUND_POLICY,
+    history_cache: int = HISTORY_CACHE_SIZE,
+    deflate: bool = True,
+    attachments_dir: str = ATTACHMENTS_DIR,
+    max_attachment_mb: float = MAX_ATTACHMENT_MB,
+    metrics_host: str = METRICS_HOST,
+    metrics_port: int = METRICS_PORT,
+    archive_dir: str = ARCHIVE_DIR,
+    retention_days: Optional[float] = None,
+    retention_rows: Optional[int] = None,
+    retention_interval: float = RETENTION_INTERVAL,
+    client_msg_rate: float = CLIENT_MSG_RATE,
+    client_byte_rate: float = CLIENT_BYTE_RATE,
+    global_msg_rate: float = GLOBAL_MSG_RATE,
+    global_byte_rate: float = GLOBAL_BYTE_RATE,
+    max_frame_bytes: int = MAX_FRAME_BYTES,
+):
+    global STORAGE, HOT, BLOBS, ARCHIVE, OUTBOUND_QUEUE_SIZE, OUTBOUND_POLICY
+    OUTBOUND_QUEUE_SIZE = send_queue
+    OUTBOUND_POLICY = overflow_policy
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
-    STORAGE = Storage("server_chat_history.db")
+    _set_limits(client_msg_rate, client_byte_rate, global_msg_rate, global_byte_rate, max_frame_bytes)
+    STORAGE = Storage(db_path, commit_window=commit_window, commit_batch=commit_batch)
     await STORAGE.init()
+    if history_cache > 0:
+        HOT = HotHistory(history_cache)
+        await HOT.warm(STORAGE)
+    BLOBS = BlobStore(attachments_dir, max_size=int(max_attachment_mb * 1024 * 1024))
+    ARCHIVE = Archive(archive_dir)
+    retention = await _start_retention(retention_days, retention_rows, retention_interval)
+    stop = _stop_on_sigterm()
     logging.info("Starting PyChat server on %s:%s", host, port)
-    async with websockets.serve(handler, host, port):
-        await asyncio.Future()  # run forever
+    laggards = asyncio.create_task(report_laggards())
+    metrics_server = await metrics.serve_metrics(metrics_host, metrics_port) if metrics_port else None
+    try:
+        async with websockets.serve(handler, host, port, **_serve_options(deflate)):
+            await stop  # run until SIGTERM (or Ctrl+C cancels us)
+    finally:
+        laggards.cancel()
+        EPHEMERAL.close()
+        if retention is not None:
+            retention.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        # flush messages still waiting in the write-behind queue
+        await STORAGE.close()
+        logging.info("Storage flushed and closed")
+
+
+def _set_limits(
+    client_msg_rate: float, client_byte_rate: float, global_msg_rate: float, global_byte_rate: float, max_frame_bytes: int
+) -> None:
+    global CLIENT_MSG_RATE, CLIENT_BYTE_RATE, GLOBAL_LIMIT, MAX_FRAME_BYTES
+    CLIENT_MSG_RATE = client_msg_rate
+    CLIENT_BYTE_RATE = client_byte_rate
+    GLOBAL_LIMIT = RateLimit(global_msg_rate, global_byte_rate)
+    MAX_FRAME_BYTES = max_frame_bytes
+    logging.info(
+        "Ingress limits: %s msg/s and %s B/s per client, %s msg/s and %s B/s per process (0 = unlimited), max frame %d B",
+        client_msg_rate,
+        client_byte_rate,
+        global_msg_rate,
+        global_byte_rate,
+        max_frame_bytes,
+    )
+
+
+def _serve_options(deflate: bool) -> dict:
+    return {
+        "subprotocols": codec.SUBPROTOCOLS,
+        "compression": "deflate" if deflate else None,
+        # larger frames close the connection (1009); a short receive queue
+        # makes a throttled handler push back on the client's socket
+        "max_size": MAX_FRAME_BYTES or None,
+        "max_queue": INGRESS_QUEUE,
+    }
+
+
+def _stop_on_sigterm() -> asyncio.Future:
+    stop = asyncio.get_running_loop().create_future()
+
+    def on_sigterm() -> None:
+        # a worker gets SIGTERM twice when the whole process group is signalled
+        # (the supervisor terminates it again), or after its bus link went away
+        if not stop.done():
+            stop.set_result(None)
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, on_sigterm)
+    except (NotImplementedError, RuntimeError):
+        # add_signal_handler is not available on Windows
+        pass
+    return stop
+
+
+async def worker_async(
+    worker_id: int,
+    host: str,
+    port: int,
+    db_path: str,
+    bus_path: str,
+    send_queue: int = OUTBOUND_QUEUE_SIZE,
+    overflow_policy: str = OUTBOUND_POLICY,
+    history_cache: int = HISTORY_CACHE_SIZE,
+    deflate: bool = True,
+    attachments_dir: str = ATTACHMENTS_DIR,
+    max_attachment_mb: float = MAX_ATTACHMENT_MB,
+    metrics_host: str = METRICS_HOST,
+    metrics_port: int = 0,
+    archive_dir: str = ARCHIVE_DIR,
+    client_msg_rate: float = CLIENT_MSG_RATE,
+    client_byte_rate: float = CLIENT_BYTE_RATE,
+    global_msg_rate: float = GLOBAL_MSG_RATE,
+    global_byte_rate: float = GLOBAL_BYTE_RATE,
+    max_frame_bytes: int = MAX_FRAME_BYTES,
+):
+    """One worker of the multi-process mode: serves clients, never writes the DB."""
+    global STORAGE, BUS, HOT, BLOBS, ARCHIVE, OUTBOUND_QUEUE_SIZE, OUTBOUND_POLICY
+    OUTBOUND_QUEUE_SIZE = send_queue
+    OUTBOUND_POLICY = overflow_policy
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s %(levelname)s [worker {worker_id}] %(message)s")
+    _set_limits(client_msg_rate, client_byte_rate, global_msg_rate, global_byte_rate, max_frame_bytes)
+    # history reads only; the supervisor owns all writes
+    STORAGE = Storage(db_path)
+    await STORAGE.init()
+    if history_cache > 0:
+        HOT = HotHistory(history_cache)
+        await HOT.warm(STORAGE)
+    BLOBS = BlobStore(attachments_dir, max_size=int(max_attachment_mb * 1024 * 1024))
+    # archive queries only; the supervisor runs retention
+    ARCHIVE = Archive(archive_dir)
+    BUS = BusClient(bus_path, worker_id)
+    await BUS.connect()
+    stop = _stop_on_sigterm()
+    bus_reader = asyncio.create_task(BUS.run(_on_bus_deliver, _on_bus_ephemeral))
+    bus_reader.add_done_callback(lambda _: stop.done() or stop.set_result(None))
+    laggards = asyncio.create_task(report_laggards())
+    metrics_server = await metrics.serve_metrics(metrics_host, metrics_port) if metrics_port else None
+    try:
+        async with websockets.serve(handler, host, port, reuse_port=True, **_serve_options(deflate)):
+            await stop
+    finally:
+        laggards.cancel()
+        EPHEMERAL.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        bus_reader.cancel()
+        await BUS.close()
+        await STORAGE.close()
+
+
+def _worker_main(worker_id: int, kwargs: dict) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor handles Ctrl+C
+    try:
+        asyncio.run(worker_async(worker_id, **kwargs))
+    except KeyboardInterrupt:
+        pass
+
+
+async def supervisor_async(
+    workers: int,
+    host: str = "0.0.0.0",
+    port: int = 8765,
+    db_path: str = "server_chat_history.db",
+    commit_window: float = 0.05,
+    commit_batch: int = 500,
+    send_queue: int = OUTBOUND_QUEUE_SIZE,
+    overflow_policy: str = OUTBOUND_POLICY,
+    history_cache: int = HISTORY_CACHE_SIZE,
+    deflate: bool = True,
+    attachments_dir: str = ATTACHMENTS_DIR,
+    max_attachment_mb: float = MAX_ATTACHMENT_MB,
+    metrics_host: str = METRICS_HOST,
+    metrics_port: int = METRICS_PORT,
+    archive_dir: str = ARCHIVE_DIR,
+    retention_days: Optional[float] = None,
+    retention_rows: Optional[int] = None,
+    retention_interval: float = RETENTION_INTERVAL,
+    client_msg_rate: float = CLIENT_MSG_RATE,
+    client_byte_rate: float = CLIENT_BYTE_RATE,
+    global_msg_rate: float = GLOBAL_MSG_RATE,
+    global_byte_rate: float = GLOBAL_BYTE_RATE,
+    max_frame_bytes: int = MAX_FRAME_BYTES,
+    bus_path: str | None = None,
+):
+    """Run `workers` server processes plus the bus hub and the single DB writer."""
+    global STORAGE, ARCHIVE
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [supervisor] %(message)s")
+    bus_path = bus_path or os.path.join(tempfile.gettempdir(), f"pychat-bus-{os.getpid()}.sock")
+    STORAGE = Storage(db_path, commit_window=commit_window, commit_batch=commit_batch)
+    await STORAGE.init()
+
+    async def on_publish(msg: dict) -> dict:
+        await persist_message(msg)
+        return msg
+
+    # workers keep their own history caches, so archived rows may stay in them
+    # until they age out of the ring
+    ARCHIVE = Archive(archive_dir)
+    retention = await _start_retention(retention_days, retention_rows, retention_interval)
+    hub = BusHub(bus_path, on_publish)
+    await hub.start()
+    # the supervisor only persists; clients and fan-out are counted by the workers
+    metrics_server = await metrics.serve_metrics(metrics_host, metrics_port) if metrics_port else None
+    stop = _stop_on_sigterm()
+    ctx = multiprocessing.get_context("spawn")
+    worker_kwargs = dict(
+        host=host,
+        port=port,
+        db_path=db_path,
+        bus_path=bus_path,
+        send_queue=send_queue,
+        overflow_policy=overflow_policy,
+        history_cache=history_cache,
+        deflate=deflate,
+        attachments_dir=attachments_dir,
+        max_attachment_mb=max_attachment_mb,
+        metrics_host=metrics_host,
+        archive_dir=archive_dir,
+        client_msg_rate=client_msg_rate,
+        client_byte_rate=client_byte_rate,
+        # each worker enforces its share of the process-wide limit
+        global_msg_rate=global_msg_rate / workers,
+        global_byte_rate=global_byte_rate / workers,
+        max_frame_bytes=max_frame_bytes,
+    )
+    procs: Dict[int, multiprocessing.process.BaseProcess] = {}
+
+    def spawn(worker_id: int) -> None:
+        kwargs = dict(worker_kwargs, metrics_port=metrics_port + 1 + worker_id if metrics_port else 0)
+        proc = ctx.Process(target=_worker_main, args=(worker_id, kwargs), name=f"pychat-worker-{worker_id}", daemon=True)
+        proc.start()
+        procs[worker_id] = proc
+
+    logging.info("Starting PyChat server on %s:%s with %d workers (bus %s)", host, port, workers, bus_path)
+    for worker_id in range(workers):
+        spawn(worker_id)
+    try:
+        while not stop.done():
+            await asyncio.wait([stop], timeout=1.0)
+            for worker_id, proc in list(procs.items()):
+                if not proc.is_alive() and not stop.done():
+                    logging.warning("Worker %d exited (code %s); restarting", worker_id, proc.exitcode)
+                    spawn(worker_id)
+    finally:
+        if retention is not None:
+            retention.cancel()
+        for proc in procs.values():
+            proc.terminate()
+        for proc in procs.values():
+            await asyncio.get_running_loop().run_in_executor(None, proc.join, 5)
+        if metrics_server is not None:
+            metrics_server.close()
+        await hub.close()
+        # flush messages still waiting in the write-behind queue
+        await STORAGE.close()
+        logging.info("Storage flushed and closed")
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="PyChat WebSocket server")
+    p.add_argument("--host", default="0.0.0.0")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--db", default="server_chat_history.db", help="SQLite database path")
+    p.add_argument(
+        "--commit-window-ms",
+        type=float,
+        default=50.0,
+        help="durability window: queued messages are committed at least this often (0 = commit every message synchronously)",
+    )
+    p.add_argument("--commit-batch", type=int, default=500, help="commit early once this many messages are queued")
+    p.add_argument("--send-queue", type=int, default=OUTBOUND_QUEUE_SIZE, help="max queued outbound frames per client")
+    p.add_argument("--overflow-policy", choices=POLICIES, default=OUTBOUND_POLICY, help="what to do when a client's send queue is full")
+    p.add_argument("--history-cache", type=int, default=HISTORY_CACHE_SIZE, help="recent messages kept in memory for history replay (0 = off)")
+    p.add_argument("--attachments-dir", default=ATTACHMENTS_DIR, help="content-addressed attachment store")
+    p.add_argument("--max-attachment-mb", type=float, default=MAX_ATTACHMENT_MB, help="largest accepted attachment")
+    p.add_argument("--metrics-host", default=METRICS_HOST, help="address of the /metrics HTTP endpoint")
+    p.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="port of the Prometheus /metrics endpoint (0 = off; workers use port + 1 + N)",
+    )
+    p.add_argument("--archive-dir", default=ARCHIVE_DIR, help="where retention writes archive segments")
+    p.add_argument("--retention-days", type=float, default=None, help="archive messages older than this many days")
+    p.add_argument("--retention-rows", type=int, default=None, help="keep at most this many messages in the database")
+    p.add_argument(
+        "--retention-interval", type=float, default=RETENTION_INTERVAL, help="seconds between retention runs"
+    )
+    p.add_argument("--client-msg-rate", type=float, default=CLIENT_MSG_RATE, help="messages per second per client (0 = unlimited)")
+    p.add_argument(
+        "--client-kb-rate", type=float, default=CLIENT_BYTE_RATE / 1024, help="incoming KiB per second per client (0 = unlimited)"
+    )
+    p.add_argument(
+        "--global-msg-rate", type=float, default=GLOBAL_MSG_RATE, help="messages per second over all clients (0 = unlimited)"
+    )
+    p.add_argument(
+        "--global-kb-rate", type=float, default=GLOBAL_BYTE_RATE / 1024, help="incoming KiB per second over all clients (0 = unlimited)"
+    )
+    p.add_argument(
+        "--max-frame-kb", type=int, default=MAX_FRAME_BYTES // 1024, help="largest accepted frame (keep above 65 for attachment chunks); larger ones close the connection"
+    )
+    p.add_argument("--no-deflate", action="store_true", help="disable permessage-deflate compression")
+    p.add_argument("--workers", type=int, default=1, help="number of worker processes sharing the port (Linux, SO_REUSEPORT)")
+    p.add_argument("--bus-path", default=None, help="Unix socket path of the worker bus (default: a temp file)")
+    return p
 
 
-def main(host: str = "0.0.0.0", port: int = 8765):
-    asyncio.run(main_async(host, port))
+def main(argv: list[str] | None = None):
+    args = build_arg_parser().parse_args(argv)
+    kwargs = dict(
+        db_path=args.db,
+        commit_window=args.commit_window_ms / 1000.0,
+        commit_batch=args.commit_batch,
+        send_queue=args.send_queue,
+        overflow_policy=args.overflow_policy,
+        history_cache=args.history_cache,
+        deflate=not args.no_deflate,
+        attachments_dir=args.attachments_dir,
+        max_attachment_mb=args.max_attachment_mb,
+        metrics_host=args.metrics_host,
+        metrics_port=args.metrics_port,
+        archive_dir=args.archive_dir,
+        retention_days=args.retention_days,
+        retention_rows=args.retention_rows,
+        retention_interval=args.retention_interval,
+        client_msg_rate=args.client_msg_rate,
+        client_byte_rate=args.client_kb_rate * 1024,
+        global_msg_rate=args.global_msg_rate,
+        global_byte_rate=args.global_kb_rate * 1024,
+        max_frame_bytes=args.max_frame_kb * 1024,
+    )
+    if args.workers > 1:
+        asyncio.run(supervisor_async(args.workers, args.host, args.port, bus_path=args.bus_path, **kwargs))
+    else:
+        asyncio.run(main_async(args.host, args.port, **kwargs))
 
 
 if __name__ == "__main__":
@@ -1,57 +1,1012 @@
 from __future__ import annotations
 
+import asyncio
+import gzip
+import itertools
+import json
+import logging
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import AsyncIterator, Iterable, List, Dict, Optional, Set, TextIO
 import aiosqlite
-from datetime import datetime
+from datetime import datetime, timezone
+
+from .compression import DICTS_SCHEMA, MAX_DICTS, TRAIN_SAMPLES, TextCodec, train
+from .metrics import COMMIT_RETRIES, COMMIT_SECONDS, MESSAGES_REJECTED
+
+DEFAULT_ROOM = "general"
+# How many recent client_msg_ids are remembered to drop retransmitted messages
+DEDUPE_WINDOW = 20_000
+# Backoff between retries of a failed write-behind commit (seconds)
+COMMIT_RETRY_BASE = 0.05
+COMMIT_RETRY_MAX = 5.0
+# Errors caused by a row itself: retrying the same row can never succeed.
+# Anything else (e.g. OperationalError "database is locked") is retried.
+ROW_ERRORS = (
+    sqlite3.IntegrityError,
+    sqlite3.ProgrammingError,
+    sqlite3.InterfaceError,
+    sqlite3.DataError,
+    TypeError,
+    ValueError,
+    OverflowError,
+)
+
+# Full-text index over messages.text, kept in sync by triggers. The trigram
+# tokenizer gives substring matches, which also works for Japanese text
+# (no word boundaries); queries shorter than 3 characters fall back to LIKE.
+FTS_SCHEMA = (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, content='messages', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+)
+# The same index for compressed message text (see compression.py): it reads
+# the text through pychat_text(), directly and via the messages_plain view.
+FTS_SCHEMA_COMPRESSED = (
+    "CREATE VIEW IF NOT EXISTS messages_plain AS SELECT id, pychat_text(text) AS text FROM messages",
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, content='messages_plain', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, pychat_text(new.text));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, pychat_text(old.text));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, pychat_text(old.text));
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, pychat_text(new.text));
+    END
+    """,
+)
+FTS_TRIGGERS = ("messages_fts_ai", "messages_fts_ad", "messages_fts_au")
+FTS_MIN_QUERY = 3
+SNIPPET_TOKENS = 16
+# rows per query when exporting and per transaction when importing
+EXPORT_BATCH = 5000
+IMPORT_BATCH = 20000
+# rows per INSERT statement when importing (7 columns, under SQLite's 999 variables)
+ROWS_PER_INSERT = 100
+
+# messages.timestamp is INTEGER milliseconds since the Unix epoch (UTC)
+MESSAGES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender TEXT NOT NULL,
+        text TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        attachment TEXT,
+        room TEXT NOT NULL DEFAULT 'general',
+        client_msg_id TEXT
+    )
+"""
+
+
+# timestamps must fit a datetime (years 1..9999), which also keeps them in int64
+MIN_EPOCH_MS = -62_135_596_800_000
+MAX_EPOCH_MS = 253_402_300_799_999
+
+
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def to_epoch_ms(value) -> Optional[int]:
+    """Epoch milliseconds from epoch ms (int/float/digits), an ISO 8601 string or a datetime.
+
+    Naive ISO strings and datetimes are taken as UTC (what older versions
+    stored). Raises ValueError for anything else, including NaN, infinity
+    and times outside MIN_EPOCH_MS..MAX_EPOCH_MS.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return _in_range(value)
+    if isinstance(value, str):
+        value = value.strip()
+        if value.lstrip("-").isdigit():
+            return _in_range(int(value))
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"not a timestamp: {value!r}") from None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return _in_range(value.timestamp() * 1000)
+    raise ValueError(f"not a timestamp: {value!r}")
+
+
+def _in_range(ms) -> int:
+    # NaN fails both comparisons
+    if not MIN_EPOCH_MS <= ms <= MAX_EPOCH_MS:
+        raise ValueError(f"timestamp out of range: {ms!r}")
+    return int(ms)
+
+
+def open_jsonl(path, mode: str) -> TextIO:
+    """Open a JSONL/NDJSON file for streaming ("-" = stdin/stdout, *.gz = gzip)."""
+    if str(path) == "-":
+        return sys.stdin if "r" in mode else sys.stdout
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode + "t", compresslevel=6, encoding="utf-8")
+    return open(path, mode, encoding="utf-8", newline="\n")
+
+
+def _insert_ignore_sql(rows: int) -> str:
+    return (
+        "INSERT OR IGNORE INTO messages (id, sender, text, timestamp, attachment, room, client_msg_id) VALUES "
+        + ", ".join(["(?, ?, ?, ?, ?, ?, ?)"] * rows)
+    )
+
+
+def _flatten(rows: List[tuple]) -> tuple:
+    return tuple(itertools.chain.from_iterable(rows))
+
+
+def fts_phrase(query: str) -> str:
+    """Quote user input as one FTS5 phrase so operators in it are literal."""
+    return '"' + query.replace('"', '""') + '"'
+
+
+def like_pattern(query: str) -> str:
+    return "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def highlight(text: str, query: str) -> Optional[str]:
+    """`text` with the first case-insensitive match of `query` in brackets, or None."""
+    at = text.lower().find(query.lower())
+    if at < 0:
+        return None
+    end = at + len(query)
+    return text[:at] + "[" + text[at:end] + "]" + text[end:]
 
 
 class Storage:
-    def __init__(self, db_path: Path | str):
+    """aiosqlite-backed message store.
+
+    With ``commit_window > 0`` the store runs in write-behind mode:
+    ``add_message`` assigns the id, enqueues the row on a bounded queue and
+    returns immediately; a background task inserts queued rows and commits
+    them as one transaction per ``commit_window`` seconds (or per
+    ``commit_batch`` rows, whichever comes first). ``close()`` flushes the
+    queue before closing. With ``commit_window == 0`` every message is
+    committed synchronously. A commit that fails for a transient reason is
+    rolled back and retried with backoff, so queued rows are not lost (the
+    queue fills up and pushes back on senders meanwhile). When a row itself
+    is at fault (one of ``ROW_ERRORS``: a taken id, a value SQLite can't
+    bind) the batch is retried row by row; only the rows that fail are
+    dropped, and their client_msg_id is forgotten so a retransmission is
+    stored again.
+
+    Timestamps are stored as INTEGER epoch milliseconds (UTC) with indexes
+    on (room, timestamp) and (timestamp), so ``get_messages_between`` reads
+    a time range without scanning; databases with the old ISO 8601 TEXT
+    column are converted on ``init``.
+
+    ``export_jsonl`` / ``import_jsonl`` stream the table to and from JSON
+    lines (one message object per line) in fixed-size chunks, so memory use
+    does not grow with the history; imports keep message ids and skip the
+    ids that already exist.
+
+    ``compress_text`` turns on dictionary compression of message bodies
+    (see compression.py). The dictionaries are kept in the database, so the
+    mode persists: ``init`` loads them and new messages are compressed too.
+    Reads decompress inside SQLite with the ``pychat_text()`` function.
+
+    Messages may carry the sender's ``client_msg_id``. The ids of the last
+    ``DEDUPE_WINDOW`` messages are kept in memory (loaded from the database
+    on ``init``), so ``find_client_msg`` recognizes a message that a client
+    re-sends after a reconnect, even across a server restart.
+    """
+
+    def __init__(
+        self,
+        db_path: Path | str,
+        commit_window: float = 0.0,
+        commit_batch: int = 500,
+        queue_size: int = 10000,
+    ):
         self.db_path = Path(db_path)
         self.db: Optional[aiosqlite.Connection] = None
+        self.commit_window = commit_window
+        self.commit_batch = commit_batch
+        self.queue_size = queue_size
+        self._next_id = 1
+        # rows accepted by add_message but not yet committed, keyed by id
+        self._pending: Dict[int, Dict] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        # failed write-behind commits and messages dropped as unstorable
+        self.commit_retries = 0
+        self.rejected = 0
+        # client_msg_id -> (id, timestamp) of recently stored messages
+        self._client_ids: "OrderedDict[str, tuple]" = OrderedDict()
+        self.fts = False
+        # set when message text is stored compressed
+        self.codec: Optional[TextCodec] = None
+
+    @property
+    def write_behind(self) -> bool:
+        return self.commit_window > 0
+
+    @property
+    def backlog(self) -> int:
+        """Messages accepted but not committed yet."""
+        return len(self._pending)
 
     async def init(self):
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
         self.db = await aiosqlite.connect(str(self.db_path))
+        self.db.row_factory = aiosqlite.Row
+        async with self.db.execute("SELECT COUNT(*) FROM sqlite_master") as cur:
+            if (await cur.fetchone())[0] == 0:
+                # new database: let retention hand free pages back (see incremental_vacuum)
+                await self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await self.db.execute("PRAGMA journal_mode=WAL")
+        await self.db.create_function("pychat_text", 1, self._plain_text, deterministic=True)
         await self._ensure_table()
+        # sqlite_sequence (AUTOINCREMENT) remembers the largest id ever stored,
+        # also after retention deleted the rows: archived ids are never reused
+        async with self.db.execute(
+            "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'messages'), 0),"
+            " (SELECT COALESCE(MAX(id), 0) FROM messages))"
+        ) as cur:
+            row = await cur.fetchone()
+        self._next_id = row[0] + 1
+        async with self.db.execute(
+            "SELECT client_msg_id, id, timestamp FROM messages WHERE client_msg_id IS NOT NULL ORDER BY id DESC LIMIT ?",
+            (DEDUPE_WINDOW,),
+        ) as cur:
+            recent = await cur.fetchall()
+        for r in reversed(recent):
+            self._client_ids[r[0]] = (r[1], r[2])
+        if self.write_behind:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._batch_ready = asyncio.Event()
+            self._writer = asyncio.create_task(self._write_loop())
 
     async def _ensure_table(self) -> None:
         assert self.db
+        await self.db.execute(MESSAGES_SCHEMA.format(table="messages"))
+        # Add columns missing from databases created by older versions
+        async with self.db.execute("PRAGMA table_info(messages)") as cur:
+            cols = {r[1]: r[2] for r in await cur.fetchall()}
+        if "attachment" not in cols:
+            await self.db.execute("ALTER TABLE messages ADD COLUMN attachment TEXT")
+        if "room" not in cols:
+            await self.db.execute("ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT 'general'")
+        if "client_msg_id" not in cols:
+            await self.db.execute("ALTER TABLE messages ADD COLUMN client_msg_id TEXT")
+        if cols["timestamp"].upper() != "INTEGER":
+            await self._migrate_timestamps()
+        await self.db.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, id)")
+        await self.db.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_ts ON messages (room, timestamp)")
+        await self.db.execute("CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages (timestamp)")
+        await self.db.commit()
+        await self._load_text_dicts()
+        await self._ensure_fts()
+
+    async def _load_text_dicts(self) -> None:
+        assert self.db
+        async with self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'text_dicts'") as cur:
+            if await cur.fetchone() is None:
+                return
+        async with self.db.execute("SELECT id, data FROM text_dicts") as cur:
+            dicts = {r[0]: r[1] for r in await cur.fetchall()}
+        self.codec = TextCodec(dicts) if dicts else None
+
+    def _plain_text(self, value):
+        # the pychat_text() SQL function; runs on aiosqlite's thread
+        codec = self.codec
+        return codec.decompress(value) if codec is not None and isinstance(value, bytes) else value
+
+    def _text(self, col: str = "text") -> str:
+        """SQL for the message text in column `col`."""
+        return f"pychat_text({col})" if self.codec is not None else col
+
+    def _stored_text(self, text: str):
+        return self.codec.compress(text) if self.codec is not None else text
+
+    async def _migrate_timestamps(self) -> None:
+        """Rewrite a table with ISO 8601 TEXT timestamps to INTEGER epoch ms.
+
+        SQLite cannot change a column's type, so the rows are copied into a
+        new table that then replaces the old one. Ids are kept, so the
+        search index stays valid; its triggers are recreated by _ensure_fts.
+        """
+        assert self.db
+
+        def convert(value):
+            try:
+                return to_epoch_ms(value)
+            except ValueError:
+                return 0
+
+        t0 = time.perf_counter()
+        await self.db.create_function("pychat_epoch_ms", 1, convert, deterministic=True)
+        await self.db.execute("DROP TABLE IF EXISTS messages_migrating")
+        await self.db.execute(MESSAGES_SCHEMA.format(table="messages_migrating"))
         await self.db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender TEXT NOT NULL,
-                text TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                attachment TEXT
-            )
-            """
+            "INSERT INTO messages_migrating (id, sender, text, timestamp, attachment, room, client_msg_id)"
+            " SELECT id, sender, text, pychat_epoch_ms(timestamp), attachment, room, client_msg_id FROM messages"
         )
+        await self.db.execute("DROP TABLE messages")
+        await self.db.execute("ALTER TABLE messages_migrating RENAME TO messages")
+        await self.db.commit()
+        logging.info("Migrated message timestamps to epoch milliseconds in %.2fs", time.perf_counter() - t0)
+
+    async def _ensure_fts(self) -> None:
+        assert self.db
+        async with self.db.execute("SELECT sql FROM sqlite_master WHERE name = 'messages_fts'") as cur:
+            row = await cur.fetchone()
+        existed = row is not None
+        if existed and ("messages_plain" in row[0]) != (self.codec is not None):
+            # compression was switched on or off: the index must read its text another way
+            await self._drop_fts()
+            existed = False
+        try:
+            for stmt in FTS_SCHEMA_COMPRESSED if self.codec is not None else FTS_SCHEMA:
+                await self.db.execute(stmt)
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5 (or the trigram tokenizer): search is unavailable
+            logging.warning("FTS5 is not available; message search is disabled")
+            await self.db.rollback()
+            return
+        self.fts = True
+        if not existed:
+            # index the messages written before the index existed
+            await self.rebuild_fts()
+        await self.db.commit()
+
+    async def _drop_fts(self) -> None:
+        assert self.db
+        for name in FTS_TRIGGERS:
+            await self.db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        await self.db.execute("DROP TABLE IF EXISTS messages_fts")
+        await self.db.execute("DROP VIEW IF EXISTS messages_plain")
+
+    async def rebuild_fts(self) -> None:
+        """Re-index every message (for databases created before search existed)."""
+        assert self.db
+        await self.db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
         await self.db.commit()
 
-    async def add_message(self, sender: str, text: str, timestamp: Optional[str] = None, attachment: Optional[str] = None) -> int:
+    async def add_message(
+        self,
+        sender: str,
+        text: str,
+        timestamp: int | str | None = None,
+        attachment: Optional[str] = None,
+        room: str = DEFAULT_ROOM,
+        client_msg_id: Optional[str] = None,
+    ) -> int:
         assert self.db
-        ts = timestamp or datetime.utcnow().isoformat()
-        cur = await self.db.execute(
-            "INSERT INTO messages (sender, text, timestamp, attachment) VALUES (?, ?, ?, ?)",
-            (sender, text, ts, attachment),
+        ts = to_epoch_ms(timestamp) if timestamp is not None else now_ms()
+        msg_id = self._next_id
+        self._next_id += 1
+        row = {
+            "id": msg_id,
+            "sender": sender,
+            "text": text,
+            "timestamp": ts,
+            "attachment": attachment,
+            "room": room,
+            "client_msg_id": client_msg_id,
+        }
+        if client_msg_id:
+            self._client_ids[client_msg_id] = (msg_id, ts)
+            if len(self._client_ids) > DEDUPE_WINDOW:
+                self._client_ids.popitem(last=False)
+        if not self.write_behind:
+            await self._insert_rows([row])
+            return msg_id
+        assert self._queue is not None and self._batch_ready is not None
+        self._pending[msg_id] = row
+        # blocks only when the queue is full (backpressure towards the sender)
+        await self._queue.put(row)
+        if self._queue.qsize() >= self.commit_batch:
+            self._batch_ready.set()
+        return msg_id
+
+    def find_client_msg(self, client_msg_id: Optional[str]) -> Optional[Dict]:
+        """The id and timestamp a message with this client_msg_id was stored with, if any."""
+        if not client_msg_id:
+            return None
+        found = self._client_ids.get(client_msg_id)
+        return {"id": found[0], "timestamp": found[1]} if found else None
+
+    async def _insert_rows(self, rows: List[Dict]) -> None:
+        assert self.db
+        await self.db.executemany(
+            "INSERT INTO messages (id, sender, text, timestamp, attachment, room, client_msg_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (r["id"], r["sender"], self._stored_text(r["text"]), r["timestamp"], r["attachment"], r["room"], r.get("client_msg_id"))
+                for r in rows
+            ],
         )
         await self.db.commit()
-        return cur.lastrowid
 
-    async def get_messages(self, limit: Optional[int] = None) -> List[Dict]:
+    async def _write_loop(self) -> None:
+        assert self._queue is not None and self._batch_ready is not None
+        while True:
+            first = await self._queue.get()
+            if self._queue.qsize() + 1 < self.commit_batch:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.commit_window)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_ready.clear()
+            batch = [first]
+            while len(batch) < self.commit_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            t0 = time.perf_counter()
+            await self._commit_batch(batch)
+            COMMIT_SECONDS.observe(time.perf_counter() - t0)
+            for r in batch:
+                self._pending.pop(r["id"], None)
+                self._queue.task_done()
+
+    async def _commit_batch(self, batch: List[Dict]) -> None:
+        """Insert and commit `batch`, retrying until the database has taken every row it can."""
+        delay = COMMIT_RETRY_BASE
+        todo = list(batch)
+        one_by_one = False
+        while todo:
+            try:
+                if not one_by_one:
+                    await self._insert_rows(todo)
+                    return
+                while todo:
+                    try:
+                        await self._insert_rows(todo[:1])
+                    except ROW_ERRORS as e:
+                        await self._rollback()
+                        self._reject(todo[0], e)
+                    todo.pop(0)
+            except ROW_ERRORS:
+                await self._rollback()
+                # some row can never be stored (e.g. its id is taken): find it
+                one_by_one = True
+            except Exception:
+                await self._rollback()
+                self.commit_retries += 1
+                COMMIT_RETRIES.inc()
+                logging.exception("Failed to commit %d queued messages; retrying in %.2fs", len(todo), delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, COMMIT_RETRY_MAX)
+
+    async def _rollback(self) -> None:
         assert self.db
-        q = "SELECT id, sender, text, timestamp, attachment FROM messages ORDER BY id ASC"
+        try:
+            await self.db.rollback()
+        except Exception:
+            logging.exception("Rollback failed")
+
+    def _reject(self, row: Dict, error: Exception) -> None:
+        """Drop a row the database refused (it was acked already, so say so loudly)."""
+        self.rejected += 1
+        MESSAGES_REJECTED.inc()
+        client_msg_id = row.get("client_msg_id")
+        if client_msg_id and self._client_ids.get(client_msg_id, (None,))[0] == row["id"]:
+            # a retransmission must be stored, not acked as a duplicate
+            del self._client_ids[client_msg_id]
+        logging.error("Dropped message %d from %r: the database refused it (%r)", row["id"], row["sender"], error)
+
+    async def flush(self) -> None:
+        """Commit every queued message now and wait until that is done."""
+        if self._queue is not None:
+            if self._batch_ready is not None and self._pending:
+                # don't sit out the rest of the commit window
+                self._batch_ready.set()
+            await self._queue.join()
+
+    async def iter_messages(
+        self,
+        since_id: Optional[int] = None,
+        limit: Optional[int] = None,
+        room: Optional[str] = None,
+    ) -> AsyncIterator[Dict]:
+        """Stream messages in id order without materializing the result set.
+
+        - since_id: only messages with id > since_id (the oldest ones first)
+        - limit: at most this many rows; without since_id this means "the latest N"
+        - room: only messages of this room (served by the (room, id) index)
+
+        Messages still waiting in the write-behind queue are included.
+        """
+        assert self.db
+        # snapshot before querying so rows committed meanwhile are not missed
+        pending = sorted(
+            (r for r in self._pending.values() if room is None or r["room"] == room),
+            key=lambda r: r["id"],
+        )
+        cols = f"SELECT id, sender, {self._text()} AS text, timestamp, attachment, room FROM messages"
+        where = []
+        params: tuple = ()
+        if room is not None:
+            where.append("room = ?")
+            params += (room,)
+        if since_id is not None:
+            where.append("id > ?")
+            params += (since_id,)
+        elif limit is not None:
+            # the newest rows may still be queued; only read the rest from disk
+            pending = pending[-limit:] if limit else []
+            if pending:
+                where.append("id < ?")
+                params += (pending[0]["id"],)
+        if where:
+            cols += " WHERE " + " AND ".join(where)
+        if since_id is not None:
+            q = cols + " ORDER BY id ASC"
+            if limit is not None:
+                q += " LIMIT ?"
+                params += (limit,)
+        elif limit is not None:
+            q = f"SELECT * FROM ({cols} ORDER BY id DESC LIMIT ?) ORDER BY id ASC"
+            params += (limit - len(pending),)
+        else:
+            q = cols + " ORDER BY id ASC"
+        last_id = since_id or 0
+        count = 0
+        async with self.db.execute(q, params) as cur:
+            async for row in cur:
+                last_id = row["id"]
+                count += 1
+                yield dict(row)
+        for r in pending:
+            if limit is not None and count >= limit:
+                break
+            if r["id"] > last_id:
+                last_id = r["id"]
+                count += 1
+                yield {k: v for k, v in r.items() if k != "client_msg_id"}
+
+    async def get_messages(
+        self,
+        limit: Optional[int] = None,
+        since_id: Optional[int] = None,
+        room: Optional[str] = None,
+    ) -> List[Dict]:
+        return [m async for m in self.iter_messages(since_id=since_id, limit=limit, room=room)]
+
+    async def get_messages_between(
+        self,
+        start,
+        end,
+        limit: Optional[int] = None,
+        room: Optional[str] = None,
+    ) -> List[Dict]:
+        """Messages with start <= timestamp < end, oldest first (ties in id order).
+
+        `start` and `end` are epoch milliseconds, ISO 8601 strings or datetimes;
+        None leaves that side open. Served by the (room, timestamp) or
+        (timestamp) index; messages still waiting in the write-behind queue
+        are included.
+        """
+        assert self.db
+        start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+
+        def wanted(r: Dict) -> bool:
+            return (
+                (room is None or r["room"] == room)
+                and (start_ms is None or r["timestamp"] >= start_ms)
+                and (end_ms is None or r["timestamp"] < end_ms)
+            )
+
+        pending = [
+            {k: v for k, v in r.items() if k != "client_msg_id"} for r in list(self._pending.values()) if wanted(r)
+        ]
+        where = []
+        params: tuple = ()
+        if room is not None:
+            where.append("room = ?")
+            params += (room,)
+        if start_ms is not None:
+            where.append("timestamp >= ?")
+            params += (start_ms,)
+        if end_ms is not None:
+            where.append("timestamp < ?")
+            params += (end_ms,)
+        q = f"SELECT id, sender, {self._text()} AS text, timestamp, attachment, room FROM messages"
+        if where:
+            q += " WHERE " + " AND ".join(where)
+        q += " ORDER BY timestamp, id"
         if limit is not None:
             q += " LIMIT ?"
-            cur = await self.db.execute(q, (limit,))
+            params += (limit,)
+        async with self.db.execute(q, params) as cur:
+            rows = [dict(row) async for row in cur]
+        if pending:
+            # a row may have been committed after the snapshot: keep one copy
+            seen = {r["id"] for r in rows}
+            rows = sorted(rows + [r for r in pending if r["id"] not in seen], key=lambda r: (r["timestamp"], r["id"]))
+            if limit is not None:
+                rows = rows[:limit]
+        return rows
+
+    async def export_jsonl(self, dest, room: Optional[str] = None, since_id: Optional[int] = None) -> Dict:
+        """Write messages (id order) as JSON lines to `dest` (a path, "-" or a text file).
+
+        Returns {"rows", "bytes", "seconds", "rows_per_s"}.
+        """
+        assert self.db
+        await self.flush()
+        t0 = time.perf_counter()
+        rows = size = 0
+        last_id = since_id or 0
+        f = open_jsonl(dest, "w") if isinstance(dest, (str, Path)) else dest
+        try:
+            while True:
+                q = (
+                    f"SELECT id, sender, {self._text()} AS text, timestamp, attachment, room, client_msg_id"
+                    " FROM messages WHERE id > ?"
+                )
+                params: tuple = (last_id,)
+                if room is not None:
+                    q += " AND room = ?"
+                    params += (room,)
+                # keyset pages: one bounded chunk in memory at a time
+                async with self.db.execute(q + " ORDER BY id LIMIT ?", params + (EXPORT_BATCH,)) as cur:
+                    chunk = await cur.fetchall()
+                if not chunk:
+                    break
+                lines = "".join(json.dumps(dict(r), ensure_ascii=False) + "\n" for r in chunk)
+                f.write(lines)
+                size += len(lines)
+                rows += len(chunk)
+                last_id = chunk[-1]["id"]
+        finally:
+            if f is not dest and f is not sys.stdout:
+                f.close()
+        seconds = time.perf_counter() - t0
+        return {"rows": rows, "bytes": size, "seconds": seconds, "rows_per_s": rows / seconds if seconds else 0.0}
+
+    async def import_jsonl(self, source) -> Dict:
+        """Insert messages from JSON lines (a path, "-" or a text file).
+
+        Rows are inserted with executemany, IMPORT_BATCH rows per transaction.
+        A row whose id already exists is skipped, so re-importing the same
+        file is harmless; rows without an id get new ones. Lines written by
+        the desktop client's export use its "server_id" as the id. Returns
+        {"read", "inserted", "skipped", "invalid", "seconds", "rows_per_s"}.
+        """
+        assert self.db
+        await self.flush()
+        t0 = time.perf_counter()
+        stats = {"read": 0, "inserted": 0, "skipped": 0, "invalid": 0}
+        batch: List[tuple] = []
+        f = open_jsonl(source, "r") if isinstance(source, (str, Path)) else source
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+                stats["read"] += 1
+                try:
+                    batch.append(self._import_row(json.loads(line)))
+                except (ValueError, TypeError, AttributeError):
+                    stats["invalid"] += 1
+                    continue
+                if len(batch) >= IMPORT_BATCH:
+                    stats["inserted"] += await self._insert_ignore(batch)
+                    batch = []
+            if batch:
+                stats["inserted"] += await self._insert_ignore(batch)
+        finally:
+            if f is not source and f is not sys.stdin:
+                f.close()
+        stats["skipped"] = stats["read"] - stats["invalid"] - stats["inserted"]
+        seconds = time.perf_counter() - t0
+        stats.update(seconds=seconds, rows_per_s=stats["read"] / seconds if seconds else 0.0)
+        return stats
+
+    def _import_row(self, obj: Dict) -> tuple:
+        msg_id = obj.get("server_id") if "server_id" in obj else obj.get("id")
+        if msg_id is None:
+            msg_id = self._next_id
+        msg_id = int(msg_id)
+        # later add_message calls must not reuse imported ids
+        self._next_id = max(self._next_id, msg_id + 1)
+        ts = to_epoch_ms(obj.get("timestamp"))
+        return (
+            msg_id,
+            str(obj.get("sender") or "unknown"),
+            self._stored_text(str(obj.get("text") or "")),
+            ts if ts is not None else now_ms(),
+            obj.get("attachment"),
+            obj.get("room") or DEFAULT_ROOM,
+            obj.get("client_msg_id"),
+        )
+
+    async def _insert_ignore(self, rows: List[tuple]) -> int:
+        """Insert `rows` in one transaction; returns how many were new."""
+        assert self.db
+        # Several rows per statement: the search index has a fixed cost per
+        # statement, which made one-row inserts about 5x slower.
+        full = len(rows) - len(rows) % ROWS_PER_INSERT
+        inserted = 0
+        for sql, params in (
+            (_insert_ignore_sql(ROWS_PER_INSERT), [_flatten(rows[i:i + ROWS_PER_INSERT]) for i in range(0, full, ROWS_PER_INSERT)]),
+            (_insert_ignore_sql(len(rows) - full), [_flatten(rows[full:])]),
+        ):
+            if params and params[0]:
+                # rowcount leaves out the rows the index triggers insert
+                async with self.db.executemany(sql, params) as cur:
+                    inserted += cur.rowcount
+        await self.db.commit()
+        return inserted
+
+    async def retention_cutoff_id(self, keep_rows: int) -> Optional[int]:
+        """Id of the oldest of the newest `keep_rows` messages (older ones are expired)."""
+        assert self.db
+        if keep_rows <= 0:
+            return self._next_id
+        async with self.db.execute("SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?", (keep_rows - 1,)) as cur:
+            row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def expired_rows(self, before_ts: Optional[int], before_id: Optional[int], limit: int) -> List[Dict]:
+        """The oldest stored rows with timestamp < before_ts or id < before_id.
+
+        The newest row is never returned, so the table keeps the latest id.
+        """
+        assert self.db
+        where = []
+        params: tuple = ()
+        if before_ts is not None:
+            where.append("timestamp < ?")
+            params += (before_ts,)
+        if before_id is not None:
+            where.append("id < ?")
+            params += (before_id,)
+        if not where:
+            return []
+        q = (
+            f"SELECT id, sender, {self._text()} AS text, timestamp, attachment, room FROM messages"
+            " WHERE (" + " OR ".join(where) + ") AND id < (SELECT MAX(id) FROM messages)"
+        )
+        async with self.db.execute(q + " ORDER BY id LIMIT ?", params + (limit,)) as cur:
+            return [dict(row) async for row in cur]
+
+    async def delete_messages(self, ids: Iterable[int]) -> None:
+        """Delete messages by id in one transaction (the search index follows via triggers)."""
+        assert self.db
+        await self.db.executemany("DELETE FROM messages WHERE id = ?", [(i,) for i in ids])
+        await self.db.commit()
+
+    async def enable_incremental_vacuum(self) -> None:
+        """Switch a database created without auto_vacuum to incremental mode.
+
+        This needs one full VACUUM, which rewrites the file; it only happens
+        the first time retention runs on such a database.
+        """
+        assert self.db
+        async with self.db.execute("PRAGMA auto_vacuum") as cur:
+            mode = (await cur.fetchone())[0]
+        if mode == 2:
+            return
+        t0 = time.perf_counter()
+        await self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await self.db.execute("VACUUM")
+        logging.info("Enabled incremental vacuum on %s in %.2fs", self.db_path, time.perf_counter() - t0)
+
+    async def incremental_vacuum(self, pages: int = 0) -> None:
+        """Return up to `pages` free pages (0 = all) to the file system."""
+        assert self.db
+        # executescript steps the pragma to completion; execute() frees only one page
+        await self.db.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        # the file only shrinks once the WAL is checkpointed
+        async with self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cur:
+            await cur.fetchall()
+
+    async def vacuum(self) -> None:
+        """Rewrite the database file without free pages (full VACUUM)."""
+        assert self.db
+        await self.db.execute("VACUUM")
+        async with self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cur:
+            await cur.fetchall()
+
+    async def text_size(self) -> Dict:
+        """Message count, compressed message count and stored bytes of message text."""
+        assert self.db
+        async with self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(typeof(text) = 'blob'), 0), COALESCE(SUM(length(CAST(text AS BLOB))), 0)"
+            " FROM messages"
+        ) as cur:
+            row = await cur.fetchone()
+        return {"messages": row[0], "compressed": row[1], "text_bytes": row[2]}
+
+    async def compress_text(self, retrain: bool = False, samples: int = TRAIN_SAMPLES) -> Dict:
+        """Store message text compressed with a zstd dictionary trained from the newest messages.
+
+        Trains a dictionary the first time (or, with `retrain`, a new one
+        that is used for messages written from then on), then compresses
+        every uncompressed row in chunks. The search index is rebuilt the
+        first time. Run it with the server stopped; call vacuum() afterwards
+        to shrink the file. Returns the dictionary number, the number of
+        rows compressed and the text bytes before and after.
+        """
+        assert self.db
+        await self.flush()
+        t0 = time.perf_counter()
+        before = await self.text_size()
+        if self.codec is None or retrain:
+            async with self.db.execute(f"SELECT {self._text()} FROM messages ORDER BY id DESC LIMIT ?", (samples,)) as cur:
+                texts = [r[0] for r in await cur.fetchall()]
+            await self.db.execute(DICTS_SCHEMA)
+            async with self.db.execute("SELECT COALESCE(MAX(id), 0) FROM text_dicts") as cur:
+                dict_no = (await cur.fetchone())[0] + 1
+            if dict_no > MAX_DICTS:
+                raise ValueError(f"at most {MAX_DICTS} dictionaries can be trained")
+            data = await asyncio.get_running_loop().run_in_executor(None, train, texts)
+            await self.db.execute(
+                "INSERT INTO text_dicts (id, data, created, samples) VALUES (?, ?, ?, ?)", (dict_no, data, now_ms(), len(texts))
+            )
+            await self.db.commit()
+            await self._load_text_dicts()
+        assert self.codec is not None
+        # The indexed text does not change, so keep the triggers from re-indexing
+        # every row; _ensure_fts puts them back (and rebuilds on the first run).
+        for name in FTS_TRIGGERS:
+            await self.db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        await self.db.commit()
+        compressed = 0
+        last_id = 0
+        while True:
+            async with self.db.execute(
+                "SELECT id, text FROM messages WHERE id > ? AND typeof(text) = 'text' ORDER BY id LIMIT ?",
+                (last_id, EXPORT_BATCH),
+            ) as cur:
+                rows = await cur.fetchall()
+            if not rows:
+                break
+            updates = []
+            for r in rows:
+                stored = self.codec.compress(r["text"])
+                if isinstance(stored, bytes):
+                    updates.append((stored, r["id"]))
+            await self.db.executemany("UPDATE messages SET text = ? WHERE id = ?", updates)
+            await self.db.commit()
+            compressed += len(updates)
+            last_id = rows[-1]["id"]
+        await self._ensure_fts()
+        after = await self.text_size()
+        logging.info("Compressed %d messages in %.2fs", compressed, time.perf_counter() - t0)
+        return {
+            "dictionary": self.codec.dict_no,
+            "compressed": compressed,
+            "text_bytes_before": before["text_bytes"],
+            "text_bytes_after": after["text_bytes"],
+            "seconds": time.perf_counter() - t0,
+        }
+
+    async def decompress_text(self) -> Dict:
+        """Turn compression off: store every message as plain text again and drop the dictionaries."""
+        assert self.db
+        await self.flush()
+        t0 = time.perf_counter()
+        if self.codec is None:
+            return {"decompressed": 0, "seconds": 0.0}
+        for name in FTS_TRIGGERS:
+            await self.db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        async with self.db.execute("UPDATE messages SET text = pychat_text(text) WHERE typeof(text) = 'blob'") as cur:
+            decompressed = cur.rowcount
+        await self.db.execute("DROP TABLE text_dicts")
+        await self.db.commit()
+        self.codec = None
+        await self._ensure_fts()
+        return {"decompressed": decompressed, "seconds": time.perf_counter() - t0}
+
+    async def search(
+        self,
+        query: str,
+        limit: int = 20,
+        offset: int = 0,
+        rooms: Optional[Iterable[str]] = None,
+    ) -> List[Dict]:
+        """Best-ranked messages matching `query`, with a highlighted snippet.
+
+        Returns dicts with the message columns plus "snippet" and "rank"
+        (bm25, lower is better). Page through results with `offset`.
+        Messages still waiting in the write-behind queue are matched as
+        plain substrings and come first, newest first, with rank 0.0.
+        """
+        assert self.db
+        query = query.strip()
+        if not query or not self.fts:
+            return []
+        where = ""
+        room_params: tuple = ()
+        if rooms is not None:
+            room_list = list(rooms)
+            if not room_list:
+                return []
+            where = " AND m.room IN (" + ",".join("?" * len(room_list)) + ")"
+            room_params = tuple(room_list)
+        pending = self._pending_matches(query, None if rooms is None else set(room_list))
+        head = pending[offset:offset + limit]
+        # the committed results continue where the pending ones end
+        offset = max(0, offset - len(pending))
+        limit -= len(head)
+        if limit <= 0:
+            return head
+        if len(query) >= FTS_MIN_QUERY:
+            q = (
+                f"SELECT m.id, m.sender, {self._text('m.text')} AS text, m.timestamp, m.attachment, m.room,"
+                f" snippet(messages_fts, 0, '[', ']', '…', {SNIPPET_TOKENS}) AS snippet,"
+                " bm25(messages_fts) AS rank"
+                " FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+                " WHERE messages_fts MATCH ?" + where + " ORDER BY rank, m.id DESC LIMIT ? OFFSET ?"
+            )
+            params = (fts_phrase(query),) + room_params + (limit, offset)
         else:
-            cur = await self.db.execute(q)
-        rows = await cur.fetchall()
-        return [dict(row) for row in rows]
+            # too short for trigrams: unranked scan, newest first
+            q = (
+                f"SELECT m.id, m.sender, {self._text('m.text')} AS text, m.timestamp, m.attachment, m.room,"
+                f" {self._text('m.text')} AS snippet, 0.0 AS rank"
+                f" FROM messages m WHERE {self._text('m.text')} LIKE ? ESCAPE '\\'" + where + " ORDER BY m.id DESC LIMIT ? OFFSET ?"
+            )
+            params = (like_pattern(query),) + room_params + (limit, offset)
+        async with self.db.execute(q, params) as cur:
+            rows = [dict(row) async for row in cur]
+        if pending:
+            # a row may have been committed after the pending snapshot: keep one copy
+            seen = {r["id"] for r in pending}
+            rows = [r for r in rows if r["id"] not in seen]
+        return head + rows
+
+    def _pending_matches(self, query: str, rooms: Optional[Set[str]]) -> List[Dict]:
+        """Rows of the write-behind queue whose text contains `query`, newest first."""
+        out = []
+        for r in reversed(list(self._pending.values())):
+            if rooms is not None and r["room"] not in rooms:
+                continue
+            snippet = highlight(r["text"], query)
+            if snippet is None:
+                continue
+            row = {k: v for k, v in r.items() if k != "client_msg_id"}
+            row.update(snippet=snippet, rank=0.0)
+            out.append(row)
+        return out
 
     async def close(self) -> None:
+        if self._writer is not None:
+            await self.flush()
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
         if self.db:
             await self.db.close()
@@ -0,0 +1,37 @@
+import sqlite3
+import time
+
+from app.storage import Storage
+
+
+def committed_rows(db) -> int:
+    with sqlite3.connect(db) as conn:
+        return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+def test_steady_writes_are_committed_every_interval(tmp_path):
+    db = tmp_path / "client.db"
+    storage = Storage(db, commit_interval=0.1, commit_batch=10**6)
+    try:
+        # one write every 20 ms never leaves the writer idle for a whole interval
+        end = time.monotonic() + 0.5
+        while time.monotonic() < end:
+            storage.add_message("alice", "hi")
+            time.sleep(0.02)
+        seen = committed_rows(db)
+    finally:
+        storage.close()
+    assert seen > 0
+
+
+def test_duplicate_server_id_returns_stored_row(tmp_path):
+    db = tmp_path / "client.db"
+    storage = Storage(db)
+    try:
+        first = storage.add_message("bob", "hello", server_id=7)
+        again = storage.add_message("bob", "hello", server_id=7)
+        rows = storage.get_messages()
+    finally:
+        storage.close()
+    assert again == first
+    assert [r["id"] for r in rows] == [first]
@@ -0,0 +1,48 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from server.blobstore import BlobStore, UploadError
+
+
+def test_empty_or_negative_size_is_refused(tmp_path):
+    store = BlobStore(tmp_path)
+    sha = hashlib.sha256(b"").hexdigest()
+    for size in (0, -1):
+        with pytest.raises(UploadError):
+            store.begin_upload(sha, size)
+    assert store.size(sha) is None
+
+
+def test_complete_partial_is_verified_before_it_is_stored(tmp_path):
+    store = BlobStore(tmp_path)
+    data = b"x" * 100
+    sha = hashlib.sha256(data).hexdigest()
+    store._partial(sha).write_bytes(data)
+    assert store.begin_upload(sha, len(data)) == len(data)
+    assert store.size(sha) is None
+    asyncio.run(store.finish(sha))
+    assert store.size(sha) == len(data)
+
+    bad = hashlib.sha256(b"y" * 100).hexdigest()
+    store._partial(bad).write_bytes(data)
+    store.begin_upload(bad, len(data))
+    with pytest.raises(UploadError):
+        asyncio.run(store.finish(bad))
+    assert store.size(bad) is None and not store._partial(bad).exists()
+
+
+def test_upload_resumes_in_another_process(tmp_path):
+    data = bytes(range(256)) * 10
+    sha = hashlib.sha256(data).hexdigest()
+    first = BlobStore(tmp_path)
+    first.begin_upload(sha, len(data))
+    assert first.write_chunk(sha, 0, data[:1000]) == (1000, False)
+
+    # a worker that never saw upload_start takes the rest
+    second = BlobStore(tmp_path)
+    assert second.write_chunk(sha, 1000, data[1000:]) == (len(data), True)
+    asyncio.run(second.finish(sha))
+    assert second.size(sha) == len(data)
+    assert list(tmp_path.joinpath("partial").iterdir()) == []
@@ -0,0 +1,36 @@
+import asyncio
+
+from server.bus import BusHub, encode_frame, read_frame
+
+
+def test_hub_drops_a_worker_that_stops_reading(tmp_path):
+    async def run():
+        hub = BusHub(str(tmp_path / "bus.sock"), on_publish=None, buffer_limit=1024 * 1024, drain_timeout=0.2)
+        await hub.start()
+        try:
+            links = {}
+            for worker_id in (0, 1):
+                reader, writer = await asyncio.open_unix_connection(hub.path)
+                writer.write(encode_frame({"op": "hello", "worker": worker_id}))
+                links[worker_id] = (reader, writer)
+            while len(hub.workers) < 2:
+                await asyncio.sleep(0.01)
+
+            # worker 1 never reads; worker 0 keeps publishing and reading
+            reader, writer = links[0]
+            received = 0
+            for i in range(200):
+                writer.write(encode_frame({"op": "ephemeral", "worker": 0, "msg": {"text": "x" * 64 * 1024, "n": i}}))
+                await writer.drain()
+                frame = await asyncio.wait_for(read_frame(reader), 5)
+                received += frame["msg"]["n"] == i
+            return received, hub.dropped, sorted(hub.workers)
+        finally:
+            await hub.close()
+            for _, w in links.values():
+                w.close()
+
+    received, dropped, attached = asyncio.run(run())
+    assert received == 200
+    assert dropped == 1
+    assert attached == [0]
@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+from server import server as srv
+from server.connection import KIND_EPHEMERAL, Connection
+from server.metrics import MESSAGES_OUT, REGISTRY
+
+
+class SlowSocket:
+    """A client that reads nothing until `release()`."""
+
+    remote_address = ("127.0.0.1", 0)
+
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+        self._open = asyncio.Event()
+
+    def release(self):
+        self._open.set()
+
+    async def send(self, payload):
+        await self._open.wait()
+        self.sent.append(json.loads(payload))
+
+    async def close(self, code=1000, reason=""):
+        self.closed_with = code
+
+
+def message(n: int) -> str:
+    return json.dumps({"text": str(n)})
+
+
+def texts(frames) -> list:
+    out = []
+    for frame in frames:
+        if frame.get("type") == "batch":
+            out.extend(m["text"] for m in frame["messages"])
+        else:
+            out.append(frame["text"])
+    return out
+
+
+async def fill(policy: str, n: int, maxsize: int = 4):
+    ws = SlowSocket()
+    conn = Connection(ws, maxsize=maxsize, policy=policy)
+    conn.start()
+    queued = [conn.enqueue(message(i)) for i in range(n)]
+    await asyncio.sleep(0)
+    return ws, conn, queued
+
+
+async def flush(ws, conn):
+    ws.release()
+    await asyncio.wait_for(conn.drain(), 5)
+    stats = conn.stats()
+    await conn.close()
+    return stats
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+    async def run():
+        ws, conn, queued = await fill("drop_oldest", 10)
+        srv.CONNECTED[ws] = conn
+        try:
+            gauge = REGISTRY.render()
+        finally:
+            del srv.CONNECTED[ws]
+        sent_before = MESSAGES_OUT.value
+        stats = await flush(ws, conn)
+        return ws.sent, queued, stats, gauge, MESSAGES_OUT.value - sent_before
+
+    frames, queued, stats, gauge, sent = asyncio.run(run())
+    assert all(queued)
+    assert texts(frames) == ["6", "7", "8", "9"]
+    assert stats["dropped"] == 6 and stats["sent"] == 4 and stats["max_depth"] == 4
+    assert "pychat_outbound_dropped 6" in gauge
+    # the writer holds one frame while the client is stalled
+    assert "pychat_outbound_queue_depth 3" in gauge
+    assert sent == 4
+
+
+def test_coalesce_merges_queued_messages_into_a_batch():
+    async def run():
+        ws, conn, queued = await fill("coalesce", 6)
+        return ws.sent, queued, await flush(ws, conn)
+
+    frames, queued, stats = asyncio.run(run())
+    assert all(queued)
+    assert frames[0]["type"] == "batch"
+    assert texts(frames) == [str(i) for i in range(6)]
+    assert stats["coalesced"] == 4 and stats["dropped"] == 0
+
+
+def test_disconnect_closes_the_slow_client():
+    async def run():
+        ws, conn, queued = await fill("disconnect", 6)
+        await asyncio.sleep(0)
+        await conn.close()
+        return ws, conn, queued
+
+    ws, conn, queued = asyncio.run(run())
+    assert queued == [True] * 4 + [False, False]
+    assert conn.closed
+    assert ws.closed_with == 1008
+
+
+def test_ephemeral_frames_go_first():
+    async def run():
+        ws = SlowSocket()
+        conn = Connection(ws, maxsize=4, policy="drop_oldest")
+        conn.start()
+        results = [
+            conn.enqueue(json.dumps({"text": "typing"}), KIND_EPHEMERAL),
+            conn.enqueue(message(0)),
+            # half full: no more typing/presence
+            conn.enqueue(json.dumps({"text": "late typing"}), KIND_EPHEMERAL),
+            conn.enqueue(message(1)),
+            conn.enqueue(message(2)),
+            # full: the queued ephemeral frame makes room before any message is dropped
+            conn.enqueue(message(3)),
+        ]
+        return ws.sent, results, await flush(ws, conn)
+
+    frames, results, stats = asyncio.run(run())
+    assert results == [True, True, False, True, True, True]
+    assert texts(frames) == ["0", "1", "2", "3"]
+    assert stats["ephemeral_dropped"] == 2 and stats["dropped"] == 0
@@ -0,0 +1,84 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT"), reason="--workers needs SO_REUSEPORT")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def connect(url: str, deadline: float):
+    while True:
+        try:
+            ws = await websockets.connect(url)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+            continue
+        while json.loads(await asyncio.wait_for(ws.recv(), 5)).get("type") != "history_end":
+            pass
+        return ws
+
+
+async def recv_text(ws) -> str:
+    while True:
+        data = json.loads(await asyncio.wait_for(ws.recv(), 5))
+        if data.get("text") is not None:
+            return data["text"]
+
+
+def test_two_workers_fan_out_and_shut_down_cleanly(tmp_path):
+    port = free_port()
+    proc = subprocess.Popen(
+        [
+            sys.executable, "-m", "server.server", "--workers", "2", "--host", "127.0.0.1", "--port", str(port),
+            "--db", str(tmp_path / "chat.db"), "--attachments-dir", str(tmp_path / "blobs"),
+            "--archive-dir", str(tmp_path / "archive"), "--bus-path", str(tmp_path / "bus.sock"), "--metrics-port", "0",
+        ],
+        cwd=ROOT,
+        stderr=subprocess.PIPE,
+        text=True,
+        start_new_session=True,
+    )
+
+    async def run():
+        url = f"ws://127.0.0.1:{port}/"
+        deadline = time.monotonic() + 20
+        clients = [await connect(url, deadline) for _ in range(6)]
+        try:
+            await clients[0].send(json.dumps({"sender": "alice", "text": "hello", "client_msg_id": "c1"}))
+            return [await recv_text(ws) for ws in clients[1:]]
+        finally:
+            for ws in clients:
+                await ws.close()
+
+    try:
+        received = asyncio.run(run())
+    finally:
+        # like a service manager: every process of the group gets SIGTERM,
+        # and the supervisor then terminates its workers once more
+        os.killpg(proc.pid, signal.SIGTERM)
+        try:
+            _, log = proc.communicate(timeout=20)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            _, log = proc.communicate()
+    assert received == ["hello"] * 5
+    assert proc.returncode == 0, log
+    assert "Traceback" not in log and "Error" not in log, log
+    assert log.count("attached") >= 2
@@ -0,0 +1,40 @@
+import asyncio
+
+from server.archive import Archive, archive_expired
+from server.storage import Storage
+
+OLD_TS = 1_600_000_000_000
+
+
+def test_ids_keep_increasing_after_archiving_everything(tmp_path):
+    db = tmp_path / "chat.db"
+    archive = Archive(tmp_path / "archive")
+
+    async def archive_all():
+        storage = Storage(db)
+        await storage.init()
+        try:
+            ids = [await storage.add_message("alice", f"old {i}", timestamp=OLD_TS + i) for i in range(5)]
+            moved = await archive_expired(storage, archive, max_age_days=1)
+            remaining = [m["id"] for m in await storage.get_messages()]
+            # even with every row gone, a restart must not hand out archived ids again
+            await storage.delete_messages(remaining)
+        finally:
+            await storage.close()
+        return ids, moved, remaining
+
+    async def add_after_restart():
+        storage = Storage(db)
+        await storage.init()
+        try:
+            return await storage.add_message("alice", "after restart")
+        finally:
+            await storage.close()
+
+    ids, moved, remaining = asyncio.run(archive_all())
+    # retention keeps the newest row
+    assert moved == 4
+    assert remaining == ids[-1:]
+    new_id = asyncio.run(add_after_restart())
+    assert new_id > max(ids)
+    assert new_id not in {r["id"] for r in archive.query(limit=100)}
@@ -0,0 +1,88 @@
+import asyncio
+import contextlib
+import json
+
+import websockets
+
+from server import server as srv
+from server.storage import Storage, now_ms
+
+
+@contextlib.asynccontextmanager
+async def running_server(tmp_path):
+    srv.STORAGE = Storage(tmp_path / "chat.db", commit_window=0.01)
+    await srv.STORAGE.init()
+    try:
+        async with websockets.serve(srv.handler, "127.0.0.1", 0) as server:
+            yield f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+    finally:
+        await srv.STORAGE.close()
+        srv.STORAGE = None
+
+
+async def recv_type(ws, kind: str) -> dict:
+    while True:
+        data = json.loads(await asyncio.wait_for(ws.recv(), 5))
+        if data.get("type") == kind:
+            return data
+
+
+def test_message_with_unstorable_fields_is_refused(tmp_path):
+    async def run():
+        async with running_server(tmp_path) as url:
+            async with websockets.connect(url) as ws:
+                await recv_type(ws, "history_end")
+                await ws.send(json.dumps({"sender": "alice", "text": "hi", "attachment": {"name": "x"}, "client_msg_id": "c1"}))
+                error = await recv_type(ws, "error")
+                await ws.send(json.dumps({"sender": ["alice"], "text": "hi"}))
+                error2 = await recv_type(ws, "error")
+                await ws.send(json.dumps({"sender": "alice", "text": "ok", "client_msg_id": "c2"}))
+                ack = await recv_type(ws, "ack")
+            await srv.STORAGE.flush()
+            return error, error2, ack, await srv.STORAGE.get_messages()
+
+    error, error2, ack, rows = asyncio.run(run())
+    assert error["request"] == "message" and error["client_msg_id"] == "c1"
+    assert "attachment" in error["error"]
+    assert "sender" in error2["error"]
+    assert ack["client_msg_id"] == "c2"
+    assert [r["text"] for r in rows] == ["ok"]
+
+
+def test_out_of_range_timestamp_gets_the_current_time(tmp_path):
+    async def run():
+        async with running_server(tmp_path) as url:
+            async with websockets.connect(url) as ws:
+                await recv_type(ws, "history_end")
+                acks = []
+                for i, ts in enumerate([1e30, float("inf"), float("nan"), "-99999999999999999999"]):
+                    await ws.send(json.dumps({"sender": "alice", "text": str(i), "timestamp": ts}))
+                    acks.append(await recv_type(ws, "ack"))
+            await srv.STORAGE.flush()
+            return acks, await srv.STORAGE.get_messages()
+
+    before = now_ms()
+    acks, rows = asyncio.run(run())
+    assert all(before <= a["timestamp"] <= now_ms() for a in acks)
+    assert [r["text"] for r in rows] == ["0", "1", "2", "3"]
+
+
+def test_presence_is_keyed_by_peer(tmp_path):
+    async def run():
+        async with running_server(tmp_path) as url:
+            async with websockets.connect(url) as a, websockets.connect(url) as b, websockets.connect(url) as c:
+                for ws in (a, b, c):
+                    await recv_type(ws, "history_end")
+                await a.send(json.dumps({"type": "presence", "sender": "you", "peer": "p-a", "status": "online"}))
+                await b.send(json.dumps({"type": "presence", "sender": "you", "status": "online"}))
+                seen = [await recv_type(c, "presence"), await recv_type(c, "presence")]
+                await b.close()
+                seen.append(await recv_type(c, "presence"))
+        return seen
+
+    seen = asyncio.run(run())
+    online_a, online_b = sorted(seen[:2], key=lambda f: f["peer"] != "p-a")
+    offline = seen[2]
+    assert online_a["peer"] == "p-a"
+    assert online_b["peer"] not in ("p-a", None)
+    assert offline["status"] == "offline" and offline["peer"] == online_b["peer"]
@@ -0,0 +1,100 @@
+import asyncio
+import sqlite3
+
+from server import storage as storage_mod
+from server.storage import Storage
+
+
+def test_failed_commit_is_retried_not_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage_mod, "COMMIT_RETRY_BASE", 0.001)
+
+    async def run():
+        storage = Storage(tmp_path / "chat.db", commit_window=0.01)
+        await storage.init()
+        try:
+            insert = storage._insert_rows
+            failures = [sqlite3.OperationalError("database is locked")] * 2
+
+            async def flaky(rows):
+                if failures:
+                    raise failures.pop()
+                await insert(rows)
+
+            monkeypatch.setattr(storage, "_insert_rows", flaky)
+            msg_id = await storage.add_message("alice", "hello", client_msg_id="c1")
+            await storage.flush()
+            return msg_id, await storage.get_messages(), storage.commit_retries
+        finally:
+            await storage.close()
+
+    msg_id, rows, retries = asyncio.run(run())
+    assert retries == 2
+    assert [r["id"] for r in rows] == [msg_id]
+
+
+def test_refused_row_is_dropped_alone_and_forgotten(tmp_path):
+    async def run():
+        storage = Storage(tmp_path / "chat.db", commit_window=0.01)
+        await storage.init()
+        try:
+            # another writer takes the id the next message will get
+            await storage.db.execute(
+                "INSERT INTO messages (id, sender, text, timestamp) VALUES (?, 'x', 'taken', 0)", (storage._next_id,)
+            )
+            await storage.db.commit()
+            lost = await storage.add_message("alice", "lost", client_msg_id="c1")
+            kept = await storage.add_message("alice", "kept", client_msg_id="c2")
+            await storage.flush()
+            texts = {r["id"]: r["text"] for r in await storage.get_messages()}
+            return lost, kept, texts, storage.rejected, storage.find_client_msg("c1"), storage.find_client_msg("c2")
+        finally:
+            await storage.close()
+
+    lost, kept, texts, rejected, c1, c2 = asyncio.run(run())
+    assert rejected == 1
+    assert texts[lost] == "taken" and texts[kept] == "kept"
+    assert c1 is None
+    assert c2 is not None and c2["id"] == kept
+
+
+def test_search_finds_messages_not_yet_committed(tmp_path):
+    async def run():
+        storage = Storage(tmp_path / "chat.db", commit_window=60)
+        await storage.init()
+        try:
+            await storage.add_message("alice", "Deploy finished", room="dev")
+            await storage.flush()
+            await storage.add_message("bob", "deploy again?", room="dev")
+            await storage.add_message("carol", "deploy elsewhere", room="general")
+            return await storage.search("deploy", rooms=["dev"]), await storage.search("deploy", rooms=["dev"], offset=1)
+        finally:
+            await storage.close()
+
+    first, second = asyncio.run(run())
+    assert [r["text"] for r in first] == ["deploy again?", "Deploy finished"]
+    assert first[0]["snippet"] == "[deploy] again?"
+    assert [r["text"] for r in second] == ["Deploy finished"]
+
+
+def test_unbindable_row_does_not_wedge_the_writer(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage_mod, "COMMIT_RETRY_BASE", 0.001)
+
+    async def run():
+        storage = Storage(tmp_path / "chat.db", commit_window=0.01)
+        await storage.init()
+        try:
+            before = await storage.add_message("alice", "before")
+            poison = await storage.add_message("alice", "poison", attachment={"name": "x"}, client_msg_id="c1")
+            after = await storage.add_message("alice", "after")
+            await asyncio.wait_for(storage.flush(), 5)
+            later = await storage.add_message("bob", "later")
+            await asyncio.wait_for(storage.flush(), 5)
+            ids = [r["id"] for r in await storage.get_messages()]
+            return (before, poison, after, later), ids, storage.rejected, storage.commit_retries, storage.find_client_msg("c1")
+        finally:
+            await storage.close()
+
+    (before, poison, after, later), ids, rejected, retries, c1 = asyncio.run(run())
+    assert ids == [before, after, later]
+    assert rejected == 1 and retries == 0
+    assert c1 is None